@@ -1,155 +1,3298 @@
 import discord
 from discord.ext import commands
 from discord.ui import Button, View
-import subprocess
+import aiohttp
+from aiohttp import web
 import asyncio
+import itertools
+import collections
 import random
 import string
 import os
+import sys
+import threading
 import json
 import shutil
 import re
+import sqlite3
+import time
+import hashlib
+import math
+import struct
+import heapq
+import zlib
+import gzip
+import csv
+import io
+import tempfile
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import zmq
+    import zmq.asyncio
+except ImportError:  # ZMQ notifications are optional, the unix socket and polling still work
+    zmq = None
 
 # Bot configuration with intents
 intents = discord.Intents.default()
 intents.message_content = True
 intents.guilds = True
-intents.members = True
+# No members intent: members are fetched one at a time when a deal needs them
+# (see MemberResolver), instead of chunking every guild's member list at startup.
+intents.members = False
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+# Sharding. One process runs all the shards Discord recommends by default.
+# To spread the bot over several processes, start each one with the same
+# SHARD_COUNT and its own SHARD_IDS, e.g. SHARD_COUNT=4 SHARD_IDS=0,1 and
+# SHARD_COUNT=4 SHARD_IDS=2,3. Every process keeps the deals of its own
+# guilds and they all share db/ledger.sqlite3, through which the process
+# holding the coordinator lease watches deposits and signs payouts for all.
+SHARD_COUNT = int(os.environ["SHARD_COUNT"]) if os.environ.get("SHARD_COUNT") else None
+SHARD_IDS = [int(shard) for shard in os.environ["SHARD_IDS"].split(",")] if os.environ.get("SHARD_IDS") else None
+if SHARD_IDS and not SHARD_COUNT:
+    raise SystemExit("SHARD_IDS is set without SHARD_COUNT: every sharded process needs the same SHARD_COUNT.")
+if SHARD_IDS and not all(0 <= shard < SHARD_COUNT for shard in SHARD_IDS):
+    raise SystemExit(f"SHARD_IDS must be between 0 and SHARD_COUNT - 1 ({SHARD_COUNT - 1}).")
+PROCESS_NAME = "shards-" + "-".join(map(str, SHARD_IDS)) if SHARD_IDS else "main"
+COORDINATOR_LEASE_TTL = 30  # Seconds the coordinator lease lasts without renewal
+COORDINATOR_POLL_INTERVAL = 1.0  # Seconds between checks of the shared deposit and payout tables
+COORDINATOR_PAYOUT_TIMEOUT = 300  # Seconds a release waits for the coordinator to pay out before giving up
+
+class AutoMiddlemanBot(commands.AutoShardedBot):
+    async def close(self):
+        # Hand over the coordinator lease, write pending deal state and
+        # release the node connections before exiting
+        await coordinator.stop()
+        await deal_store.flush(compact=True)
+        await rpc.close()
+        await metrics.stop()
+        watchdog.stop()
+        await super().close()
+
+bot = AutoMiddlemanBot(
+    command_prefix="!", intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS,
+    chunk_guilds_at_startup=False, member_cache_flags=discord.MemberCacheFlags.none()
+)
 
 TOKEN = "token"  # Replace with your actual bot token
 
-# Constants
-EMBED_COLOR_GREEN = 0x3cc171
-EMBED_COLOR_ORANGE = 0xff7f00
-LOGS_DIR = "logs/threads"  # Directory for thread logs
-DB_DIR = "db"
-USERS_DIR = os.path.join(DB_DIR, "users")
-STATS_FILE = os.path.join(DB_DIR, "stats.json")
-thread_data = {}  # Maps thread.id to a custom thread ID
+# Constants
+EMBED_COLOR_GREEN = 0x3cc171
+EMBED_COLOR_ORANGE = 0xff7f00
+LOGS_DIR = "logs/threads"  # Directory for thread logs
+DB_DIR = "db"
+USERS_DIR = os.path.join(DB_DIR, "users")  # Legacy per-user stats, migrated into the ledger
+STATS_FILE = os.path.join(DB_DIR, "stats.json")  # Legacy stats, migrated into the ledger
+# Open deals, read at startup, and the deal changes since. Each sharded process has its own.
+DEAL_SNAPSHOT_FILE = os.path.join(DB_DIR, f"deals.{PROCESS_NAME}.snapshot.json" if SHARD_IDS else "deals.snapshot.json")
+DEAL_JOURNAL_FILE = os.path.join(DB_DIR, f"deals.{PROCESS_NAME}.journal" if SHARD_IDS else "deals.journal")
+DEAL_SNAPSHOT_EVERY = 1000  # Journal entries before they are folded into a new snapshot
+DEAL_FLUSH_DELAY = 1.0  # Seconds deal changes are held to coalesce them into one write
+DEAL_SWEEP_INTERVAL = 60  # Seconds between sweeps for expired deals
+# Seconds a deal may stay in each state. Deals stalled before funding expire,
+# finished deals are archived; funded deals never time out. Cancelled and
+# expired deals without an address are archived at once; those with one stay
+# watched that long in case a deposit still arrives.
+DEAL_TTL = {
+    "created": 3600,
+    "accepted": 3600,
+    "roles_confirmed": 3 * 86400,
+    "released": 86400,
+    "cancelled": 30 * 86400,
+    "expired": 30 * 86400,
+}
+# Finished deals are moved out of LOGS_DIR into compressed, append-only
+# segment files. Each sharded process appends to its own directory.
+ARCHIVE_DIR = os.path.join("logs", "archive", PROCESS_NAME) if SHARD_IDS else os.path.join("logs", "archive")
+ARCHIVE_SEGMENT_SIZE = 64 * 1024 * 1024  # Bytes after which a new segment file is started
+LEDGER_FILE = os.path.join(DB_DIR, "ledger.sqlite3")
+COIN = 100_000_000  # Litoshis per LTC
+ROLLUP_HOURS = 48  # Hourly stats buckets kept in memory
+ROLLUP_DAYS = 90  # Daily stats buckets kept in memory
+LEADERBOARD_SIZE = 10
+HISTORY_PAGE_SIZE = 10  # Deals per !history page
+EXPORT_CHUNK_SIZE = 1000  # Deals read from the ledger and written out per step of !export
+ADDRESS_POOL_LOW = 20  # Refill the deposit address pool below this many free addresses
+ADDRESS_POOL_HIGH = 100  # ...up to this many
+ADDRESS_POOL_BATCH = 25  # Addresses generated per batched RPC request
+LTC_NETWORK = "main"  # "main", "test" or "regtest", used to decode payout addresses
+FEE_RATE = 0.0001  # Fallback payout fee rate in LTC per 1000 virtual bytes, used without estimates
+FEE_RATE_MAX = 0.01  # Never pay more than this, whatever the node estimates
+FEE_TARGETS = (2, 6, 12)  # Confirmation targets, in blocks, estimated in the background
+FEE_TARGET = 6  # Confirmation target used for payouts
+FEE_REFRESH_INTERVAL = 300  # Seconds between estimatesmartfee refreshes
+FEE_ESTIMATE_TTL = 900  # Estimates older than this are ignored
+
+# Payout batching merges releases into one multi-output transaction
+PAYOUT_BATCHING = False
+PAYOUT_BATCH_INTERVAL = 60  # Seconds between batch broadcasts
+PAYOUT_BATCH_SIZE = 25  # Broadcast early once this many releases are queued
+
+# litecoind JSON-RPC connection. Leave RPC_USER/RPC_PASSWORD empty to use the
+# node's cookie file, the same way litecoin-cli authenticates by default.
+RPC_URL = "http://127.0.0.1:9332"
+RPC_USER = ""
+RPC_PASSWORD = ""
+RPC_COOKIE_FILE = os.path.expanduser("~/.litecoin/.cookie")
+RPC_POOL_SIZE = 8  # Maximum number of keep-alive connections to the node
+RPC_TIMEOUT = 30  # Default per-call timeout in seconds
+
+# Extra litecoind nodes that share the read load of the RPC_URL node, which
+# stays the wallet node. Each entry is a dict with "url" and "user"/"password"
+# or "cookie_file"; add "wallet": "replica" for nodes holding a watch-only copy
+# of the escrow wallet, so they can also answer listunspent and balance queries.
+RPC_NODES = []  # e.g. [{"url": "http://10.0.0.2:9332", "user": "bot", "password": "..."}]
+RPC_HEALTH_INTERVAL = 15  # Seconds between node health and tip checks
+RPC_MAX_LAG = 2  # Blocks a node may trail the best tip before leaving rotation
+WATCH_INTERVAL = 10  # Seconds between deposit watcher ticks when no notifications arrive
+WATCH_FALLBACK_INTERVAL = 120  # Safety poll while block/tx notifications are flowing
+NOTIFY_SILENCE_TIMEOUT = 600  # Seconds without any notification before polling every WATCH_INTERVAL again
+WATCH_SHARED_TTL = 300  # Seconds a sharded process's watched addresses stay polled without a refresh
+
+# Node notifications. Set NOTIFY_ZMQ to the node's zmqpubhashblock/zmqpubrawtx
+# endpoints, and/or NOTIFY_SOCKET to a unix socket fed by litecoind, e.g.
+#   blocknotify=sh -c 'echo block %s | nc -U /tmp/automiddleman.sock'
+#   walletnotify=sh -c 'echo wallet %s | nc -U /tmp/automiddleman.sock'
+NOTIFY_ZMQ = []  # e.g. ["tcp://127.0.0.1:28332"]
+NOTIFY_SOCKET = ""  # e.g. "/tmp/automiddleman.sock"
+
+# Outbound message pacing. Each route gets a budget of (requests, per seconds)
+# in every channel, on top of a bot-wide budget of OUTBOX_GLOBAL_RATE/s.
+OUTBOX_ROUTE_LIMITS = {"send": (5, 5.0), "edit": (5, 5.0), "delete": (5, 5.0)}
+OUTBOX_GLOBAL_RATE = 50
+
+# Admission control: buttons that need the node or Discord are refused while
+# more than this many node requests, or outbound thread operations, are pending.
+ADMISSION_MAX_RPC = 4 * RPC_POOL_SIZE
+ADMISSION_MAX_OUTBOX = 500
+
+# Guild members looked up by id are cached, least recently used first out
+MEMBER_CACHE_SIZE = 10000
+MEMBER_CACHE_TTL = 600  # Seconds a fetched member is reused
+MEMBER_MISS_TTL = 60  # Seconds an id found not to be a member is remembered
+
+# Confirmations required before funds can be released, by deposit amount.
+# Each entry is (minimum amount in LTC, confirmations); the largest match wins.
+# The result is stored with the deal; administrators can override it for one
+# deal with !confirmations in its thread.
+CONFIRMATION_TIERS = [(0, 1), (10, 3), (100, 6)]
+
+# Prometheus metrics endpoint, served on http://METRICS_HOST:METRICS_PORT/metrics.
+# Sharded processes listen on METRICS_PORT plus their first shard id.
+# Set METRICS_PORT to None to disable it.
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)  # Seconds
+SLOW_SPAN_SECONDS = None  # Log handlers, RPC calls and Discord requests slower than this, e.g. 2.0
+
+# Event loop watchdog: a heartbeat task measures how late the loop runs it, and
+# a thread prints the loop's stack once the heartbeat is WATCHDOG_THRESHOLD late.
+WATCHDOG_INTERVAL = 0.1  # Seconds between heartbeats
+WATCHDOG_THRESHOLD = 0.5  # Seconds the loop may be blocked before its stack is printed, None to disable
+PROFILE_INTERVAL = 0.005  # Seconds between stack samples of !profile
+PROFILE_MAX_SECONDS = 60
+
+# Create directories if they do not exist
+os.makedirs(LOGS_DIR, exist_ok=True)
+os.makedirs(USERS_DIR, exist_ok=True)
+os.makedirs(DB_DIR, exist_ok=True)
+
+
+def generate_id(length=32):
+    """Generate a random alphanumeric ID."""
+    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=length))
+
+def sanitize_filename(name):
+    """Sanitize a string to be safely used as a filename."""
+    return re.sub(r'[^\w\.-]', '_', name)
+
+background_tasks = set()
+
+def spawn(coro):
+    """Run a coroutine in the background, keeping a reference to it until it finishes."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+def owns_guild(guild_id):
+    """Whether this process runs the shard of a guild. Deals from before
+    sharding have no guild and stay with the process running shard 0."""
+    if not SHARD_IDS:
+        return True
+    if guild_id is None:
+        return 0 in SHARD_IDS
+    return (guild_id >> 22) % SHARD_COUNT in SHARD_IDS
+
+def confirmations_for(amount):
+    """Return the number of confirmations required for a deposit amount."""
+    required = 1
+    for min_amount, confirmations in CONFIRMATION_TIERS:
+        if amount >= min_amount:
+            required = confirmations
+    return required
+
+def to_litoshis(amount):
+    """Convert an LTC amount to an integer number of litoshis."""
+    return int(round(float(amount) * COIN))
+
+# ----------------- Metrics -----------------
+class Histogram:
+    """Cumulative latency histogram over METRICS_BUCKETS."""
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(METRICS_BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.total += seconds
+        self.count += 1
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+
+class Metrics:
+    """
+    Latency histograms for handlers, RPC methods and Discord routes, plus
+    gauges read from the live services when scraped, exposed in the
+    Prometheus text format on a local HTTP endpoint.
+    """
+    # Histogram families: name -> (label name, help)
+    FAMILIES = {
+        "handler": ("handler", "Interaction handler latency"),
+        "rpc": ("method", "litecoind RPC latency"),
+        "discord": ("route", "Discord API request latency"),
+        "watcher_tick": ("mode", "Deposit watcher tick duration"),
+        "loop_lag": ("loop", "How late the event loop ran the watchdog heartbeat"),
+    }
+
+    def __init__(self, host=METRICS_HOST, port=METRICS_PORT, slow=SLOW_SPAN_SECONDS):
+        self.host = host
+        self.port = port
+        self.slow = slow
+        self.histograms = {}  # (family, label) -> Histogram
+        self.errors = {}  # (family, label) -> count
+        self._runner = None
+
+    def observe(self, family, label, seconds):
+        histogram = self.histograms.get((family, label))
+        if histogram is None:
+            histogram = self.histograms[(family, label)] = Histogram()
+        histogram.observe(seconds)
+        if self.slow is not None and seconds >= self.slow:
+            print(f"Slow {family} span {label}: {seconds:.3f}s")
+
+    @contextlib.contextmanager
+    def span(self, family, label):
+        """Time the enclosed block; exceptions are counted as errors."""
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            if not isinstance(e, (asyncio.CancelledError, PromptCancelled)):
+                self.errors[(family, label)] = self.errors.get((family, label), 0) + 1
+            raise
+        finally:
+            self.observe(family, label, time.perf_counter() - started)
+
+    def instrument_http(self, http):
+        """Time every Discord REST request by its route template."""
+        request = http.request
+
+        async def timed_request(route, **kwargs):
+            with self.span("discord", f"{route.method} {route.path}"):
+                return await request(route, **kwargs)
+
+        http.request = timed_request
+
+    @staticmethod
+    def _label(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def gauges(self):
+        """Return [(name, help, {label tuple: value})] read from the running services."""
+        states = {state: 0 for state in DEAL_TRANSITIONS}
+        for deal in deal_store.deals.values():
+            states[deal.state] = states.get(deal.state, 0) + 1
+        last_tick = deposit_watcher.last_tick
+        queues = {
+            "outbox": outbox.pending(),
+            "prompts": len(message_router.waiters),
+            "payout_batch": len(payout_batcher.queue),
+            "deal_flush": len(deal_store.dirty),
+            "rpc_in_flight": rpc.in_flight,
+            "interactions_waiting": sum(route.waiting for route in interactions.routes.values()),
+        }
+        return [
+            ("automiddleman_deals", "Deals in memory by state", {("state", state): count for state, count in states.items()}),
+            ("automiddleman_watched_addresses", "Addresses the deposit watcher waits on", {(): len(deposit_watcher.waiters)}),
+            ("automiddleman_watcher_lag_seconds", "Seconds since the deposit watcher last completed a tick while addresses were watched",
+             {(): time.monotonic() - last_tick if last_tick and deposit_watcher.waiters else 0}),
+            ("automiddleman_queue_depth", "Items waiting in internal queues", {("queue", name): depth for name, depth in queues.items()}),
+            ("automiddleman_coordinator", "1 if this process is the coordinator", {(): int(coordinator.is_leader)}),
+        ]
+
+    def render(self):
+        lines = []
+        for family, (label_name, help_text) in self.FAMILIES.items():
+            name = f"automiddleman_{family}_seconds"
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for (key, label), histogram in sorted(self.histograms.items()):
+                if key != family:
+                    continue
+                label = f'{label_name}="{self._label(label)}"'
+                cumulative = 0
+                for bound, count in zip(METRICS_BUCKETS, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{label},le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{{label},le="+Inf"}} {histogram.count}')
+                lines.append(f"{name}_sum{{{label}}} {histogram.total}")
+                lines.append(f"{name}_count{{{label}}} {histogram.count}")
+        lines.append("# HELP automiddleman_errors_total Spans that ended with an exception")
+        lines.append("# TYPE automiddleman_errors_total counter")
+        for (family, label), count in sorted(self.errors.items()):
+            lines.append(f'automiddleman_errors_total{{family="{family}",label="{self._label(label)}"}} {count}')
+        for name, help_text, values in self.gauges():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for label, value in values.items():
+                labels = f'{{{label[0]}="{self._label(label[1])}"}}' if label else ""
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+    async def _handle(self, request):
+        return web.Response(body=self.render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def start(self):
+        if self.port is None or self._runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        port = self.port + (SHARD_IDS[0] if SHARD_IDS else 0)
+        await web.TCPSite(self._runner, self.host, port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+metrics = Metrics()
+
+# ----------------- Loop watchdog -----------------
+def frame_stack(frame):
+    """Return a frame's stack, outermost call first, as "function (file:line)" strings."""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+class LoopWatchdog:
+    """
+    Detects a blocked event loop. A heartbeat task runs every
+    WATCHDOG_INTERVAL and records how late it was woken as loop lag. A daemon
+    thread watches the heartbeat and, once it is WATCHDOG_THRESHOLD overdue,
+    prints what the loop thread is running right then, which is the blocking
+    call. Each stall is reported once, then its total length when it ends.
+    """
+    def __init__(self, interval=WATCHDOG_INTERVAL, threshold=WATCHDOG_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.beat = time.monotonic()
+        self.stalls = 0
+        self._reported = None  # Heartbeat of the stall already reported
+        self._loop_thread = None
+        self._stop = threading.Event()
+        self._task = None
+
+    def start(self):
+        if self.threshold is None or self._task is not None:
+            return
+        self._loop_thread = threading.get_ident()
+        self.beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(now - expected, 0.0)
+            metrics.observe("loop_lag", "main", lag)
+            if self._reported == self.beat:
+                print(f"Event loop was blocked for {now - self.beat:.2f}s")
+            self.beat = now
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            beat = self.beat
+            if time.monotonic() - beat < self.threshold or self._reported == beat:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            self._reported = beat
+            self.stalls += 1
+            print(f"Event loop blocked for over {self.threshold}s, at:\n  " + "\n  ".join(frame_stack(frame)))
+
+watchdog = LoopWatchdog()
+
+def sample_stacks(seconds, interval=PROFILE_INTERVAL):
+    """
+    Sample the stack of every thread for `seconds`, from the calling thread,
+    and return the samples in the collapsed format flamegraph.pl and
+    speedscope read: "thread;outer;...;inner count" per line. Samples land
+    where threads give up the GIL, which blocking calls do right away, so
+    they are caught exactly; busy Python code is sampled less often.
+    """
+    own = threading.get_ident()
+    names = {}
+    counts = collections.Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            if thread_id not in names:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            counts[";".join([names.get(thread_id, str(thread_id)), *frame_stack(frame)])] += 1
+        time.sleep(interval)
+    return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+# ----------------- Deal store -----------------
+class InvalidTransition(Exception):
+    """A deal was asked to move to a state it cannot reach from its current one."""
+
+# Deal lifecycle: which states each state may move to
+DEAL_TRANSITIONS = {
+    "created": {"accepted", "cancelled", "expired"},
+    "accepted": {"roles_confirmed", "cancelled", "expired"},
+    "roles_confirmed": {"funded", "cancelled", "expired"},
+    "funded": {"confirmed"},
+    "confirmed": {"released"},
+    "released": set(),
+    # A deposit that arrives after all the same
+    "cancelled": {"funded"},
+    "expired": {"funded"},
+}
+TERMINAL_STATES = {"released", "cancelled", "expired"}
+
+class Deal:
+    """
+    State of one escrow deal, mirrored to logs/threads/<deal_id>/info.json.
+    Records use __slots__ to stay small with thousands of deals open; state
+    changes go through DealStore.transition so only DEAL_TRANSITIONS apply.
+    """
+    FIELDS = (
+        "state", "state_since", "guild_id", "thread_id", "participants", "address", "private_key", "sender", "receiver",
+        "amount", "confirmations_required", "roles", "role_message_id", "message_ids", "watching", "txid"
+    )
+    __slots__ = ("deal_id", "role_view") + FIELDS
+
+    def __init__(self, deal_id, **fields):
+        self.deal_id = deal_id
+        for field in self.FIELDS:
+            setattr(self, field, fields.get(field))
+        # Pending role selections are kept in `roles`: {user_id: {"role": None, "confirmed": False}}
+        self.participants = self.participants or []
+        self.state = self.state or "created"
+        self.state_since = self.state_since or time.time()
+        self.role_view = None  # Live RoleSelectionView, never persisted
+
+    @classmethod
+    def from_info(cls, deal_id, info):
+        fields = {field: info.get(field) for field in cls.FIELDS}
+        if fields["roles"]:
+            # JSON object keys are strings, user ids are ints
+            fields["roles"] = {int(user_id): selection for user_id, selection in fields["roles"].items()}
+        if not fields["state"]:
+            # info.json written before deals had states
+            if fields["txid"]:
+                fields["state"] = "released"
+            elif fields["amount"] is not None:
+                fields["state"] = "funded"
+            elif fields["sender"] is not None:
+                fields["state"] = "roles_confirmed"
+            elif len(fields["participants"] or []) > 1:
+                fields["state"] = "accepted"
+        return cls(deal_id, **fields)
+
+    def to_info(self):
+        return {field: getattr(self, field) for field in self.FIELDS if getattr(self, field) is not None}
+
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    deal_id TEXT PRIMARY KEY,
+    thread_id INTEGER,
+    address TEXT,
+    segment INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_thread ON records (thread_id);
+CREATE INDEX IF NOT EXISTS records_address ON records (address);
+"""
+
+class DealArchive:
+    """
+    Append-only store for finished deals. Each deal becomes one record, its
+    info and thread transcript as zlib-compressed JSON behind a 4-byte length,
+    appended to segment-NNNNNN.dat; a new segment is started once the current
+    one reaches ARCHIVE_SEGMENT_SIZE. A sidecar SQLite index maps deal id,
+    thread id and address to the record's segment, offset and length, so a
+    lookup is one indexed query and one seek.
+
+    Segments are written first and indexed after, so the index never points
+    at missing data; on open, records past the last indexed one are re-indexed
+    and a record torn by a crash is cut off. Used from the DealStore worker
+    thread only.
+    """
+    HEADER = struct.Struct(">I")
+
+    def __init__(self, directory=ARCHIVE_DIR, segment_size=ARCHIVE_SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.segment = None  # Number of the segment being appended to
+        self.conn = None
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, f"segment-{segment:06d}.dat")
+
+    def _open(self):
+        if self.conn is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(self.directory, "index.sqlite3"), check_same_thread=False)
+        self.conn.executescript(ARCHIVE_SCHEMA)
+        segments = [
+            int(name[8:-4]) for name in os.listdir(self.directory)
+            if name.startswith("segment-") and name.endswith(".dat")
+        ]
+        self.segment = max(segments, default=1)
+        self._recover(self.segment)
+
+    def _recover(self, segment):
+        path = self._segment_path(segment)
+        if not os.path.exists(path):
+            return
+        (end,) = self.conn.execute(
+            "SELECT COALESCE(MAX(offset + length), 0) FROM records WHERE segment = ?", (segment,)
+        ).fetchone()
+        rows = []
+        with open(path, "r+b") as f:
+            f.seek(end)
+            while True:
+                header = f.read(self.HEADER.size)
+                if not header:
+                    break
+                if len(header) == self.HEADER.size:
+                    (size,) = self.HEADER.unpack(header)
+                    blob = f.read(size)
+                    if len(blob) == size:
+                        try:
+                            record = json.loads(zlib.decompress(blob))
+                        except (zlib.error, ValueError):
+                            record = None
+                        if record is not None:
+                            rows.append(self._row(record, segment, end, self.HEADER.size + size))
+                            end += self.HEADER.size + size
+                            continue
+                print(f"Truncating torn archive record at {path}:{end}")
+                f.truncate(end)
+                break
+        if rows:
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    @staticmethod
+    def _row(record, segment, offset, length):
+        info = record["info"]
+        return (record["deal_id"], info.get("thread_id"), info.get("address"), segment, offset, length)
+
+    def append(self, records):
+        """Archive (deal_id, info, transcript) tuples, durably, in one write per segment."""
+        self._open()
+        path = self._segment_path(self.segment)
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        rows, chunks = [], []
+        for deal_id, info, transcript in records:
+            record = {"deal_id": deal_id, "archived_at": int(time.time()), "info": info, "transcript": transcript}
+            blob = zlib.compress(json.dumps(record, separators=(",", ":")).encode())
+            length = self.HEADER.size + len(blob)
+            if offset and offset + length > self.segment_size:
+                self._write(path, chunks)
+                self.segment += 1
+                path, offset, chunks = self._segment_path(self.segment), 0, []
+            chunks.append(self.HEADER.pack(len(blob)) + blob)
+            rows.append(self._row(record, self.segment, offset, length))
+            offset += length
+        self._write(path, chunks)
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    @staticmethod
+    def _write(path, chunks):
+        if not chunks:
+            return
+        with open(path, "ab") as f:
+            f.write(b"".join(chunks))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def find(self, deal_id=None, thread_id=None, address=None):
+        """Return the archived record of a deal, looked up by any one of its keys, or None."""
+        self._open()
+        if deal_id is not None:
+            where, key = "deal_id = ?", deal_id
+        elif thread_id is not None:
+            where, key = "thread_id = ?", thread_id
+        else:
+            where, key = "address = ?", address
+        row = self.conn.execute(
+            f"SELECT segment, offset, length FROM records WHERE {where} ORDER BY rowid DESC LIMIT 1", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        segment, offset, length = row
+        with open(self._segment_path(segment), "rb") as f:
+            f.seek(offset)
+            data = f.read(length)
+        return json.loads(zlib.decompress(data[self.HEADER.size:]))
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+class DealStore:
+    """
+    In-memory index of every deal, keyed by deal id, Discord thread id,
+    deposit address and participant, so handlers never have to scan thread
+    history to find their state. info.json stays the per-deal on-disk copy,
+    next to transcript.jsonl, the messages posted in the deal's thread; it is
+    only written, startup reads the snapshot and journal, so edits to it are
+    overwritten.
+
+    The in-memory deal is the source of truth. Changes only mark it dirty and
+    a write-behind flusher writes each dirty deal once per DEAL_FLUSH_DELAY,
+    on a worker thread, with an atomic temp-file-and-rename. Every flush is
+    also appended to a journal, which is folded into a compact snapshot every
+    DEAL_SNAPSHOT_EVERY entries; startup only reads those two files.
+
+    Deals in a state with a DEAL_TTL are queued by deadline so the sweeper
+    finds abandoned or finished deals without walking the whole store. Deals
+    dropped from the store are moved into the DealArchive and their folder is
+    deleted, so LOGS_DIR only holds live deals.
+    """
+    def __init__(self, logs_dir=LOGS_DIR, snapshot_file=DEAL_SNAPSHOT_FILE, journal_file=DEAL_JOURNAL_FILE,
+                 flush_delay=DEAL_FLUSH_DELAY, snapshot_every=DEAL_SNAPSHOT_EVERY, archive=None):
+        self.logs_dir = logs_dir
+        self.archive = archive if archive is not None else DealArchive()
+        self.snapshot_file = snapshot_file
+        self.journal_file = journal_file
+        self.flush_delay = flush_delay
+        self.snapshot_every = snapshot_every
+        self.deals = {}  # deal_id -> Deal
+        self.threads = {}  # thread_id -> deal_id
+        self.addresses = {}  # address -> deal_id
+        self.participants = {}  # user_id -> set of deal_ids
+        self.dirty = set()  # deal_ids waiting to be written
+        self.dropped = {}  # deal_id -> last info, to be archived
+        self.transcripts = {}  # deal_id -> transcript lines waiting to be written
+        self.deadlines = []  # heap of (deadline, deal_id, state_since)
+        self.journal_entries = 0
+        # A single worker keeps writes and deletions of a deal in order
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="deal-store")
+        self._flush_task = None
+
+    def _info_path(self, deal_id):
+        return os.path.join(self.logs_dir, deal_id, "info.json")
+
+    def _transcript_path(self, deal_id):
+        return os.path.join(self.logs_dir, deal_id, "transcript.jsonl")
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def load(self):
+        """Restore every deal from the snapshot and journal."""
+        infos, self.journal_entries, legacy = await self._run(self._read_state)
+        for deal_id, info in infos.items():
+            if legacy and not owns_guild(info.get("guild_id")):
+                continue  # Another sharded process's deal
+            deal = Deal.from_info(deal_id, info)
+            self._index(deal)
+            self._schedule_deadline(deal)
+        if legacy:
+            # First start with a snapshot: write one so later starts skip the scan
+            await self.flush(compact=True)
+        # Folders of deals evicted before the archive existed
+        await self._run(self._archive_orphans, set(self.deals))
+
+    def _read_state(self):
+        """Return ({deal_id: info}, journal entries, whether the legacy scan was used)."""
+        if not os.path.exists(self.snapshot_file) and not os.path.exists(self.journal_file):
+            return self._read_all(), 0, True
+        infos = {}
+        if os.path.exists(self.snapshot_file):
+            with open(self.snapshot_file, "r") as f:
+                infos = json.load(f)
+        entries = 0
+        if os.path.exists(self.journal_file):
+            with open(self.journal_file, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # A torn last line from a crash mid-append
+                    entries += 1
+                    if entry.get("removed"):
+                        infos.pop(entry["id"], None)
+                    else:
+                        infos[entry["id"]] = entry["info"]
+        return infos, entries, False
+
+    def _read_all(self):
+        infos = {}
+        for deal_id in os.listdir(self.logs_dir):
+            try:
+                with open(self._info_path(deal_id), "r") as f:
+                    infos[deal_id] = json.load(f)
+            except (OSError, ValueError):
+                continue
+        return infos
+
+    def _archive_orphans(self, live):
+        orphans = []
+        for deal_id in os.listdir(self.logs_dir) if os.path.isdir(self.logs_dir) else ():
+            if deal_id in live:
+                continue
+            try:
+                with open(self._info_path(deal_id), "r") as f:
+                    info = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if owns_guild(info.get("guild_id")):
+                orphans.append((deal_id, info))
+        for start in range(0, len(orphans), 1000):
+            self._archive_dropped(dict(orphans[start:start + 1000]))
+        if orphans:
+            print(f"Archived {len(orphans)} deal folders")
+
+    def _index(self, deal):
+        self.deals[deal.deal_id] = deal
+        if deal.thread_id is not None:
+            self.threads[deal.thread_id] = deal.deal_id
+        if deal.address:
+            self.addresses[deal.address] = deal.deal_id
+        for user_id in {*deal.participants, deal.sender, deal.receiver} - {None}:
+            self.participants.setdefault(user_id, set()).add(deal.deal_id)
+
+    def _unindex(self, deal):
+        self.threads.pop(deal.thread_id, None)
+        self.addresses.pop(deal.address, None)
+        for user_id in {*deal.participants, deal.sender, deal.receiver} - {None}:
+            deals = self.participants.get(user_id)
+            if deals is not None:
+                deals.discard(deal.deal_id)
+                if not deals:
+                    del self.participants[user_id]
+
+    def save(self, deal):
+        """Schedule the deal's info.json to be written by the flusher."""
+        self.dirty.add(deal.deal_id)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_delay)
+        await self.flush()
+
+    async def flush(self, compact=False):
+        """Write every dirty deal to disk, off the event loop."""
+        while self.dirty or self.dropped or self.transcripts or compact:
+            dirty, self.dirty = self.dirty, set()
+            dropped, self.dropped = self.dropped, {}
+            transcripts, self.transcripts = self.transcripts, {}
+            # Snapshot on the loop so the worker never sees a half-applied update
+            infos = [(deal_id, self.deals[deal_id].to_info()) for deal_id in dirty if deal_id in self.deals]
+            self.journal_entries += len(infos) + len(dropped)
+            snapshot = None
+            if compact or self.journal_entries >= self.snapshot_every:
+                snapshot = {deal_id: deal.to_info() for deal_id, deal in self.deals.items()}
+                self.journal_entries = 0
+                compact = False
+            await self._run(self._write_all, infos, dropped, transcripts, snapshot)
+
+    def _write_all(self, infos, dropped, transcripts, snapshot):
+        entries = [{"id": deal_id, "info": info} for deal_id, info in infos]
+        entries += [{"id": deal_id, "removed": True} for deal_id in dropped]
+        if entries:
+            with open(self.journal_file, "a") as f:
+                f.write("".join(json.dumps(entry) + "\n" for entry in entries))
+                f.flush()
+                os.fsync(f.fileno())
+        for deal_id, info in infos:
+            self._write_json(self._info_path(deal_id), info)
+        for deal_id, lines in transcripts.items():
+            path = self._transcript_path(deal_id)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "a") as f:
+                    f.write("".join(json.dumps(line) + "\n" for line in lines))
+            except OSError as e:
+                print(f"Error writing {path}: {e}")
+        if dropped:
+            self._archive_dropped(dropped)
+        if snapshot is not None:
+            # The snapshot covers everything journaled so far, start a new journal
+            self._write_json(self.snapshot_file, snapshot, indent=None)
+            open(self.journal_file, "w").close()
+
+    def _archive_dropped(self, dropped):
+        """Move dropped deals, with their transcripts, into the archive and delete their folders."""
+        records = []
+        for deal_id, info in dropped.items():
+            transcript = []
+            try:
+                with open(self._transcript_path(deal_id), "r") as f:
+                    for line in f:
+                        try:
+                            transcript.append(json.loads(line))
+                        except ValueError:
+                            break  # A torn last line from a crash mid-append
+            except OSError:
+                pass
+            records.append((deal_id, info, transcript))
+        try:
+            self.archive.append(records)
+        except (OSError, sqlite3.Error) as e:
+            # Keep the folders, the deals are archived again at the next startup
+            print(f"Error archiving deals: {e}")
+            for deal_id, info in dropped.items():
+                self._write_json(self._info_path(deal_id), info)
+            return
+        for deal_id in dropped:
+            shutil.rmtree(os.path.join(self.logs_dir, deal_id), ignore_errors=True)
+
+    @staticmethod
+    def _write_json(path, data, indent=4):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(data, f, indent=indent)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Error writing {path}: {e}")
+
+    def create(self, deal_id, thread_id, creator_id, guild_id=None):
+        """Register a new deal, its logs folder is created on the first flush."""
+        deal = Deal(deal_id, guild_id=guild_id, thread_id=thread_id, participants=[creator_id])
+        self._index(deal)
+        self._schedule_deadline(deal)
+        self.save(deal)
+        return deal
+
+    def update(self, deal, **fields):
+        """Change some fields of a deal, keep the indexes in sync and save it."""
+        self._unindex(deal)
+        for field, value in fields.items():
+            setattr(deal, field, value)
+        self._index(deal)
+        self.save(deal)
+
+    def transition(self, deal, state, **fields):
+        """Move a deal to a new state, updating other fields along with it."""
+        if state not in DEAL_TRANSITIONS[deal.state]:
+            raise InvalidTransition(f"Deal {deal.deal_id} cannot go from {deal.state} to {state}")
+        self.update(deal, state=state, state_since=time.time(), **fields)
+        self._schedule_deadline(deal)
+
+    def _schedule_deadline(self, deal):
+        ttl = DEAL_TTL.get(deal.state)
+        if ttl is not None:
+            heapq.heappush(self.deadlines, (deal.state_since + ttl, deal.deal_id, deal.state_since))
+
+    def requeue(self, deal):
+        """Queue a deal popped by pop_expired again, to be swept next time."""
+        heapq.heappush(self.deadlines, (0, deal.deal_id, deal.state_since))
+
+    def pop_expired(self, now):
+        """Return the deals that stayed in their current state past its TTL."""
+        expired = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, deal_id, state_since = heapq.heappop(self.deadlines)
+            deal = self.deals.get(deal_id)
+            # Entries of deals that moved on since they were queued are stale
+            if deal is not None and deal.state_since == state_since:
+                expired.append(deal)
+        return expired
+
+    def log_message(self, deal, message):
+        """Queue a message posted in the deal's thread for its transcript."""
+        line = {"at": message.created_at.timestamp(), "author": message.author.id, "content": message.content}
+        if message.attachments:
+            line["attachments"] = [attachment.url for attachment in message.attachments]
+        self.transcripts.setdefault(deal.deal_id, []).append(line)
+        self._schedule_flush()
+
+    def archive_deal(self, deal):
+        """Drop a finished deal from memory and move its files into the archive in the background."""
+        self._unindex(deal)
+        self.deals.pop(deal.deal_id, None)
+        self.dirty.discard(deal.deal_id)
+        self.dropped[deal.deal_id] = deal.to_info()
+        self._schedule_flush()
+
+    async def find_archived(self, deal_id=None, thread_id=None, address=None):
+        """Read a deal's archived record, by deal id, thread id or address."""
+        return await self._run(self.archive.find, deal_id, thread_id, address)
+
+    def get(self, deal_id):
+        return self.deals.get(deal_id)
+
+    def by_thread(self, thread_id):
+        return self.deals.get(self.threads.get(thread_id))
+
+    def by_address(self, address):
+        return self.deals.get(self.addresses.get(address))
+
+    def for_participant(self, user_id):
+        return [self.deals[deal_id] for deal_id in self.participants.get(user_id, ())]
+
+deal_store = DealStore()
+
+# ----------------- Ledger -----------------
+LEDGER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS deals (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    deal_id TEXT NOT NULL UNIQUE,
+    thread_id INTEGER,
+    sender_id INTEGER,
+    receiver_id INTEGER,
+    amount INTEGER NOT NULL,
+    fee INTEGER,
+    txid TEXT,
+    completed_at INTEGER NOT NULL  -- 0 for deals imported from stats.json, whose date is unknown
+);
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    amount_sent INTEGER NOT NULL DEFAULT 0,
+    amount_received INTEGER NOT NULL DEFAULT 0,
+    total_deals INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS legacy_users (
+    name TEXT PRIMARY KEY,
+    amount_sent INTEGER NOT NULL,
+    amount_received INTEGER NOT NULL,
+    total_deals INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS address_pool (
+    address TEXT PRIMARY KEY,
+    private_key TEXT NOT NULL,
+    deal_id TEXT UNIQUE,
+    created_at INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS watched (
+    address TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    updated_at INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS deposits (
+    address TEXT PRIMARY KEY,
+    amount REAL NOT NULL,
+    confirmations INTEGER NOT NULL,
+    updated_at INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS payouts (
+    deal_id TEXT PRIMARY KEY,
+    address TEXT NOT NULL,
+    script TEXT NOT NULL,
+    status TEXT NOT NULL,
+    owner TEXT,
+    txid TEXT,
+    amount INTEGER,
+    fee INTEGER,
+    error TEXT,
+    updated_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS payouts_status ON payouts (status);
+CREATE INDEX IF NOT EXISTS deals_sender ON deals (sender_id);
+CREATE INDEX IF NOT EXISTS deals_receiver ON deals (receiver_id);
+"""
+
+class Ledger:
+    """
+    Record of completed deals and per-user totals in a WAL-mode SQLite
+    database. Amounts are stored in litoshis and users are keyed by their
+    Discord id. Every query runs on one dedicated worker thread so the event
+    loop never waits on the disk and writes are naturally serialized.
+
+    Sharded processes share this database: it also holds the coordinator
+    lease, the addresses each process watches, the deposits the coordinator
+    sees on them and the queue of payouts it signs.
+    """
+    def __init__(self, path=LEDGER_FILE):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ledger")
+        self._conn = None
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def open(self):
+        await self._run(self._open)
+
+    def _open(self):
+        # Other sharded processes may hold the write lock for a moment
+        self._conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(LEDGER_SCHEMA)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(deals)")}
+        if "fee" not in columns:
+            self._conn.execute("ALTER TABLE deals ADD COLUMN fee INTEGER")
+        self._migrate_json()
+        self._undate_legacy()
+
+    def _migrate_json(self):
+        """One-time import of db/stats.json and db/users/*.json."""
+        if self._conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+            return
+        with self._conn:
+            if os.path.exists(STATS_FILE):
+                with open(STATS_FILE, "r") as f:
+                    stats = json.load(f)
+                # The old "dealN" keys keep their order as the new row ids
+                keys = sorted((k for k in stats if k.startswith("deal") and k[4:].isdigit()), key=lambda k: int(k[4:]))
+                # stats.json never recorded when deals completed
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO deals (deal_id, amount, completed_at) VALUES (?, ?, 0)",
+                    [(f"legacy-{key}", to_litoshis(stats[key])) for key in keys]
+                )
+            # Old user files are keyed by sanitized user name, which cannot be
+            # mapped back to a user id here, so they are kept apart until a
+            # member with that name is seen (claim_legacy_user)
+            for filename in os.listdir(USERS_DIR):
+                if not filename.endswith(".json"):
+                    continue
+                with open(os.path.join(USERS_DIR, filename), "r") as f:
+                    user_data = json.load(f)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO legacy_users VALUES (?, ?, ?, ?)",
+                    (filename[:-5], to_litoshis(user_data.get("Amount Sent", 0)),
+                     to_litoshis(user_data.get("Amount Received", 0)), user_data.get("Total Deals", 0))
+                )
+            self._conn.execute("INSERT INTO meta VALUES ('json_migrated', ?)", (str(int(time.time())),))
+            self._conn.execute("INSERT OR IGNORE INTO meta VALUES ('legacy_undated', '1')")
+
+    def _undate_legacy(self):
+        """Clear the completion time earlier migrations stamped legacy deals with (stats.json's mtime)."""
+        if self._conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_undated'").fetchone():
+            return
+        with self._conn:
+            self._conn.execute("UPDATE deals SET completed_at = 0 WHERE deal_id LIKE 'legacy-%' AND sender_id IS NULL")
+            self._conn.execute("INSERT INTO meta VALUES ('legacy_undated', '1')")
+
+    async def record_deal(self, deal_id, thread_id, sender_id, receiver_id, amount, txid=None, fee=None):
+        """
+        Record a completed deal and update both users' totals in one transaction.
+        `fee` is the part of the payout transaction fee paid by this deal.
+        Returns False if the deal was already recorded.
+        """
+        return await self._run(self._record_deal, deal_id, thread_id, sender_id, receiver_id, amount, txid, fee)
+
+    def _record_deal(self, deal_id, thread_id, sender_id, receiver_id, amount, txid, fee):
+        with self._conn:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO deals (deal_id, thread_id, sender_id, receiver_id, amount, fee, txid, completed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (deal_id, thread_id, sender_id, receiver_id, amount, fee, txid, int(time.time()))
+            )
+            if cursor.rowcount == 0:
+                return False
+            for user_id, sent, received in ((sender_id, amount, 0), (receiver_id, 0, amount)):
+                if user_id is None:
+                    continue
+                self._conn.execute(
+                    "INSERT INTO users (user_id, amount_sent, amount_received, total_deals) VALUES (?, ?, ?, 1) "
+                    "ON CONFLICT(user_id) DO UPDATE SET amount_sent = amount_sent + excluded.amount_sent, "
+                    "amount_received = amount_received + excluded.amount_received, total_deals = total_deals + 1",
+                    (user_id, sent, received)
+                )
+        return True
+
+    async def claim_legacy_user(self, name, user_id):
+        """
+        Merge the legacy totals kept under a sanitized user name into the
+        user's own, in one transaction. Returns the (amount_sent,
+        amount_received, total_deals) merged, or None if there was nothing
+        left to claim (e.g. another process claimed it first).
+        """
+        return await self._run(self._claim_legacy_user, name, user_id)
+
+    def _claim_legacy_user(self, name, user_id):
+        with self._conn:
+            row = self._conn.execute(
+                "SELECT amount_sent, amount_received, total_deals FROM legacy_users WHERE name = ?", (name,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("DELETE FROM legacy_users WHERE name = ?", (name,))
+            self._conn.execute(
+                "INSERT INTO users (user_id, amount_sent, amount_received, total_deals) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET amount_sent = amount_sent + excluded.amount_sent, "
+                "amount_received = amount_received + excluded.amount_received, "
+                "total_deals = total_deals + excluded.total_deals",
+                (user_id, *row)
+            )
+        return row
+
+    async def totals(self):
+        """Return (number of deals, total volume in litoshis)."""
+        return await self._run(self._totals)
+
+    def _totals(self):
+        count, volume = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM deals").fetchone()
+        return count, volume
+
+    async def rollup_source(self, hourly_since, daily_since):
+        """Return the aggregates needed to rebuild the in-memory stats rollups."""
+        return await self._run(self._rollup_source, hourly_since, daily_since)
+
+    def _rollup_source(self, hourly_since, daily_since):
+        # One read transaction, so the aggregates and last id match even while
+        # another process records deals
+        self._conn.execute("BEGIN")
+        try:
+            return (self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM deals").fetchone()[0],
+                    *self._rollup_aggregates(hourly_since, daily_since))
+        finally:
+            self._conn.execute("COMMIT")
+
+    def _rollup_aggregates(self, hourly_since, daily_since):
+        count, volume = self._totals()
+        users = self._conn.execute("SELECT user_id, amount_sent, amount_received, total_deals FROM users").fetchall()
+        legacy_users = self._conn.execute("SELECT name, amount_sent, amount_received, total_deals FROM legacy_users").fetchall()
+        hourly = self._conn.execute(
+            "SELECT completed_at / 3600 * 3600, COUNT(*), SUM(amount) FROM deals WHERE completed_at >= ? GROUP BY 1",
+            (hourly_since,)
+        ).fetchall()
+        daily = self._conn.execute(
+            "SELECT completed_at / 86400 * 86400, COUNT(*), SUM(amount) FROM deals WHERE completed_at >= ? GROUP BY 1",
+            (daily_since,)
+        ).fetchall()
+        return count, volume, users, legacy_users, hourly, daily
+
+    async def history(self, user_id=None, before_id=None, after_id=None, limit=10):
+        """
+        Return up to `limit` completed deals of a user, or of everyone, newest
+        first. Pages are keyed on the row id, never an offset: pass the oldest
+        id shown as `before_id` for the next page, or the newest as `after_id`
+        for the previous one. Rows are (id, deal_id, thread_id, sender_id,
+        receiver_id, amount, fee, txid, completed_at).
+        """
+        if after_id is not None:
+            rows = await self._run(self._deals_page, user_id, after_id, True, limit)
+            return rows[::-1]
+        return await self._run(self._deals_page, user_id, before_id, False, limit)
+
+    async def export_chunk(self, after_id, user_id=None, limit=1000):
+        """Return the next `limit` completed deals after `after_id`, oldest first, in history() rows."""
+        return await self._run(self._deals_page, user_id, after_id, True, limit)
+
+    def _deals_page(self, user_id, bound, ascending, limit):
+        columns = "id, deal_id, thread_id, sender_id, receiver_id, amount, fee, txid, completed_at"
+        if ascending:
+            where, order, bound = "id > ?", "ASC", bound or 0
+        else:
+            where, order, bound = "id < ?", "DESC", bound if bound is not None else 2 ** 63 - 1
+        if user_id is None:
+            return self._conn.execute(
+                f"SELECT {columns} FROM deals WHERE {where} ORDER BY id {order} LIMIT ?", (bound, limit)
+            ).fetchall()
+        # One range scan per index instead of an OR the planner would walk the whole table for
+        return self._conn.execute(
+            f"SELECT * FROM (SELECT {columns} FROM deals WHERE sender_id = ? AND {where} ORDER BY id {order} LIMIT ?) "
+            f"UNION SELECT * FROM (SELECT {columns} FROM deals WHERE receiver_id = ? AND {where} ORDER BY id {order} LIMIT ?) "
+            f"ORDER BY id {order} LIMIT ?",
+            (user_id, bound, limit, user_id, bound, limit, limit)
+        ).fetchall()
+
+    async def deals_after(self, last_id):
+        """Return (id, sender_id, receiver_id, amount, completed_at) of the deals recorded after `last_id`."""
+        return await self._run(self._deals_after, last_id)
+
+    def _deals_after(self, last_id):
+        return self._conn.execute(
+            "SELECT id, sender_id, receiver_id, amount, completed_at FROM deals WHERE id > ? ORDER BY id", (last_id,)
+        ).fetchall()
+
+    async def pool_available(self):
+        """Return the number of pooled addresses not bound to a deal yet."""
+        return await self._run(self._pool_available)
+
+    def _pool_available(self):
+        return self._conn.execute("SELECT COUNT(*) FROM address_pool WHERE deal_id IS NULL").fetchone()[0]
+
+    async def pool_add(self, keys, deal_id=None):
+        """Add (address, private_key) pairs to the address pool, already bound to `deal_id` if given."""
+        await self._run(self._pool_add, keys, deal_id)
+
+    def _pool_add(self, keys, deal_id):
+        now = int(time.time())
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO address_pool (address, private_key, deal_id, created_at) VALUES (?, ?, ?, ?)",
+                [(address, private_key, deal_id, now) for address, private_key in keys]
+            )
+
+    async def pool_claim(self, deal_id):
+        """
+        Bind a free pooled address to a deal and return
+        (address, private_key, newly_bound). A deal that already owns an
+        address gets the same one back. Returns None when the pool is empty.
+        """
+        return await self._run(self._pool_claim, deal_id)
+
+    def _pool_claim(self, deal_id):
+        with self._conn:
+            row = self._conn.execute(
+                "SELECT address, private_key FROM address_pool WHERE deal_id = ?", (deal_id,)
+            ).fetchone()
+            if row:
+                return (*row, False)
+            while True:
+                row = self._conn.execute(
+                    "SELECT address, private_key FROM address_pool WHERE deal_id IS NULL ORDER BY created_at LIMIT 1"
+                ).fetchone()
+                if row is None:
+                    return None
+                # Another process may have claimed the same row since the select
+                cursor = self._conn.execute(
+                    "UPDATE address_pool SET deal_id = ? WHERE address = ? AND deal_id IS NULL", (deal_id, row[0])
+                )
+                if cursor.rowcount:
+                    return (*row, True)
+
+    async def lease(self, name, owner, ttl):
+        """Take or renew a lease shared between processes. Returns whether `owner` holds it."""
+        return await self._run(self._lease, name, owner, ttl)
+
+    def _lease(self, name, owner, ttl):
+        now = time.time()
+        with self._conn:
+            self._conn.execute("INSERT OR IGNORE INTO leases VALUES (?, ?, 0)", (name, owner))
+            cursor = self._conn.execute(
+                "UPDATE leases SET owner = ?, expires_at = ? WHERE name = ? AND (owner = ? OR expires_at < ?)",
+                (owner, now + ttl, name, owner, now)
+            )
+        return cursor.rowcount == 1
+
+    async def lease_release(self, name, owner):
+        await self._run(self._lease_release, name, owner)
+
+    def _lease_release(self, name, owner):
+        with self._conn:
+            self._conn.execute("UPDATE leases SET expires_at = 0 WHERE name = ? AND owner = ?", (name, owner))
+
+    async def watch_sync(self, owner, addresses):
+        """Replace the addresses `owner` asks the coordinator to watch."""
+        await self._run(self._watch_sync, owner, addresses)
+
+    def _watch_sync(self, owner, addresses):
+        now = int(time.time())
+        with self._conn:
+            self._conn.execute("DELETE FROM watched WHERE owner = ?", (owner,))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO watched VALUES (?, ?, ?)", [(address, owner, now) for address in addresses]
+            )
+
+    async def watched_addresses(self, since):
+        """Return every address watched by a process that refreshed it after `since`."""
+        return await self._run(self._watched_addresses, since)
+
+    def _watched_addresses(self, since):
+        return [row[0] for row in self._conn.execute("SELECT address FROM watched WHERE updated_at >= ?", (since,))]
+
+    async def deposits_put(self, totals):
+        """Publish {address: (amount, confirmations)} seen by the coordinator."""
+        await self._run(self._deposits_put, totals)
+
+    def _deposits_put(self, totals):
+        now = int(time.time())
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO deposits VALUES (?, ?, ?, ?)",
+                [(address, amount, confirmations, now) for address, (amount, confirmations) in totals.items()]
+            )
+
+    async def deposits_get(self, addresses):
+        """Return {address: (amount, confirmations)} published for these addresses."""
+        return await self._run(self._deposits_get, addresses)
+
+    def _deposits_get(self, addresses):
+        found = {}
+        addresses = list(addresses)
+        for start in range(0, len(addresses), 500):
+            chunk = addresses[start:start + 500]
+            rows = self._conn.execute(
+                f"SELECT address, amount, confirmations FROM deposits WHERE address IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            found.update((address, (amount, confirmations)) for address, amount, confirmations in rows)
+        return found
+
+    async def payout_request(self, deal_id, address, script):
+        """
+        Queue a payout for the coordinator. A deal has at most one payout: a
+        new request only replaces one that failed.
+        """
+        await self._run(self._payout_request, deal_id, address, script)
+
+    def _payout_request(self, deal_id, address, script):
+        with self._conn:
+            self._conn.execute(
+                "INSERT INTO payouts (deal_id, address, script, status, updated_at) VALUES (?, ?, ?, 'pending', ?) "
+                "ON CONFLICT(deal_id) DO UPDATE SET script = excluded.script, status = 'pending', error = NULL, "
+                "updated_at = excluded.updated_at WHERE status = 'failed'",
+                (deal_id, address, script, int(time.time()))
+            )
+
+    async def payout_status(self, deal_id):
+        """Return (status, txid, amount, fee, error) of a deal's payout, or None."""
+        return await self._run(self._payout_status, deal_id)
+
+    def _payout_status(self, deal_id):
+        return self._conn.execute(
+            "SELECT status, txid, amount, fee, error FROM payouts WHERE deal_id = ?", (deal_id,)
+        ).fetchone()
+
+    async def payouts_claim(self, owner):
+        """Mark every pending payout as being signed by `owner` and return (deal_id, address, script)."""
+        return await self._run(self._payouts_claim, owner)
+
+    def _payouts_claim(self, owner):
+        with self._conn:
+            rows = self._conn.execute("SELECT deal_id, address, script FROM payouts WHERE status = 'pending'").fetchall()
+            claimed = []
+            for row in rows:
+                cursor = self._conn.execute(
+                    "UPDATE payouts SET status = 'signing', owner = ?, updated_at = ? WHERE deal_id = ? AND status = 'pending'",
+                    (owner, int(time.time()), row[0])
+                )
+                if cursor.rowcount:
+                    claimed.append(row)
+        return claimed
+
+    async def payout_finish(self, deal_id, txid=None, amount=None, fee=None, error=None):
+        await self._run(self._payout_finish, deal_id, txid, amount, fee, error)
+
+    def _payout_finish(self, deal_id, txid, amount, fee, error):
+        with self._conn:
+            self._conn.execute(
+                "UPDATE payouts SET status = ?, txid = ?, amount = ?, fee = ?, error = ?, updated_at = ? WHERE deal_id = ?",
+                ("failed" if error else "done", txid, amount, fee, error, int(time.time()), deal_id)
+            )
+
+    async def payouts_interrupted(self, error):
+        """Fail the payouts a previous coordinator was signing when it stopped."""
+        await self._run(self._payouts_interrupted, error)
+
+    def _payouts_interrupted(self, error):
+        with self._conn:
+            self._conn.execute(
+                "UPDATE payouts SET status = 'failed', error = ?, updated_at = ? WHERE status = 'signing'",
+                (error, int(time.time()))
+            )
+
+ledger = Ledger()
+
+# ----------------- Address pool -----------------
+class AddressPool:
+    """
+    Deposit addresses generated ahead of time, so accepting a deal does not
+    wait on the node. The pool is persisted in the ledger database and
+    refilled in the background in batches whenever it drops below the low
+    watermark. Each address is bound to exactly one deal when taken.
+    """
+    def __init__(self, ledger, low=ADDRESS_POOL_LOW, high=ADDRESS_POOL_HIGH, batch=ADDRESS_POOL_BATCH):
+        self.ledger = ledger
+        self.low = low
+        self.high = high
+        self.batch = batch
+        self.available = 0
+        self._refill_task = None
+
+    async def start(self):
+        self.available = await self.ledger.pool_available()
+        self._maybe_refill()
+
+    def _maybe_refill(self):
+        if not coordinator.is_leader:
+            return  # The coordinator refills the pool shared by every process
+        if self.available < self.low and (self._refill_task is None or self._refill_task.done()):
+            self._refill_task = asyncio.create_task(self._refill())
+
+    async def _generate(self, count, deal_id=None):
+        """Create `count` new addresses with two batched RPC requests, for the pool or bound to a deal."""
+        addresses = await rpc.batch([("getnewaddress",)] * count)
+        private_keys = await rpc.batch([("dumpprivkey", address) for address in addresses])
+        keys = list(zip(addresses, private_keys))
+        await self.ledger.pool_add(keys, deal_id)
+        if deal_id is None:
+            self.available += len(keys)
+        return keys
+
+    async def _refill(self):
+        try:
+            # Other sharded processes take addresses from the same pool
+            self.available = await self.ledger.pool_available()
+            while self.available < self.high:
+                await self._generate(min(self.batch, self.high - self.available))
+        except RPCError as e:
+            print(f"Error refilling address pool: {e}")
+
+    async def take(self, deal_id):
+        """Return the (address, private_key) bound to a deal, taking one from the pool."""
+        claim = await self.ledger.pool_claim(deal_id)
+        if claim is None:
+            # The pool ran dry, generate an address inline. It is inserted
+            # already bound to the deal, so another sharded process emptying
+            # the pool meanwhile cannot take it.
+            self._maybe_refill()
+            [(address, private_key)] = await self._generate(1, deal_id)
+            return address, private_key
+        address, private_key, newly_bound = claim
+        if newly_bound:
+            self.available = max(self.available - 1, 0)
+        self._maybe_refill()
+        return address, private_key
+
+address_pool = AddressPool(ledger)
+
+# ----------------- Transactions -----------------
+BASE58_ALPHABET = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+BECH32_CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+BECH32M_CONST = 0x2bc830a3
+
+# Address prefixes per network: bech32 human readable part and base58 version bytes
+NETWORKS = {
+    "main": {"hrp": "ltc", "p2pkh": (0x30,), "p2sh": (0x32, 0x05)},
+    "test": {"hrp": "tltc", "p2pkh": (0x6f,), "p2sh": (0x3a, 0xc4)},
+    "regtest": {"hrp": "rltc", "p2pkh": (0x6f,), "p2sh": (0x3a, 0xc4)},
+}
+
+# Virtual size of a signed input spending each script type. Escrow addresses
+# come from the node wallet, so P2SH outputs are P2SH-wrapped P2WPKH.
+INPUT_VBYTES = {"p2pkh": 148, "p2sh": 91, "p2wpkh": 68, "p2tr": 58}
+SEGWIT_INPUTS = {"p2sh", "p2wpkh", "p2tr"}
+DUST_LIMIT = 5460  # Litoshis, smallest payout output we are willing to create
+
+class AddressError(ValueError):
+    """The destination is not a valid address for the configured network."""
+
+def _bech32_polymod(values):
+    generator = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
+    checksum = 1
+    for value in values:
+        top = checksum >> 25
+        checksum = (checksum & 0x1ffffff) << 5 ^ value
+        for i in range(5):
+            checksum ^= generator[i] if (top >> i) & 1 else 0
+    return checksum
+
+def _convert_bits(data, from_bits, to_bits):
+    """Regroup 5-bit bech32 data into bytes, rejecting non-zero padding."""
+    acc = bits = 0
+    result = []
+    for value in data:
+        acc = (acc << from_bits) | value
+        bits += from_bits
+        while bits >= to_bits:
+            bits -= to_bits
+            result.append((acc >> bits) & ((1 << to_bits) - 1))
+    if bits >= from_bits or (acc << (to_bits - bits)) & ((1 << to_bits) - 1):
+        raise AddressError("Invalid bech32 padding")
+    return bytes(result)
+
+def _decode_segwit(hrp, address):
+    """Return (witness version, program) for a bech32/bech32m address."""
+    if address.lower() != address and address.upper() != address:
+        raise AddressError("Mixed case bech32 address")
+    address = address.lower()
+    pos = address.rfind("1")
+    if address[:pos] != hrp or len(address) - pos < 7:
+        raise AddressError("Wrong network or malformed address")
+    try:
+        data = [BECH32_CHARSET.index(c) for c in address[pos + 1:]]
+    except ValueError:
+        raise AddressError("Invalid bech32 character")
+    checksum = _bech32_polymod([ord(c) >> 5 for c in hrp] + [0] + [ord(c) & 31 for c in hrp] + data)
+    version = data[0]
+    if checksum != (1 if version == 0 else BECH32M_CONST):
+        raise AddressError("Invalid bech32 checksum")
+    program = _convert_bits(data[1:-6], 5, 8)
+    if version > 16 or not 2 <= len(program) <= 40 or (version == 0 and len(program) not in (20, 32)):
+        raise AddressError("Invalid witness program")
+    return version, program
+
+def _decode_base58check(address):
+    number = 0
+    for c in address:
+        if c not in BASE58_ALPHABET:
+            raise AddressError("Invalid base58 character")
+        number = number * 58 + BASE58_ALPHABET.index(c)
+    raw = number.to_bytes((number.bit_length() + 7) // 8, "big")
+    raw = b"\x00" * (len(address) - len(address.lstrip("1"))) + raw
+    payload, checksum = raw[:-4], raw[-4:]
+    if hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] != checksum:
+        raise AddressError("Invalid base58 checksum")
+    return payload
+
+def address_to_script(address, network=LTC_NETWORK):
+    """Return the scriptPubKey paying to a Litecoin address."""
+    params = NETWORKS[network]
+    if address.lower().startswith(params["hrp"] + "1"):
+        version, program = _decode_segwit(params["hrp"], address)
+        return bytes([version + 0x50 if version else 0, len(program)]) + program
+    payload = _decode_base58check(address)
+    if len(payload) != 21:
+        raise AddressError("Invalid address length")
+    if payload[0] in params["p2pkh"]:
+        return b"\x76\xa9\x14" + payload[1:] + b"\x88\xac"
+    if payload[0] in params["p2sh"]:
+        return b"\xa9\x14" + payload[1:] + b"\x87"
+    raise AddressError("Wrong network or unsupported address type")
+
+def script_type(script_hex):
+    """Classify a scriptPubKey as returned by listunspent."""
+    if len(script_hex) == 50 and script_hex.startswith("76a914") and script_hex.endswith("88ac"):
+        return "p2pkh"
+    if len(script_hex) == 46 and script_hex.startswith("a914") and script_hex.endswith("87"):
+        return "p2sh"
+    if len(script_hex) == 44 and script_hex.startswith("0014"):
+        return "p2wpkh"
+    if len(script_hex) == 68 and script_hex.startswith("5120"):
+        return "p2tr"
+    raise ValueError(f"Unsupported escrow script {script_hex}")
+
+def _varint(n):
+    if n < 0xfd:
+        return bytes([n])
+    if n <= 0xffff:
+        return b"\xfd" + struct.pack("<H", n)
+    return b"\xfe" + struct.pack("<I", n)
+
+def estimate_vsize(input_types, output_scripts):
+    """Virtual size of the signed transaction, from input and output script types."""
+    vsize = 4 + 4 + len(_varint(len(input_types))) + len(_varint(len(output_scripts)))
+    if any(kind in SEGWIT_INPUTS for kind in input_types):
+        vsize += 0.5  # Segwit marker and flag bytes
+    vsize += sum(INPUT_VBYTES[kind] for kind in input_types)
+    vsize += sum(8 + len(_varint(len(script))) + len(script) for script in output_scripts)
+    return math.ceil(vsize)
+
+def fee_for(vsize, fee_rate=FEE_RATE):
+    """Fee in litoshis for a transaction of `vsize` at `fee_rate` LTC/kvB."""
+    return math.ceil(vsize * fee_rate * COIN / 1000)
+
+def serialize_transaction(inputs, outputs):
+    """
+    Serialize an unsigned transaction. `inputs` are (txid, vout) pairs and
+    `outputs` are (scriptPubKey bytes, litoshis) pairs.
+    """
+    raw = struct.pack("<i", 2) + _varint(len(inputs))
+    for txid, vout in inputs:
+        raw += bytes.fromhex(txid)[::-1] + struct.pack("<I", vout) + b"\x00" + b"\xff\xff\xff\xff"
+    raw += _varint(len(outputs))
+    for script, value in outputs:
+        raw += struct.pack("<q", value) + _varint(len(script)) + script
+    raw += struct.pack("<I", 0)
+    return raw.hex()
+
+def build_payouts(payouts, fee_rate=FEE_RATE):
+    """
+    Build one unsigned transaction for several payouts. Each payout is a
+    (utxos, recipient script) pair: all of its escrow outputs go to its
+    recipient, less its own share of the fee. A payout pays for the size of
+    its inputs and output plus an even share of the transaction overhead, so
+    the amount every deal sends is exact however the batch is made up.
+    Returns (raw hex, [(amount sent, fee)] in payout order), in litoshis.
+    """
+    all_types = [[script_type(utxo["scriptPubKey"]) for utxo in utxos] for utxos, _ in payouts]
+    scripts = [script for _, script in payouts]
+    own_sizes = [
+        sum(INPUT_VBYTES[kind] for kind in types) + 8 + len(_varint(len(script))) + len(script)
+        for types, script in zip(all_types, scripts)
+    ]
+    total_size = estimate_vsize([kind for types in all_types for kind in types], scripts)
+    overhead = (total_size - sum(own_sizes)) / len(payouts)
+    inputs = []
+    outputs = []
+    results = []
+    for (utxos, script), own_size in zip(payouts, own_sizes):
+        fee = fee_for(own_size + overhead, fee_rate)
+        amount = sum(to_litoshis(utxo["amount"]) for utxo in utxos) - fee
+        if amount < DUST_LIMIT:
+            raise ValueError("Escrow balance is too small to cover the network fee")
+        inputs.extend((utxo["txid"], utxo["vout"]) for utxo in utxos)
+        outputs.append((script, amount))
+        results.append((amount, fee))
+    return serialize_transaction(inputs, outputs), results
+
+def build_sweep(utxos, recipient_script, fee_rate=FEE_RATE):
+    """
+    Build the unsigned transaction sending every escrow output to the recipient,
+    less the fee. Returns (raw hex, amount sent, fee), amounts in litoshis.
+    """
+    raw_hex, [(amount, fee)] = build_payouts([(utxos, recipient_script)], fee_rate)
+    return raw_hex, amount, fee
+
+async def sign_and_send(raw_hex):
+    """Sign a transaction with the node wallet and broadcast it, returning the txid."""
+    signed = await rpc.call("signrawtransactionwithwallet", raw_hex)
+    if not signed.get("complete"):
+        errors = "; ".join(error.get("error", "") for error in signed.get("errors", []))
+        raise RPCResponseError(None, f"Incomplete signature: {errors}", "signrawtransactionwithwallet")
+    return await rpc.call("sendrawtransaction", signed["hex"])
+
+# ----------------- Fee estimation -----------------
+class FeeEstimator:
+    """
+    Keeps estimatesmartfee results for a few confirmation targets, refreshed
+    in the background with one batched request, so payouts read the current
+    fee rate without an extra RPC. Falls back to FEE_RATE when the node has
+    no estimate (e.g. right after startup or on a quiet chain).
+    """
+    def __init__(self, targets=FEE_TARGETS, interval=FEE_REFRESH_INTERVAL, ttl=FEE_ESTIMATE_TTL):
+        self.targets = targets
+        self.interval = interval
+        self.ttl = ttl
+        self.rates = {}  # target -> (LTC/kvB, time fetched)
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def refresh(self):
+        results = await rpc.batch([("estimatesmartfee", target) for target in self.targets], return_exceptions=True)
+        now = time.monotonic()
+        for target, result in zip(self.targets, results):
+            if isinstance(result, dict) and result.get("feerate"):
+                self.rates[target] = (float(result["feerate"]), now)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+            except RPCError as e:
+                print(f"Error refreshing fee estimates: {e}")
+            await asyncio.sleep(self.interval)
+
+    def fee_rate(self, target=FEE_TARGET):
+        """Return the cached fee rate in LTC/kvB for a confirmation target."""
+        now = time.monotonic()
+        fresh = {t: rate for t, (rate, fetched) in self.rates.items() if now - fetched < self.ttl}
+        if not fresh:
+            return FEE_RATE
+        # Use the closest target at or above the requested one, else the slowest known
+        candidates = [t for t in fresh if t >= target]
+        rate = fresh[min(candidates)] if candidates else fresh[max(fresh)]
+        return min(rate, FEE_RATE_MAX)
+
+fee_estimator = FeeEstimator()
+
+# ----------------- Payout batching -----------------
+class PayoutBatcher:
+    """
+    Queues confirmed releases and pays them out together in one transaction
+    with many inputs and outputs, broadcast every PAYOUT_BATCH_INTERVAL
+    seconds or as soon as PAYOUT_BATCH_SIZE releases are waiting. Every
+    release gets the shared txid back along with its own amount and fee.
+    """
+    def __init__(self, interval=PAYOUT_BATCH_INTERVAL, max_size=PAYOUT_BATCH_SIZE):
+        self.interval = interval
+        self.max_size = max_size
+        self.queue = []  # [(utxos, recipient script, future)]
+        self._full = asyncio.Event()
+        self._task = None
+
+    def submit(self, utxos, recipient_script):
+        """
+        Queue a payout. Returns a future resolved with (txid, amount sent, fee)
+        once the batch containing it is broadcast.
+        """
+        try:
+            # Reject payouts that could never be built before they join a batch
+            build_sweep(utxos, recipient_script, fee_estimator.fee_rate())
+        except ValueError as e:
+            future = asyncio.get_running_loop().create_future()
+            future.set_exception(e)
+            return future
+        future = asyncio.get_running_loop().create_future()
+        self.queue.append((utxos, recipient_script, future))
+        if len(self.queue) >= self.max_size:
+            self._full.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return future
+
+    async def _run(self):
+        while self.queue:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.flush()
+
+    async def flush(self):
+        """Broadcast everything queued so far as one transaction."""
+        batch, self.queue = self.queue[:self.max_size], self.queue[self.max_size:]
+        batch = [entry for entry in batch if not entry[2].done()]
+        if not batch:
+            return
+        try:
+            raw_hex, results = build_payouts([(utxos, script) for utxos, script, _ in batch], fee_estimator.fee_rate())
+            txid = await sign_and_send(raw_hex)
+        except (RPCError, ValueError) as e:
+            print(f"Error broadcasting payout batch: {e}")
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, _, future), (amount, fee) in zip(batch, results):
+            if not future.done():
+                future.set_result((txid, amount, fee))
+
+payout_batcher = PayoutBatcher()
+
+class PayoutError(Exception):
+    """A payout could not be made; the message is shown in the deal thread."""
+
+class UTXOIndex:
+    """
+    Unspent outputs of the escrow addresses, kept from the deposit watcher's
+    listunspent polls so payouts pick their inputs without asking the node.
+    A payout reserves the outputs it spends for its deal: reserve() does not
+    yield between selecting and marking them, so two concurrent payouts can
+    never pick the same output. Reservations are released when the payout
+    fails, and dropped along with the outputs once it is broadcast.
+    """
+    def __init__(self):
+        self.outputs = {}  # address -> {(txid, vout): utxo as returned by listunspent}
+        self.reserved = {}  # (txid, vout) -> deal_id
+
+    def update(self, addresses, unspent):
+        """Replace what is known of `addresses` with a listunspent result covering all of them."""
+        fresh = {address: {} for address in addresses}
+        for utxo in unspent:
+            fresh.setdefault(utxo["address"], {})[(utxo["txid"], utxo["vout"])] = utxo
+        self.outputs.update(fresh)
+
+    async def reserve(self, deal_id, address, confirmations=1):
+        """
+        Reserve, for the deal, every output at `address` with at least
+        `confirmations` that no other payout holds, and return them. The node
+        is only asked about addresses not polled yet, e.g. after a restart, or
+        with outputs last seen less confirmed than needed.
+        """
+        known = self.outputs.get(address)
+        if known is None or any(utxo.get("confirmations", 0) < confirmations for utxo in known.values()):
+            self.update([address], await rpc.call("listunspent", 0, 9999999, [address]))
+        selected = []
+        for outpoint, utxo in self.outputs.get(address, {}).items():
+            if utxo.get("confirmations", 0) < confirmations:
+                continue
+            owner = self.reserved.get(outpoint)
+            if owner == deal_id:
+                raise PayoutError("A payout for this deal is already in progress.")
+            if owner is None:
+                selected.append(utxo)
+        for utxo in selected:
+            self.reserved[(utxo["txid"], utxo["vout"])] = deal_id
+        return selected
+
+    def release(self, deal_id, utxos, spent=False):
+        """Drop the deal's reservation of `utxos`, and the outputs too if they were spent."""
+        for utxo in utxos:
+            outpoint = (utxo["txid"], utxo["vout"])
+            if self.reserved.get(outpoint) == deal_id:
+                del self.reserved[outpoint]
+            if spent:
+                outputs = self.outputs.get(utxo["address"])
+                if outputs is not None:
+                    outputs.pop(outpoint, None)
+                    if not outputs:
+                        del self.outputs[utxo["address"]]
+
+    def forget(self, address):
+        """Stop tracking an address whose deal is over."""
+        self.outputs.pop(address, None)
+
+utxo_index = UTXOIndex()
+
+async def execute_payout(deal_id, address, recipient_script):
+    """
+    Send every confirmed output sitting at an escrow address to the recipient,
+    alone or in the next batch. Returns (txid, amount sent, fee) in litoshis.
+    """
+    try:
+        utxos = await utxo_index.reserve(deal_id, address)
+    except RPCError as e:
+        print(f"Error retrieving unspent outputs: {e}")
+        raise PayoutError("Error retrieving unspent outputs.")
+    if not utxos:
+        print(f"Error retrieving unspent outputs: no confirmed outputs for {address}")
+        raise PayoutError("Error retrieving unspent outputs.")
+    spent = False
+    try:
+        result = await _spend(utxos, recipient_script)
+        spent = True
+        return result
+    finally:
+        utxo_index.release(deal_id, utxos, spent=spent)
+
+async def _spend(unspent_data, recipient_script):
+    if PAYOUT_BATCHING:
+        # Join the next payout batch, which is signed and broadcast as one transaction
+        try:
+            return await payout_batcher.submit(unspent_data, recipient_script)
+        except ValueError as e:
+            raise PayoutError(f"Error creating transaction: {e}.")
+        except RPCError:
+            raise PayoutError("Error signing or broadcasting transaction.")
+
+    # Build the final transaction in one pass, the fee comes from its estimated size
+    try:
+        raw_hex, amount, fee = build_sweep(unspent_data, recipient_script, fee_estimator.fee_rate())
+    except ValueError as e:
+        print(f"Error creating transaction: {e}")
+        raise PayoutError(f"Error creating transaction: {e}.")
+
+    # Sign with the wallet and broadcast the transaction
+    try:
+        txid = await sign_and_send(raw_hex)
+    except RPCError as e:
+        print(f"Error signing or broadcasting transaction: {e}")
+        raise PayoutError("Error signing or broadcasting transaction.")
+    return txid, amount, fee
+
+# ----------------- Stats rollups -----------------
+class StatsRollup:
+    """
+    Running aggregates of completed deals: all-time totals, hourly and daily
+    buckets, per-user totals and a top-N volume leaderboard. Built from the
+    ledger once at startup and updated as deals complete, so the stats
+    commands answer from memory without touching the disk or the API.
+    Updates come from the ledger rows recorded since the last one seen, so
+    deals completed by other sharded processes are counted too.
+    """
+    def __init__(self, hours=ROLLUP_HOURS, days=ROLLUP_DAYS, leaderboard_size=LEADERBOARD_SIZE):
+        self.hours = hours
+        self.days = days
+        self.leaderboard_size = leaderboard_size
+        self.count = 0
+        self.volume = 0
+        self.hourly = {}  # hour start (epoch seconds) -> [deals, volume]
+        self.daily = {}  # day start (epoch seconds) -> [deals, volume]
+        self.users = {}  # user_id -> [amount_sent, amount_received, total_deals]
+        self.legacy_users = {}  # sanitized name -> [amount_sent, amount_received, total_deals]
+        self.claiming = set()  # Legacy names whose claim was already attempted
+        self.leaderboard = []  # [(volume, user_id)], largest first
+        self.last_id = 0  # Ledger id of the last deal accounted for
+
+    async def load(self, ledger):
+        now = int(time.time())
+        self.last_id, count, volume, users, legacy_users, hourly, daily = await ledger.rollup_source(
+            now - self.hours * 3600, now - self.days * 86400
+        )
+        self.count, self.volume = count, volume
+        self.users = {user_id: [sent, received, deals] for user_id, sent, received, deals in users}
+        self.legacy_users = {name: [sent, received, deals] for name, sent, received, deals in legacy_users}
+        self.hourly = {start: [deals, amount] for start, deals, amount in hourly}
+        self.daily = {start: [deals, amount] for start, deals, amount in daily}
+        self.leaderboard = sorted(((sent + received, user_id) for user_id, (sent, received, _) in self.users.items()), reverse=True)[:self.leaderboard_size]
+
+    async def catch_up(self, ledger):
+        """Account for the deals recorded in the ledger since the last call."""
+        for row_id, sender_id, receiver_id, amount, completed_at in await ledger.deals_after(self.last_id):
+            if row_id > self.last_id:
+                self.last_id = row_id
+                self.add(sender_id, receiver_id, amount, completed_at)
+
+    def add(self, sender_id, receiver_id, amount, completed_at=None):
+        """
+        Account for one completed deal (amount in litoshis). Undated legacy
+        deals (completed_at 0) count towards the totals but no bucket.
+        """
+        completed_at = int(time.time() if completed_at is None else completed_at)
+        self.count += 1
+        self.volume += amount
+        windows = ((self.hourly, 3600, self.hours), (self.daily, 86400, self.days)) if completed_at else ()
+        for buckets, size, keep in windows:
+            bucket = buckets.setdefault(completed_at // size * size, [0, 0])
+            bucket[0] += 1
+            bucket[1] += amount
+            # Buckets only ever get added at the front, drop the oldest one
+            if len(buckets) > keep:
+                del buckets[min(buckets)]
+        for user_id, sent, received in ((sender_id, amount, 0), (receiver_id, 0, amount)):
+            if user_id is None:
+                continue
+            totals = self.users.setdefault(user_id, [0, 0, 0])
+            totals[0] += sent
+            totals[1] += received
+            totals[2] += 1
+            self._rank(user_id, totals[0] + totals[1])
+
+    def _rank(self, user_id, volume):
+        """Move a user to their place on the bounded leaderboard."""
+        board = [entry for entry in self.leaderboard if entry[1] != user_id]
+        if len(board) < self.leaderboard_size or volume > board[-1][0]:
+            board.append((volume, user_id))
+            board.sort(reverse=True)
+        self.leaderboard = board[:self.leaderboard_size]
+
+    def window(self, seconds):
+        """Return (deals, volume) completed in the last `seconds`."""
+        now = int(time.time())
+        if seconds <= self.hours * 3600:
+            buckets, size = self.hourly, 3600
+        else:
+            buckets, size = self.daily, 86400
+        since = (now - seconds) // size * size + size
+        count = volume = 0
+        for start in range(since, now + 1, size):
+            bucket = buckets.get(start)
+            if bucket:
+                count += bucket[0]
+                volume += bucket[1]
+        return count, volume
+
+    def claim_legacy(self, ledger, name, user_id):
+        """Fold the legacy totals of `name` into `user_id` once a member with that name is seen."""
+        if name not in self.legacy_users or name in self.claiming:
+            return
+        self.claiming.add(name)
+        spawn(self._claim_legacy(ledger, name, user_id))
+
+    async def _claim_legacy(self, ledger, name, user_id):
+        try:
+            claimed = await ledger.claim_legacy_user(name, user_id)
+        except sqlite3.Error as e:
+            print(f"Error claiming the legacy stats of {name} for {user_id}: {e}")
+            self.claiming.discard(name)  # Tried again next time the member is seen
+            return
+        if claimed is None:
+            return  # Claimed by another process: still matched by name here until a restart
+        self.legacy_users.pop(name, None)
+        totals = self.users.setdefault(user_id, [0, 0, 0])
+        for i, value in enumerate(claimed):
+            totals[i] += value
+        self._rank(user_id, totals[0] + totals[1])
+
+    def user(self, user_id, legacy_name=None):
+        """Return (amount sent, amount received, deals) for a user, or None."""
+        rows = [self.users.get(user_id), self.legacy_users.get(legacy_name)]
+        rows = [row for row in rows if row]
+        if not rows:
+            return None
+        return tuple(sum(column) for column in zip(*rows))
+
+stats_rollup = StatsRollup()
+
+async def record_completed_deal(deal, txid, fee=None):
+    """Write a released deal to the ledger and the in-memory rollups."""
+    amount = to_litoshis(deal.amount or 0)
+    await ledger.record_deal(deal.deal_id, deal.thread_id, deal.sender, deal.receiver, amount, txid, fee)
+    await stats_rollup.catch_up(ledger)
+
+# ----------------- Litecoin RPC -----------------
+class RPCError(Exception):
+    """Base class for every failure talking to litecoind."""
+    def __init__(self, message, method=None):
+        super().__init__(f"{method}: {message}" if method else message)
+        self.method = method
+
+class RPCConnectionError(RPCError):
+    """The node could not be reached or rejected our credentials."""
+
+class RPCTimeoutError(RPCError):
+    """The node did not answer within the call's timeout."""
+
+class RPCResponseError(RPCError):
+    """The node answered with a JSON-RPC error object."""
+    def __init__(self, code, message, method=None):
+        super().__init__(f"{message} (code {code})", method)
+        self.code = code
+        self.rpc_message = message
+
+class LitecoinRPC:
+    """
+    Asynchronous JSON-RPC client for litecoind.
+    Requests share a bounded pool of keep-alive HTTP connections, so node
+    calls never block the event loop and never fork a process.
+    """
+    def __init__(self, url, user="", password="", cookie_file=None, pool_size=RPC_POOL_SIZE, timeout=RPC_TIMEOUT):
+        self.url = url
+        self.user = user
+        self.password = password
+        self.cookie_file = cookie_file
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._session = None
+        self._ids = itertools.count(1)
+        self.in_flight = 0  # HTTP requests sent and not answered yet
+
+    def _auth(self):
+        """Return the basic auth credentials, falling back to the cookie file."""
+        if self.user or not self.cookie_file:
+            return aiohttp.BasicAuth(self.user, self.password)
+        try:
+            with open(self.cookie_file, "r") as f:
+                user, _, password = f.read().strip().partition(":")
+        except OSError as e:
+            raise RPCConnectionError(f"Cannot read RPC cookie file: {e}")
+        return aiohttp.BasicAuth(user, password)
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, auth=self._auth())
+        return self._session
+
+    def _request(self, method, params):
+        return {"jsonrpc": "1.0", "id": next(self._ids), "method": method, "params": list(params)}
+
+    async def _post(self, payload, timeout, method):
+        """Send one HTTP request and return the decoded JSON body."""
+        session = self._get_session()
+        self.in_flight += 1
+        try:
+            async with session.post(
+                self.url,
+                json=payload,
+                timeout=aiohttp.ClientTimeout(total=timeout or self.timeout)
+            ) as response:
+                if response.status in (401, 403):
+                    # The cookie is regenerated on every node restart
+                    await self.close()
+                    raise RPCConnectionError("Authentication rejected by node", method)
+                try:
+                    # litecoind reports call errors with HTTP 500 and a JSON body
+                    return await response.json(content_type=None)
+                except ValueError:
+                    raise RPCConnectionError(f"Unexpected HTTP {response.status} from node", method)
+        except asyncio.TimeoutError:
+            raise RPCTimeoutError(f"No answer within {timeout or self.timeout}s", method)
+        except aiohttp.ClientError as e:
+            raise RPCConnectionError(str(e), method)
+        finally:
+            self.in_flight -= 1
+
+    @staticmethod
+    def _result(reply, method):
+        error = reply.get("error")
+        if error:
+            return RPCResponseError(error.get("code"), error.get("message"), method)
+        return reply.get("result")
+
+    async def call(self, method, *params, timeout=None):
+        """Call a single RPC method and return its result."""
+        with metrics.span("rpc", method):
+            reply = await self._post(self._request(method, params), timeout, method)
+        result = self._result(reply, method)
+        if isinstance(result, RPCError):
+            raise result
+        return result
+
+    async def batch(self, calls, timeout=None, return_exceptions=False):
+        """
+        Send several calls in one JSON-RPC batch request.
+        `calls` is a list of (method, *params) tuples; results come back in the
+        same order. With return_exceptions=True failed entries are returned as
+        RPCResponseError instances instead of raising the first one.
+        """
+        if not calls:
+            return []
+        requests = [self._request(method, params) for method, *params in calls]
+        with metrics.span("rpc", "batch:" + ",".join(sorted({request["method"] for request in requests}))):
+            replies = await self._post(requests, timeout, "batch")
+        if not isinstance(replies, list):
+            raise RPCResponseError(None, "Batch request rejected by node", "batch")
+        by_id = {reply.get("id"): reply for reply in replies}
+        results = []
+        for request in requests:
+            reply = by_id.get(request["id"])
+            if reply is None:
+                result = RPCResponseError(None, "Missing reply in batch", request["method"])
+            else:
+                result = self._result(reply, request["method"])
+            if isinstance(result, RPCError) and not return_exceptions:
+                raise result
+            results.append(result)
+        return results
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+# Calls that change or reveal the wallet: only the wallet node runs them
+WALLET_METHODS = {
+    "getnewaddress", "dumpprivkey", "importprivkey", "signrawtransactionwithwallet",
+    "sendrawtransaction", "sendtoaddress", "sendmany", "walletpassphrase"
+}
+# Read-only wallet queries, which watch-only replicas can answer as well
+WALLET_READ_METHODS = {"listunspent", "getbalance", "getreceivedbyaddress", "gettransaction", "listtransactions"}
+
+class RPCNode:
+    __slots__ = ("client", "wallet", "healthy", "blocks")
+
+    def __init__(self, client, wallet=None):
+        self.client = client
+        self.wallet = wallet  # "primary", "replica" or None
+        self.healthy = True  # Until the first health check says otherwise
+        self.blocks = None
+
+class RPCPool:
+    """
+    Spreads node calls over several litecoind backends.
+    Wallet calls go to the wallet node only, wallet queries to the wallet node
+    and its watch-only replicas, and every other read to any node. Among the
+    eligible nodes the one with the fewest requests in flight is picked.
+    A periodic getblockchaininfo on every node takes out of rotation the ones
+    that do not answer, are still syncing, or trail the best tip by more than
+    RPC_MAX_LAG blocks. Reads failing on a connection error are retried once
+    on another node. Same call/batch interface as LitecoinRPC.
+    """
+    def __init__(self, primary, nodes=(), interval=RPC_HEALTH_INTERVAL, max_lag=RPC_MAX_LAG):
+        self.nodes = [RPCNode(primary, "primary")]
+        for node in nodes:
+            client = LitecoinRPC(node["url"], node.get("user", ""), node.get("password", ""), cookie_file=node.get("cookie_file"))
+            self.nodes.append(RPCNode(client, node.get("wallet")))
+        self.primary = self.nodes[0]
+        self.interval = interval
+        self.max_lag = max_lag
+        self._turn = itertools.count()
+        self._task = None
+
+    @property
+    def in_flight(self):
+        return sum(node.client.in_flight for node in self.nodes)
+
+    async def start(self):
+        if len(self.nodes) == 1:
+            return  # Nothing to balance
+        await self.check()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.check()
+
+    async def check(self):
+        """Refresh the tip height and health of every node."""
+        replies = await asyncio.gather(
+            *(node.client.call("getblockchaininfo", timeout=5) for node in self.nodes),
+            return_exceptions=True
+        )
+        tips = [reply["blocks"] for reply in replies if isinstance(reply, dict)]
+        best = max(tips, default=None)
+        for node, reply in zip(self.nodes, replies):
+            if isinstance(reply, Exception):
+                if node.healthy:
+                    print(f"RPC node {node.client.url} out of rotation: {reply}")
+                node.healthy = False
+                continue
+            node.blocks = reply["blocks"]
+            healthy = not reply.get("initialblockdownload") and best - node.blocks <= self.max_lag
+            if healthy != node.healthy:
+                state = "back in rotation" if healthy else f"out of rotation at height {node.blocks} (best {best})"
+                print(f"RPC node {node.client.url} {state}")
+            node.healthy = healthy
+
+    def _candidates(self, methods):
+        if methods & WALLET_METHODS:
+            return [self.primary]
+        if methods & WALLET_READ_METHODS:
+            nodes = [node for node in self.nodes if node.wallet and node.healthy]
+        else:
+            nodes = [node for node in self.nodes if node.healthy]
+        return nodes or [self.primary]
+
+    def _pick(self, candidates, exclude=None):
+        nodes = [node for node in candidates if node is not exclude] or candidates
+        start = next(self._turn)
+        # Least requests in flight, ties broken round-robin
+        return min(
+            (nodes[(start + i) % len(nodes)] for i in range(len(nodes))),
+            key=lambda node: node.client.in_flight
+        )
+
+    async def _send(self, methods, send):
+        candidates = self._candidates(methods)
+        node = self._pick(candidates)
+        try:
+            return await send(node.client)
+        except (RPCConnectionError, RPCTimeoutError):
+            if len(candidates) == 1 or methods & WALLET_METHODS:
+                raise
+            node.healthy = False  # Until the next health check
+            return await send(self._pick(candidates, exclude=node).client)
+
+    async def call(self, method, *params, timeout=None):
+        return await self._send({method}, lambda client: client.call(method, *params, timeout=timeout))
+
+    async def batch(self, calls, timeout=None, return_exceptions=False):
+        methods = {call[0] for call in calls}
+        return await self._send(methods, lambda client: client.batch(calls, timeout, return_exceptions))
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        for node in self.nodes:
+            await node.client.close()
+
+rpc = RPCPool(LitecoinRPC(RPC_URL, RPC_USER, RPC_PASSWORD, cookie_file=RPC_COOKIE_FILE), RPC_NODES)
+
+# ----------------- Deposit watcher -----------------
+class DepositWatcher:
+    """
+    Single background service watching every active deposit address.
+    Each tick asks the node for the unspent outputs of all watched addresses in
+    one listunspent call, so the RPC load stays flat however many deals are open,
+    and hands the outputs to the UTXOIndex that payouts spend from.
+    Only the waiters of addresses whose balance or confirmations changed are
+    re-evaluated. Ticks run right away when the ChainNotifier reports a new
+    block or wallet transaction; the fixed interval is only a fallback.
+
+    When sharded, each process publishes its addresses to the shared ledger
+    database; only the coordinator polls the node, for all of them, and
+    publishes the deposits it sees, which the other processes read back.
+    """
+    def __init__(self, interval=WATCH_INTERVAL, fallback_interval=WATCH_FALLBACK_INTERVAL):
+        self.interval = interval
+        self.fallback_interval = fallback_interval
+        self.notified_at = None  # time.monotonic() of the last block/tx notification received
+        self.waiters = {}  # address -> list of (min_confirmations, future)
+        self.seen = {}  # address -> (amount, confirmations) from the last tick
+        self._published = (frozenset(), 0)  # Addresses last written to the watched table, and when
+        self.last_tick = None  # time.monotonic() of the last completed tick
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def notify(self):
+        """Re-check every pending deal now, e.g. after a new block."""
+        self._wakeup.set()
+
+    @property
+    def notifications(self):
+        """True while notifications are flowing, so polling can slow down."""
+        return self.notified_at is not None and time.monotonic() - self.notified_at < NOTIFY_SILENCE_TIMEOUT
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def wait_for(self, address, confirmations=0):
+        """
+        Return a future resolved with the amount received on the address once
+        every output paying it has at least `confirmations` confirmations.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(address, []).append((confirmations, future))
+        # A deposit seen on an earlier tick can satisfy the waiter right away
+        if address in self.seen:
+            self._wake(address, *self.seen[address])
+        self.start()
+        return future
+
+    def retarget(self, address):
+        """Resolve everything waiting on the address with None, so it re-reads what its deal requires."""
+        for _, future in self.waiters.pop(address, []):
+            if not future.done():
+                future.set_result(None)
+
+    def unwatch(self, address):
+        """Stop watching an address and cancel anything still waiting on it."""
+        for _, future in self.waiters.pop(address, []):
+            future.cancel()
+        self.seen.pop(address, None)
+
+    def _wake(self, address, amount, confirmations):
+        pending = []
+        for min_confirmations, future in self.waiters.get(address, []):
+            if future.done():
+                continue
+            if amount > 0 and confirmations >= min_confirmations:
+                future.set_result(amount)
+            else:
+                pending.append((min_confirmations, future))
+        if pending:
+            self.waiters[address] = pending
+        else:
+            self.waiters.pop(address, None)
+            self.seen.pop(address, None)
+
+    async def tick(self):
+        """Poll the node once for every watched address."""
+        addresses = list(self.waiters)
+        if coordinator.sharded:
+            with metrics.span("watcher_tick", "shared"):
+                totals = await self._shared_tick(addresses)
+        elif addresses:
+            with metrics.span("watcher_tick", "node"):
+                totals = await self._poll(addresses)
+        else:
+            return
+        self.last_tick = time.monotonic()
+        for address, (amount, confirmations) in totals.items():
+            if address not in self.waiters or self.seen.get(address) == (amount, confirmations):
+                continue
+            self.seen[address] = (amount, confirmations)
+            self._wake(address, amount, confirmations)
+
+    async def balances(self, addresses):
+        """Ask the node once for the balance of any addresses, watched or not."""
+        return await self._poll(addresses)
+
+    async def _poll(self, addresses):
+        """Return {address: (amount, confirmations of its least confirmed output)} from the node."""
+        unspent = await rpc.call("listunspent", 0, 9999999, addresses)
+        utxo_index.update(addresses, unspent)
+        totals = {}
+        for utxo in unspent:
+            amount, confirmations = totals.get(utxo["address"], (0.0, None))
+            utxo_confirmations = utxo.get("confirmations", 0)
+            if confirmations is None or utxo_confirmations < confirmations:
+                confirmations = utxo_confirmations
+            totals[utxo["address"]] = (amount + float(utxo["amount"]), confirmations)
+        return totals
+
+    async def _shared_tick(self, addresses):
+        published, published_at = self._published
+        now = time.time()
+        if published != set(addresses) or now - published_at > WATCH_SHARED_TTL / 3:
+            await ledger.watch_sync(coordinator.name, addresses)
+            self._published = (frozenset(addresses), now)
+        if coordinator.is_leader:
+            watched = await ledger.watched_addresses(int(now) - WATCH_SHARED_TTL)
+            if not watched:
+                return {}
+            totals = await self._poll(watched)
+            await ledger.deposits_put(totals)
+            return totals
+        return await ledger.deposits_get(addresses) if addresses else {}
+
+    async def _run(self):
+        while self.waiters or coordinator.sharded and coordinator.is_leader:
+            self._wakeup.clear()
+            try:
+                await self.tick()
+            except (RPCError, sqlite3.Error) as e:
+                print(f"Deposit watcher error: {e}")
+            if coordinator.sharded and not coordinator.is_leader:
+                interval = coordinator.interval  # Only reads the shared database
+            else:
+                interval = self.fallback_interval if self.notifications else self.interval
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+
+deposit_watcher = DepositWatcher()
+
+class ChainNotifier:
+    """
+    Feeds new-block and wallet-transaction notifications from the node into
+    the deposit watcher, either from ZMQ (hashblock/rawtx) or from a local
+    unix socket written to by blocknotify/walletnotify. The watcher only
+    slows its polling down once a notification has actually arrived: a ZMQ
+    connect succeeds even with a wrong endpoint, and a listening socket
+    says nothing about whether litecoind writes to it.
+    """
+    def __init__(self, watcher, zmq_endpoints=NOTIFY_ZMQ, socket_path=NOTIFY_SOCKET):
+        self.watcher = watcher
+        self.zmq_endpoints = zmq_endpoints
+        self.socket_path = socket_path
+        self.heard = {}  # source -> time.monotonic() of its last notification
+        self._tasks = []
+
+    def received(self, source):
+        """Record a notification from `source` and wake the watcher."""
+        now = time.monotonic()
+        if source not in self.heard:
+            print(f"Receiving node notifications from {source}")
+        self.heard[source] = now
+        self.watcher.notified_at = now
+        self.watcher.notify()
+
+    async def start(self):
+        if self.zmq_endpoints:
+            if zmq is None:
+                print("NOTIFY_ZMQ is set but pyzmq is not installed, falling back to polling.")
+            else:
+                self._tasks.append(asyncio.create_task(self._zmq_loop()))
+        if self.socket_path:
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            server = await asyncio.start_unix_server(self._handle_socket, path=self.socket_path)
+            self._tasks.append(asyncio.create_task(server.serve_forever()))
+
+    async def _zmq_loop(self):
+        context = zmq.asyncio.Context.instance()
+        while True:
+            sock = context.socket(zmq.SUB)
+            try:
+                for endpoint in self.zmq_endpoints:
+                    sock.connect(endpoint)
+                sock.setsockopt(zmq.SUBSCRIBE, b"hashblock")
+                sock.setsockopt(zmq.SUBSCRIBE, b"rawtx")
+                while True:
+                    topic, *_ = await sock.recv_multipart()
+                    if topic in (b"hashblock", b"rawtx"):
+                        self.received("zmq")
+            except zmq.ZMQError as e:
+                print(f"ZMQ notification error: {e}")
+            finally:
+                sock.close(linger=0)
+            await asyncio.sleep(WATCH_INTERVAL)
+
+    async def _handle_socket(self, reader, writer):
+        try:
+            async for line in reader:
+                kind = line.decode(errors="replace").split(" ", 1)[0].strip()
+                if kind in ("block", "wallet"):
+                    self.received("socket")
+        finally:
+            writer.close()
+
+chain_notifier = ChainNotifier(deposit_watcher)
+
+
+# ----------------- Coordinator -----------------
+class Coordinator:
+    """
+    Picks the one process that does the node-facing work when the bot runs
+    as several sharded processes: watching deposits and signing payouts.
+    It holds a lease in the shared ledger database, renewed three times per
+    COORDINATOR_LEASE_TTL; when it stops, another process takes over once the
+    lease runs out. Every process queues its payouts in the payouts table,
+    which has one row per deal, so no deal is ever paid out twice.
+    A single process (SHARD_IDS unset) is always the coordinator and pays out
+    directly.
+    """
+    LEASE = "coordinator"
+
+    def __init__(self, ledger, name=PROCESS_NAME, sharded=bool(SHARD_IDS),
+                 ttl=COORDINATOR_LEASE_TTL, interval=COORDINATOR_POLL_INTERVAL,
+                 payout_timeout=COORDINATOR_PAYOUT_TIMEOUT):
+        self.ledger = ledger
+        self.name = name
+        self.sharded = sharded
+        self.ttl = ttl
+        self.interval = interval
+        self.payout_timeout = payout_timeout
+        self.leader = not sharded
+        self.lease_until = 0  # time.monotonic() at which our lease may have run out
+        self.signing = set()  # Ids of the deals this process is paying out
+        self._task = None
+
+    @property
+    def is_leader(self):
+        return not self.sharded or (self.leader and time.monotonic() < self.lease_until)
 
-# Global dictionary for storing pending role selections per thread
-# Structure: {thread_id: {user_id: {"role": None, "confirmed": False}}}
-pending_roles = {}
+    async def start(self):
+        if not self.sharded:
+            return
+        await self._renew()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
 
-# Create directories if they do not exist
-os.makedirs(LOGS_DIR, exist_ok=True)
-os.makedirs(USERS_DIR, exist_ok=True)
-os.makedirs(DB_DIR, exist_ok=True)
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.sharded and self.leader:
+            self.leader = False
+            await self.ledger.lease_release(self.LEASE, self.name)
 
+    async def _renew(self):
+        started = time.monotonic()
+        was_leader = self.is_leader
+        try:
+            held = await self.ledger.lease(self.LEASE, self.name, self.ttl)
+        except sqlite3.Error as e:
+            print(f"Error renewing the coordinator lease: {e}")
+            return
+        self.leader = held
+        if held:
+            self.lease_until = started + self.ttl
+        if held and not was_leader:
+            print(f"{self.name} is now the coordinator")
+            if not self.signing:
+                await self.ledger.payouts_interrupted(
+                    "Payout interrupted by a coordinator change, check the wallet before retrying."
+                )
+            deposit_watcher.start()
+        elif was_leader and not held:
+            print(f"{self.name} is no longer the coordinator")
 
-def generate_id(length=32):
-    """Generate a random alphanumeric ID."""
-    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=length))
+    async def _run(self):
+        renew_at = time.monotonic() + self.ttl / 3
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                if time.monotonic() >= renew_at:
+                    await self._renew()
+                    renew_at = time.monotonic() + self.ttl / 3
+                if self.is_leader:
+                    for deal_id, address, script in await self.ledger.payouts_claim(self.name):
+                        self.signing.add(deal_id)
+                        spawn(self._sign(deal_id, address, script))
+                # Count the deals released by the other processes
+                await stats_rollup.catch_up(self.ledger)
+            except sqlite3.Error as e:
+                print(f"Coordinator error: {e}")
 
-def sanitize_filename(name):
-    """Sanitize a string to be safely used as a filename."""
-    return re.sub(r'[^\w\.-]', '_', name)
+    async def _sign(self, deal_id, address, script):
+        try:
+            try:
+                txid, amount, fee = await execute_payout(deal_id, address, bytes.fromhex(script))
+            except PayoutError as e:
+                await self._finish(deal_id, error=str(e))
+            except Exception as e:
+                print(f"Error paying out deal {deal_id}: {e}")
+                await self._finish(deal_id, error=f"❌ Error: {e}")
+            else:
+                await self._finish(deal_id, txid, amount, fee)
+        finally:
+            self.signing.discard(deal_id)
 
-def update_stats(amount):
-    """Update the global statistics with a new transaction amount."""
-    stats = {}
-    if os.path.exists(STATS_FILE):
-        with open(STATS_FILE, 'r') as f:
-            stats = json.load(f)
-    max_deal_num = max([int(k[4:]) for k in stats.keys() if k.startswith('deal')] or [0])
-    new_key = f"deal{max_deal_num + 1}"
-    stats[new_key] = amount
-    with open(STATS_FILE, 'w') as f:
-        json.dump(stats, f, indent=4)
-
-def update_user_stats(bot, user_id, amount_sent=0, amount_received=0):
-    """Update individual user statistics."""
-    user = bot.get_user(user_id)
-    if not user:
-        return
-    username = sanitize_filename(user.name)
-    user_file = os.path.join(USERS_DIR, f"{username}.json")
-    if os.path.exists(user_file):
-        with open(user_file, 'r') as f:
-            user_data = json.load(f)
+    async def _finish(self, deal_id, txid=None, amount=None, fee=None, error=None):
+        """
+        Record how a payout ended, retrying until the database takes it: a
+        broadcast payout left marked as signing would be failed by the next
+        coordinator and could be paid out twice. The deal stays in `signing`
+        meanwhile, so this process does not fail it itself.
+        """
+        while True:
+            try:
+                await self.ledger.payout_finish(deal_id, txid, amount, fee, error)
+                return
+            except sqlite3.Error as e:
+                print(f"Error recording the payout of deal {deal_id} (txid {txid}), retrying: {e}")
+                await asyncio.sleep(self.interval)
+
+    async def payout(self, deal, address, recipient_script):
+        """
+        Pay out a confirmed deal, here or through the coordinator.
+        Returns (txid, amount sent, fee) or raises PayoutError.
+        """
+        if not self.sharded:
+            return await execute_payout(deal.deal_id, address, recipient_script)
+        await self.ledger.payout_request(deal.deal_id, address, recipient_script.hex())
+        deadline = time.monotonic() + self.payout_timeout
+        while True:
+            status, txid, amount, fee, error = await self.ledger.payout_status(deal.deal_id)
+            if status == "done":
+                return txid, amount, fee
+            if status == "failed":
+                raise PayoutError(error)
+            if time.monotonic() >= deadline:
+                # The request stays queued: releasing again picks up its outcome
+                raise PayoutError("⌛ The payout is still waiting for the coordinator, try releasing again later.")
+            await asyncio.sleep(self.interval)
+
+coordinator = Coordinator(ledger)
+
+# ----------------- Message router -----------------
+class PromptCancelled(Exception):
+    """Raised in a handler whose prompt was cancelled or superseded."""
+
+class MessageRouter:
+    """
+    Routes incoming messages to the one prompt waiting in their thread.
+    bot.wait_for runs every pending check against every message the bot sees,
+    so the cost grew with the number of open tickets; here each message costs
+    a single lookup by channel id.
+    """
+    def __init__(self):
+        self.waiters = {}  # channel_id -> (check, future)
+
+    async def wait_for(self, channel_id, check, timeout):
+        """
+        Wait for the next message in a channel accepted by `check`.
+        Raises asyncio.TimeoutError after `timeout` seconds and PromptCancelled
+        if the prompt is cancelled or replaced by a newer one.
+        """
+        self.cancel(channel_id)
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[channel_id] = (check, future)
+        try:
+            return await asyncio.wait_for(future, timeout=timeout)
+        finally:
+            if self.waiters.get(channel_id, (None, None))[1] is future:
+                del self.waiters[channel_id]
+
+    def cancel(self, channel_id):
+        """Cancel the prompt waiting in a channel, if any."""
+        waiter = self.waiters.pop(channel_id, None)
+        if waiter and not waiter[1].done():
+            waiter[1].set_exception(PromptCancelled())
+
+    def dispatch(self, message):
+        waiter = self.waiters.get(message.channel.id)
+        if waiter is None:
+            return
+        check, future = waiter
+        if not future.done() and check(message):
+            future.set_result(message)
+
+message_router = MessageRouter()
+
+# ----------------- Members -----------------
+class MemberResolver:
+    """
+    Guild members looked up by id through the API, as the bot runs without
+    the members intent and keeps no member list. Results, including "not a
+    member", are kept in an LRU cache of MEMBER_CACHE_SIZE entries for
+    MEMBER_CACHE_TTL (MEMBER_MISS_TTL for misses), and concurrent lookups of
+    the same member share a single request.
+    """
+    def __init__(self, size=MEMBER_CACHE_SIZE, ttl=MEMBER_CACHE_TTL, miss_ttl=MEMBER_MISS_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self.cache = collections.OrderedDict()  # (guild_id, user_id) -> (expires_at, member or None)
+        self.pending = {}  # (guild_id, user_id) -> future of the request in flight
+
+    def _store(self, key, member):
+        self.cache[key] = (time.monotonic() + (self.ttl if member is not None else self.miss_ttl), member)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+
+    def remember(self, member):
+        """Cache a member received from Discord anyway, e.g. the author of an interaction."""
+        self._store((member.guild.id, member.id), member)
+        stats_rollup.claim_legacy(ledger, sanitize_filename(member.name), member.id)
+
+    def cached(self, guild_id, user_id):
+        """Return the member if it is cached and fresh, without asking Discord."""
+        entry = self.cache.get((guild_id, user_id))
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1]
+
+    async def get(self, guild, user_id):
+        """
+        Return the member of `guild` with this id, or None if there is none.
+        Raises discord.HTTPException if Discord could not be asked.
+        """
+        key = (guild.id, user_id)
+        entry = self.cache.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self.cache.move_to_end(key)
+                return entry[1]
+            del self.cache[key]
+        future = self.pending.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(key, guild, user_id))
+            self.pending[key] = future
+            future.add_done_callback(lambda _: self.pending.pop(key, None))
+        # Shielded so one caller giving up does not cancel the others' request
+        return await asyncio.shield(future)
+
+    async def _fetch(self, key, guild, user_id):
+        try:
+            member = await guild.fetch_member(user_id)
+        except discord.NotFound:
+            member = None
+        self._store(key, member)
+        if member is not None:
+            stats_rollup.claim_legacy(ledger, sanitize_filename(member.name), member.id)
+        return member
+
+members = MemberResolver()
+
+# ----------------- Outbound messages -----------------
+class RateBudget:
+    """Token bucket allowing `requests` calls every `per` seconds."""
+    def __init__(self, requests, per):
+        self.capacity = requests
+        self.rate = requests / per
+        self.tokens = float(requests)
+        self.updated = time.monotonic()
+
+    def delay(self):
+        """Seconds until a call is allowed, 0 if one is allowed now."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class OutboundOp:
+    __slots__ = ("route", "channel", "content", "embeds", "view", "merge", "message_ids", "fields", "future")
+
+    def __init__(self, route, channel, content=None, embeds=(), view=None, merge=False, message_ids=(), fields=None):
+        self.route = route
+        self.channel = channel
+        self.content = content
+        self.embeds = list(embeds)
+        self.view = view
+        self.merge = merge
+        self.message_ids = list(message_ids)
+        self.fields = fields or {}
+        self.future = asyncio.get_running_loop().create_future()
+        self.future.add_done_callback(_consume_exception)
+
+def _consume_exception(future):
+    # Callers may fire and forget; failures are already printed by the outbox
+    if not future.cancelled():
+        future.exception()
+
+class Outbox:
+    """
+    Paces and coalesces the bot's messages in deal threads.
+
+    Operations queue per channel and run in order. Consecutive messages to the
+    same channel that are still queued go out as one message (contents joined,
+    embeds collected, at most one view, which closes the message). Each route
+    has a per-channel budget (OUTBOX_ROUTE_LIMITS) and all routes share a
+    global one; channels are served round-robin so a busy thread cannot starve
+    the others. Callers get a future for the sent message, whose id can be
+    kept to edit or bulk-delete it later instead of scanning history.
+    """
+    def __init__(self, route_limits=OUTBOX_ROUTE_LIMITS, global_rate=OUTBOX_GLOBAL_RATE):
+        self.route_limits = route_limits
+        self.global_budget = RateBudget(global_rate, 1.0)
+        self.budgets = {}  # (route, channel_id) -> RateBudget
+        self.queues = {}  # channel_id -> deque of OutboundOp
+        self.ready = collections.deque()  # channel ids to serve, in turn
+        self.scheduled = set()  # channel ids that are ready, waiting on a budget or in flight
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def send(self, channel, content=None, *, embed=None, view=None, merge=True):
+        """Queue a message. Returns a future for the discord.Message it ends up in."""
+        embeds = [embed] if embed is not None else []
+        return self._enqueue(OutboundOp("send", channel, content, embeds, view, merge))
+
+    def edit(self, channel, message_id, **fields):
+        """Queue an edit of one of the bot's messages (content, embeds, view...)."""
+        return self._enqueue(OutboundOp("edit", channel, message_ids=[message_id], fields=fields))
+
+    def delete(self, channel, message_ids):
+        """Queue the deletion of the bot's messages, in bulk when there are several."""
+        return self._enqueue(OutboundOp("delete", channel, message_ids=message_ids))
+
+    def pending(self):
+        """Number of operations queued and not sent yet."""
+        return sum(len(queue) for queue in self.queues.values())
+
+    def discard(self, channel_id):
+        """Drop what is still queued for a channel, e.g. a deleted thread."""
+        for op in self.queues.pop(channel_id, ()):
+            op.future.cancel()
+
+    def _enqueue(self, op):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        channel_id = op.channel.id
+        self.queues.setdefault(channel_id, collections.deque()).append(op)
+        if channel_id not in self.scheduled:
+            self.scheduled.add(channel_id)
+            self._make_ready(channel_id)
+        return op.future
+
+    def _make_ready(self, channel_id):
+        self.ready.append(channel_id)
+        self._wakeup.set()
+
+    def _budget(self, route, channel_id):
+        budget = self.budgets.get((route, channel_id))
+        if budget is None:
+            budget = self.budgets[(route, channel_id)] = RateBudget(*self.route_limits[route])
+        return budget
+
+    def _take_batch(self, queue):
+        """Pop the next operation, merged with the queued messages that can join it."""
+        ops = [queue.popleft()]
+        first = ops[0]
+        if first.route != "send" or not first.merge or first.view is not None:
+            return ops
+        length = len(first.content or "")
+        embeds = len(first.embeds)
+        while queue:
+            op = queue[0]
+            added = len(op.content or "") + 2 if op.content else 0
+            if (op.route != "send" or not op.merge or length + added > 2000
+                    or embeds + len(op.embeds) > 10):
+                break
+            ops.append(queue.popleft())
+            length += added
+            embeds += len(op.embeds)
+            if op.view is not None:
+                break
+        return ops
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            while not self.ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            channel_id = self.ready.popleft()
+            queue = self.queues.get(channel_id)
+            if not queue:
+                self.scheduled.discard(channel_id)
+                self.queues.pop(channel_id, None)
+                continue
+            budget = self._budget(queue[0].route, channel_id)
+            delay = budget.delay()
+            if delay > 0:
+                loop.call_later(delay, self._make_ready, channel_id)
+                continue
+            delay = self.global_budget.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                self.global_budget.delay()
+            budget.take()
+            self.global_budget.take()
+            # One operation in flight per channel keeps the thread in order,
+            # and lets more messages queue up to be merged meanwhile.
+            spawn(self._execute(channel_id, self._take_batch(queue)))
+
+    async def _execute(self, channel_id, ops):
+        first = ops[0]
+        try:
+            if first.route == "send":
+                contents = [op.content for op in ops if op.content]
+                result = await first.channel.send(
+                    content="\n\n".join(contents) if contents else None,
+                    embeds=[embed for op in ops for embed in op.embeds] or discord.utils.MISSING,
+                    view=next((op.view for op in ops if op.view is not None), discord.utils.MISSING)
+                )
+            elif first.route == "edit":
+                result = await first.channel.get_partial_message(first.message_ids[0]).edit(**first.fields)
+            elif len(first.message_ids) > 1:
+                result = await bot.http.delete_messages(channel_id, first.message_ids)
+            elif first.message_ids:
+                result = await bot.http.delete_message(channel_id, first.message_ids[0])
+            else:
+                result = None
+        except Exception as e:
+            # Whatever failed, every merged caller hears about it rather than waiting forever
+            print(f"Error in outbound {first.route} to channel {channel_id}: {e!r}")
+            for op in ops:
+                if not op.future.done():
+                    op.future.set_exception(e)
+        else:
+            for op in ops:
+                if not op.future.done():
+                    op.future.set_result(result)
+        finally:
+            if self.queues.get(channel_id):
+                self._make_ready(channel_id)
+            else:
+                self.queues.pop(channel_id, None)
+                self.scheduled.discard(channel_id)
+
+outbox = Outbox()
+
+@bot.listen("on_message")
+async def route_message(message):
+    deal = deal_store.by_thread(message.channel.id)
+    if deal is not None:
+        deal_store.log_message(deal, message)
+    if message.author != bot.user:
+        message_router.dispatch(message)
+
+def restore_deals():
+    """
+    Re-attach the buttons and deposit watchers of open deals after a restart,
+    from the deal store alone, without reading any Discord history.
+    """
+    for deal in deal_store.deals.values():
+        if deal.thread_id is None:
+            continue
+        thread = bot.get_partial_messageable(deal.thread_id)
+        if deal.state == "accepted" and deal.roles and deal.role_message_id:
+            deal.role_view = RoleSelectionView(deal.thread_id)
+            bot.add_view(deal.role_view, message_id=deal.role_message_id)
+        elif deal.state == "roles_confirmed" and not deal.address:
+            asyncio.create_task(send_deposit_address(deal, thread))
+        elif (deal.state == "roles_confirmed" and deal.watching) or deal.state == "funded":
+            asyncio.create_task(watch_deposit(deal, thread))
+        elif deal.state in ("cancelled", "expired") and deal.address:
+            spawn(watch_abandoned(deal))
+
+# ----------------- Deal sweeper -----------------
+class DealSweeper:
+    """
+    Background task expiring deals abandoned before funding and archiving
+    finished deals once their state's DEAL_TTL has passed.
+    """
+    def __init__(self, interval=DEAL_SWEEP_INTERVAL):
+        self.interval = interval
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.sweep()
+
+    async def sweep(self):
+        expired = deal_store.pop_expired(time.time())
+        # Deals holding an address may have been paid without anyone saying
+        # so: ask the node about all of them at once before letting them go
+        unpaid = [deal for deal in expired if deal.address and deal.state != "released"]
+        balances = {}
+        if unpaid:
+            try:
+                balances = await deposit_watcher.balances([deal.address for deal in unpaid])
+            except RPCError as e:
+                print(f"Error checking expiring deals for deposits: {e}")
+                for deal in unpaid:
+                    deal_store.requeue(deal)  # Checked again on the next sweep
+                expired = [deal for deal in expired if deal not in unpaid]
+        for deal in expired:
+            amount, _ = balances.get(deal.address, (0, 0))
+            if amount > 0:
+                recover_deposit(deal, amount)
+                continue
+            if deal.state in TERMINAL_STATES:
+                if deal.address:
+                    deposit_watcher.unwatch(deal.address)
+                    utxo_index.forget(deal.address)
+                deal_store.archive_deal(deal)
+                continue
+            end_deal(deal, "expired")
+            try:
+                await bot.http.delete_channel(deal.thread_id, reason="Escrow deal expired")
+            except discord.HTTPException as e:
+                print(f"Error deleting expired thread {deal.thread_id}: {e}")
+
+deal_sweeper = DealSweeper()
+
+def end_deal(deal, state):
+    """
+    Cancel or expire a deal that was not funded, and free what it holds:
+    its prompt, deposit watch and role view. Deals that never got an address
+    are archived right away; the others stay live (with their private key)
+    and watched for their state's DEAL_TTL in case funds still arrive, then
+    the sweeper checks the address one last time and archives them.
+    """
+    deal_store.transition(deal, state)
+    message_router.cancel(deal.thread_id)
+    outbox.discard(deal.thread_id)
+    if deal.role_view is not None:
+        deal.role_view.stop()
+        deal.role_view = None
+    if deal.address:
+        deposit_watcher.unwatch(deal.address)  # Ends the deal's watch_deposit
+        spawn(watch_abandoned(deal))
     else:
-        user_data = {
-            "Amount Received": 0,
-            "Amount Sent": 0,
-            "Total Volume": 0,
-            "Total Deals": 0
-        }
-    user_data["Amount Sent"] += amount_sent
-    user_data["Amount Received"] += amount_received
-    user_data["Total Volume"] = user_data["Amount Sent"] + user_data["Amount Received"]
-    if amount_sent or amount_received:
-        user_data["Total Deals"] += 1
-    with open(user_file, 'w') as f:
-        json.dump(user_data, f, indent=4)
+        deal_store.archive_deal(deal)
 
+async def watch_abandoned(deal):
+    """Wait for a deposit on the address of a cancelled or expired deal, until it is archived."""
+    balance = None
+    while balance is None:  # None: woken by retarget(), wait again
+        balance = await deposit_watcher.wait_for(deal.address, confirmations=0)
+    if deal.state in ("cancelled", "expired") and deal_store.get(deal.deal_id) is deal:
+        recover_deposit(deal, balance)
+
+def recover_deposit(deal, amount):
+    """
+    Move a deal whose address was paid back to funded, whichever state it was
+    left in: roles_confirmed without the sender saying so, or cancelled and
+    expired after its thread was deleted.
+    """
+    previous = deal.state
+    required = deal.confirmations_required or confirmations_for(amount)
+    deal_store.transition(deal, "funded", amount=amount, confirmations_required=required)
+    if previous == "roles_confirmed":
+        thread = bot.get_partial_messageable(deal.thread_id)
+        outbox.send(thread, "💸 Funds received!")
+        spawn(watch_deposit(deal, thread))
+    else:
+        # Its thread is gone: the funds stay at the address, with the key in the deal store
+        print(f"Deposit of {amount} LTC received by {previous} deal {deal.deal_id} at {deal.address}, "
+              f"moved back to funded for a manual release")
 
+@bot.event
+async def setup_hook():
+    watchdog.start()
+    metrics.instrument_http(bot.http)
+    await metrics.start()
+    await deal_store.load()
+    await ledger.open()
+    await stats_rollup.load(ledger)
+    await coordinator.start()
+    await rpc.start()
+    await address_pool.start()
+    fee_estimator.start()
+    await chain_notifier.start()
+    restore_deals()
+    deal_sweeper.start()
 
 @bot.event
 async def on_ready():
     print(f"Bot connected as {bot.user}")
 
-@bot.event
-async def on_interaction(interaction):
+# ----------------- Interaction dispatcher -----------------
+class InteractionRoute:
+    __slots__ = ("handler", "ephemeral", "semaphore", "max_waiting", "waiting", "debounce", "single_flight", "needs")
+
+    def __init__(self, handler, ephemeral, concurrency, max_waiting, debounce, single_flight, needs):
+        self.handler = handler
+        self.ephemeral = ephemeral
+        self.semaphore = asyncio.Semaphore(concurrency) if concurrency else None
+        self.max_waiting = max_waiting
+        self.waiting = 0
+        self.debounce = debounce
+        self.single_flight = single_flight
+        self.needs = needs
+
+class InteractionDispatcher:
     """
-    Handle interactions based on the component's custom_id.
-    (Role selection buttons are handled by the view callbacks.)
+    Routes component interactions to handlers registered by custom_id prefix.
+    A custom_id is "<prefix>" or "<prefix>:<argument>", e.g. "release_funds:<deal id>";
+    the handler receives the argument, or None for buttons sent without one.
+
+    Each route can cap how many of its handlers run at once (concurrency) and
+    how many may wait for a slot (max_waiting) before clicks are refused, ignore
+    a user's repeated clicks on the same button for `debounce` seconds, run at
+    most once at a time per deal (single_flight), and be refused while the node
+    or the outbox is saturated (needs "node" and/or "discord").
+    Buttons without a route, such as the role selection view, are left to
+    their view callbacks.
     """
+    def __init__(self):
+        self.routes = {}
+        self.recent = {}  # (prefix, user_id, key) -> time of the last accepted click
+        self.running = set()  # (prefix, key) of single-flight handlers in progress
+
+    def route(self, prefix, *, ephemeral=False, concurrency=None, max_waiting=0, debounce=2.0,
+              single_flight=False, needs=()):
+        def register(handler):
+            self.routes[prefix] = InteractionRoute(
+                handler, ephemeral, concurrency, max_waiting, debounce, single_flight, needs
+            )
+            return handler
+        return register
+
+    def saturated(self, needs):
+        """Return why new work of this kind is refused right now, or None."""
+        if "node" in needs and rpc.in_flight >= ADMISSION_MAX_RPC:
+            return "The Litecoin node is busy"
+        if "discord" in needs and outbox.pending() >= ADMISSION_MAX_OUTBOX:
+            return "Discord is rate limiting the bot"
+        return None
+
+    def _debounced(self, key, debounce):
+        return time.monotonic() - self.recent.get(key, -debounce) < debounce
+
+    def _arm(self, key):
+        now = time.monotonic()
+        if len(self.recent) > 10000:
+            self.recent = {k: t for k, t in self.recent.items() if now - t < 60}
+        self.recent[key] = now
+
+    async def dispatch(self, interaction):
+        prefix, _, argument = interaction.data.get("custom_id", "").partition(":")
+        route = self.routes.get(prefix)
+        if route is None:
+            return
+        argument = argument or None
+        key = argument or interaction.channel_id
+        recent = (prefix, interaction.user.id, key)
+        if route.debounce and self._debounced(recent, route.debounce):
+            await interaction.response.defer()
+            return
+        flight = (prefix, key)
+        if route.single_flight and flight in self.running:
+            await interaction.response.send_message("This is already in progress.", ephemeral=True)
+            return
+        reason = self.saturated(route.needs)
+        if reason is None and route.semaphore is not None and route.semaphore.locked() and route.waiting >= route.max_waiting:
+            reason = "Too many requests are in progress"
+        if reason:
+            await interaction.response.send_message(f"{reason}, please try again in a moment.", ephemeral=True)
+            return
+
+        # Only accepted clicks debounce, so a refused one can be retried right away.
+        # Both marks are taken before the first await, or a concurrent click
+        # could pass the checks above in the meantime.
+        if route.debounce:
+            self._arm(recent)
+        if route.single_flight:
+            self.running.add(flight)
+        try:
+            # Acknowledge first: queued clicks may wait longer than Discord's 3 seconds
+            await interaction.response.defer(ephemeral=route.ephemeral)
+            if route.semaphore is None:
+                with metrics.span("handler", route.handler.__name__):
+                    await route.handler(interaction, argument)
+                return
+            route.waiting += 1
+            try:
+                await route.semaphore.acquire()
+            finally:
+                route.waiting -= 1
+            try:
+                with metrics.span("handler", route.handler.__name__):
+                    await route.handler(interaction, argument)
+            finally:
+                route.semaphore.release()
+        finally:
+            self.running.discard(flight)
+
+interactions = InteractionDispatcher()
+
+@bot.event
+async def on_interaction(interaction):
+    if isinstance(interaction.user, discord.Member):
+        members.remember(interaction.user)
     if interaction.type == discord.InteractionType.component:
-        custom_id = interaction.data["custom_id"]
-        if custom_id == "create_ticket":
-            await handle_create_ticket(interaction)
-        elif custom_id == "cancel_deal":
-            await handle_cancel_deal(interaction)
-        elif custom_id == "accept_deal":
-            await handle_accept_deal(interaction)
-        elif custom_id == "confirm_funds":
-            await handle_confirm_funds(interaction)
-        elif custom_id == "release_funds":
-            await handle_release_funds(interaction)
-        # Role selection buttons ("role_sender", "role_receiver", "confirm_role")
-        # are handled by the RoleSelectionView callbacks.
+        await interactions.dispatch(interaction)
+
+# ----------------- Deal buttons -----------------
+# The deal buttons carry their deal id and are routed by the interaction
+# dispatcher on their custom_id prefix, so they keep working after a restart
+# without their views being registered again.
+def accept_buttons(deal_id):
+    view = View(timeout=180)
+    view.add_item(Button(label="Accept", style=discord.ButtonStyle.green, custom_id=f"accept_deal:{deal_id}"))
+    view.add_item(Button(label="Cancel", style=discord.ButtonStyle.red, custom_id=f"cancel_deal:{deal_id}"))
+    return view
+
+def confirm_funds_buttons(deal_id):
+    view = View(timeout=180)
+    view.add_item(Button(label="Have you sent funds?", style=discord.ButtonStyle.primary, custom_id=f"confirm_funds:{deal_id}"))
+    return view
+
+def release_funds_buttons(deal_id):
+    view = View(timeout=180)
+    view.add_item(Button(label="Release funds", style=discord.ButtonStyle.green, custom_id=f"release_funds:{deal_id}"))
+    return view
+
+def find_deal(interaction, deal_id):
+    """Return the deal a button belongs to, by its id or, for older buttons, by thread."""
+    if deal_id is not None:
+        return deal_store.get(deal_id)
+    return deal_store.by_thread(interaction.channel_id)
 
 # ----------------- Roles selections -----------------
 class RoleSelectionView(View):
-    """View for selecting and confirming roles using buttons."""
+    """
+    View for selecting and confirming roles using buttons.
+    Selections are kept on the deal, so the view can be re-attached to its
+    message after a restart.
+    """
     def __init__(self, thread_id):
-        super().__init__(timeout=300)
+        super().__init__(timeout=None)
         self.thread_id = thread_id
 
+    def _selections(self, interaction):
+        """Return the deal and its role selections if the user takes part in it."""
+        deal = deal_store.by_thread(self.thread_id)
+        if not deal or not deal.roles or interaction.user.id not in deal.roles:
+            return None, None
+        return deal, deal.roles
+
     @discord.ui.button(label="I am Sender", style=discord.ButtonStyle.primary, custom_id="role_sender")
     async def sender_button(self, interaction: discord.Interaction, button: Button):
-        if interaction.user.id not in pending_roles[self.thread_id]:
+        deal, selections = self._selections(interaction)
+        if not selections:
             await interaction.response.send_message("You are not a participant in this transaction.", ephemeral=True)
             return
-        pending_roles[self.thread_id][interaction.user.id]["role"] = "sender"
-        pending_roles[self.thread_id][interaction.user.id]["confirmed"] = False  # Reset confirmation if role changes
+        selections[interaction.user.id]["role"] = "sender"
+        selections[interaction.user.id]["confirmed"] = False  # Reset confirmation if role changes
+        deal_store.save(deal)
         await interaction.response.send_message("You have selected **Sender**. Please confirm your selection using the 'Confirm My Role' button.", ephemeral=True)
 
     @discord.ui.button(label="I am Receiver", style=discord.ButtonStyle.primary, custom_id="role_receiver")
     async def receiver_button(self, interaction: discord.Interaction, button: Button):
-        if interaction.user.id not in pending_roles[self.thread_id]:
+        deal, selections = self._selections(interaction)
+        if not selections:
             await interaction.response.send_message("You are not a participant in this transaction.", ephemeral=True)
             return
-        pending_roles[self.thread_id][interaction.user.id]["role"] = "receiver"
-        pending_roles[self.thread_id][interaction.user.id]["confirmed"] = False
+        selections[interaction.user.id]["role"] = "receiver"
+        selections[interaction.user.id]["confirmed"] = False
+        deal_store.save(deal)
         await interaction.response.send_message("You have selected **Receiver**. Please confirm your selection using the 'Confirm My Role' button.", ephemeral=True)
 
     @discord.ui.button(label="Confirm My Role", style=discord.ButtonStyle.success, custom_id="confirm_role")
     async def confirm_button(self, interaction: discord.Interaction, button: Button):
-        if interaction.user.id not in pending_roles[self.thread_id]:
+        deal, selections = self._selections(interaction)
+        if not selections:
             await interaction.response.send_message("You are not a participant in this transaction.", ephemeral=True)
             return
-        if pending_roles[self.thread_id][interaction.user.id]["role"] is None:
+        if selections[interaction.user.id]["role"] is None:
             await interaction.response.send_message("Please select a role first.", ephemeral=True)
             return
 
-        pending_roles[self.thread_id][interaction.user.id]["confirmed"] = True
-        await interaction.response.send_message(f"Your role **{pending_roles[self.thread_id][interaction.user.id]['role']}** has been confirmed.", ephemeral=True)
+        selections[interaction.user.id]["confirmed"] = True
+        deal_store.save(deal)
+        await interaction.response.send_message(f"Your role **{selections[interaction.user.id]['role']}** has been confirmed.", ephemeral=True)
+
+        # The other participant may have confirmed, and moved the deal on, during that await
+        if deal.state == "roles_confirmed":
+            return
+        if deal.state != "accepted" or not deal.roles:
+            await interaction.followup.send("This deal is no longer open.", ephemeral=True)
+            return
+        selections = deal.roles
 
         # Check if both participants have confirmed their roles
-        selections = pending_roles[self.thread_id]
         if all(info["confirmed"] for info in selections.values()):
             roles = {uid: info["role"] for uid, info in selections.items()}
             # Ensure that the two participants have chosen complementary roles
@@ -159,6 +3302,7 @@ class RoleSelectionView(View):
                 for uid in selections:
                     selections[uid]["role"] = None
                     selections[uid]["confirmed"] = False
+                deal_store.save(deal)
                 return
 
             # Assign roles
@@ -170,26 +3314,23 @@ class RoleSelectionView(View):
                 elif role == "receiver":
                     receiver_id = uid
 
-            # Update the thread's info file (without changing the thread name)
-            thread = interaction.channel
-            custom_thread_id = thread_data.get(thread.id)
-            if custom_thread_id:
-                thread_folder = os.path.join(LOGS_DIR, custom_thread_id)
-                info_path = os.path.join(thread_folder, "info.json")
-                with open(info_path, "r") as f:
-                    thread_info = json.load(f)
-                thread_info["sender"] = sender_id
-                thread_info["receiver"] = receiver_id
-                with open(info_path, "w") as f:
-                    json.dump(thread_info, f, indent=4)
+            # Update the deal (without changing the thread name)
+            try:
+                deal_store.transition(deal, "roles_confirmed", sender=sender_id, receiver=receiver_id, roles=None, role_message_id=None)
+            except InvalidTransition:
+                await interaction.followup.send("This deal is no longer open.", ephemeral=True)
+                return
 
             await interaction.followup.send("Roles have been successfully confirmed! You may now proceed with the transaction.", ephemeral=False)
+            deal.role_view = None
             self.stop()  # Disable further interactions
+            outbox.edit(interaction.channel, interaction.message.id, view=None)
+            await send_deposit_address(deal, interaction.channel)
 
 # ----------------- Ticket and Transaction  -----------------
-async def handle_create_ticket(interaction):
+@interactions.route("create_ticket", ephemeral=True, concurrency=5, max_waiting=50, debounce=10.0, needs=("discord",))
+async def handle_create_ticket(interaction, _):
     """Create a new private thread ticket for the escrow transaction."""
-    await interaction.response.defer(ephemeral=True)
     custom_thread_id = generate_id()
     guild = interaction.guild
     channel = interaction.channel
@@ -199,10 +3340,20 @@ async def handle_create_ticket(interaction):
         type=discord.ChannelType.private_thread,
         invitable=False
     )
-    # Send the custom thread ID so it can be referenced later
-    await thread.send(f"Thread ID: ```{custom_thread_id}```")
-    await thread.send(f"{interaction.user.mention}")
-    thread_data[thread.id] = custom_thread_id
+    # Register the deal and create its logs folder with an initial info.json file
+    deal = deal_store.create(custom_thread_id, thread.id, interaction.user.id, guild.id)
+    # Send the custom thread ID on its own so it can be referenced later
+    outbox.send(thread, f"Thread ID: ```{custom_thread_id}```", merge=False)
+    # The mention, warning, contact line and Accept/Cancel buttons go out as
+    # one message, which is deleted once the deal is accepted
+    outbox.send(thread, f"{interaction.user.mention}")
+    outbox.send(
+        thread,
+        "WARNING: Please use only this thread for all transaction-related conversations. "
+        "Our bots and staff will never contact you via DM."
+    )
+    outbox.send(thread, "For any questions, contact via LinkdIn")
+    intro = outbox.send(thread, "Do you want to proceed?", view=accept_buttons(custom_thread_id))
     go_to_thread_button = Button(
         label="Go to thread",
         style=discord.ButtonStyle.link,
@@ -215,371 +3366,228 @@ async def handle_create_ticket(interaction):
         view=view,
         ephemeral=True
     )
-    # Create a logs folder for this thread and write an initial info.json file
-    thread_folder = os.path.join(LOGS_DIR, custom_thread_id)
-    os.makedirs(thread_folder, exist_ok=True)
-    with open(os.path.join(thread_folder, "info.json"), "w") as f:
-        json.dump({}, f, indent=4)
-    # Send warning and contact messages
-    await thread.send(
-        "WARNING: Please use only this thread for all transaction-related conversations. "
-        "Our bots and staff will never contact you via DM."
-    )
-    await thread.send(
-        "For any questions, contact via LinkdIn"
-    )
-    # Provide Accept and Cancel buttons
-    confirm_view = View()
-    confirm_view.add_item(Button(label="Accept", style=discord.ButtonStyle.green, custom_id="accept_deal"))
-    confirm_view.add_item(Button(label="Cancel", style=discord.ButtonStyle.red, custom_id="cancel_deal"))
-    await thread.send("Do you want to proceed?", view=confirm_view)
+    try:
+        message = await intro
+    except discord.HTTPException:
+        return
+    if deal.state == "created":
+        deal_store.update(deal, message_ids=[message.id])
 
-async def handle_cancel_deal(interaction):
+@interactions.route("cancel_deal", concurrency=10, max_waiting=100, single_flight=True)
+async def handle_cancel_deal(interaction, deal_id):
     """Cancel the transaction and delete the thread along with its logs."""
-    await interaction.response.defer()
     thread = interaction.channel
-    custom_thread_id = thread_data.get(thread.id)
+    deal = find_deal(interaction, deal_id)
+    if deal and "cancelled" not in DEAL_TRANSITIONS[deal.state]:
+        outbox.send(thread, "Funds have already been sent, this deal can no longer be cancelled.")
+        return
+    outbox.discard(thread.id)
     await thread.delete()
-    if custom_thread_id:
-        thread_folder = os.path.join(LOGS_DIR, custom_thread_id)
-        if os.path.exists(thread_folder):
-            shutil.rmtree(thread_folder)
-        thread_data.pop(thread.id, None)
+    if deal:
+        end_deal(deal, "cancelled")
 
-async def handle_accept_deal(interaction):
+@interactions.route("accept_deal", single_flight=True)
+async def handle_accept_deal(interaction, deal_id):
     """
     Handle deal acceptance:
       - Add the second user to the thread.
-      - Initiate role selection via buttons.
-      - Generate a Litecoin address using local subprocess commands.
-      - Retrieve the private key and update the thread info.
+      - Initiate role selection via buttons. The deposit address is handed
+        out once both roles are confirmed.
     """
-    await interaction.response.defer()
     thread = interaction.channel
     guild = interaction.guild
-    # Delete bot messages
-    async for message in thread.history(limit=100):
-        if message.author == bot.user and not message.content.startswith("Thread ID:"):
-            await message.delete()
+    deal = find_deal(interaction, deal_id)
+    if not deal:
+        outbox.send(thread, "Deal not found.")
+        return
+    if deal.state != "created":
+        outbox.send(thread, "This deal has already been accepted.")
+        return
+    # Delete the ticket's intro message, tracked since it was sent
+    if deal.message_ids:
+        outbox.delete(thread, deal.message_ids)
+        deal_store.update(deal, message_ids=None)
     # Ask for the Discord ID of the second user
-    await thread.send(f"{interaction.user.mention}, please provide the Discord ID (numeric) of the second user.")
+    outbox.send(thread, f"{interaction.user.mention}, please provide the Discord ID (numeric) of the second user.")
     
     def check(msg):
-        return msg.channel == thread and msg.author == interaction.user and msg.content.isdigit()
+        return msg.author == interaction.user and msg.content.isdigit()
     
     try:
-        msg = await bot.wait_for("message", check=check, timeout=60)
+        msg = await message_router.wait_for(thread.id, check, timeout=60)
         second_user_id = int(msg.content)
-        second_user = guild.get_member(second_user_id)
+        try:
+            second_user = await members.get(guild, second_user_id)
+        except discord.HTTPException as e:
+            print(f"Error fetching member {second_user_id}: {e}")
+            second_user = None
         if not second_user:
-            await thread.send("The provided ID does not belong to a valid member of the server.")
+            outbox.send(thread, "The provided ID does not belong to a valid member of the server.")
             return
         await thread.add_user(second_user)
+    except PromptCancelled:
+        return
     except asyncio.TimeoutError:
-        await thread.send("Timeout. Closing the ticket.")
+        try:
+            await outbox.send(thread, "Timeout. Closing the ticket.")
+        except discord.HTTPException:
+            pass
+        outbox.discard(thread.id)
         await thread.delete()
+        if "expired" in DEAL_TRANSITIONS[deal.state]:
+            end_deal(deal, "expired")
         return
 
     # Initialize role selection for both participants using buttons
-    pending_roles[thread.id] = {
-        interaction.user.id: {"role": None, "confirmed": False},
-        second_user.id: {"role": None, "confirmed": False}
-    }
-    await thread.send(
-        "Both participants, please select your role using the buttons below, then confirm your selection using 'Confirm My Role'.",
-        view=RoleSelectionView(thread.id)
-    )
-
-    # Generate a new Litecoin address using local commands
     try:
-        result = subprocess.run(
-            ["litecoin-cli", "getnewaddress"],
-            capture_output=True,
-            text=True,
-            check=True
+        deal_store.transition(
+            deal,
+            "accepted",
+            participants=[interaction.user.id, second_user.id],
+            roles={
+                interaction.user.id: {"role": None, "confirmed": False},
+                second_user.id: {"role": None, "confirmed": False}
+            }
         )
-        address = result.stdout.strip()
-        await thread.send(f"Here is your unique Litecoin address: `{address}`")
-    except subprocess.CalledProcessError as e:
-        await thread.send("Error generating Litecoin address.")
-        print(f"Error generating Litecoin address: {e}")
+    except InvalidTransition:
+        outbox.send(thread, "This deal is no longer open.")
         return
-    
-    # Provide a button to confirm that funds have been sent
-    confirm_view = View()
-    confirm_view.add_item(Button(label="Have you sent funds?", style=discord.ButtonStyle.primary, custom_id="confirm_funds"))
-    await thread.send(view=confirm_view)
-    
-    # Retrieve the private key for the generated address
+    deal.role_view = RoleSelectionView(thread.id)
     try:
-        privkey_result = subprocess.run(
-            ["litecoin-cli", "dumpprivkey", address],
-            capture_output=True,
-            text=True,
-            check=True
+        role_message = await outbox.send(
+            thread,
+            "Both participants, please select your role using the buttons below, then confirm your selection using 'Confirm My Role'.",
+            view=deal.role_view
         )
-        private_key = privkey_result.stdout.strip()
-    except subprocess.CalledProcessError as e:
-        await thread.send("Error retrieving private key.")
-        print(f"Error retrieving private key: {e}")
+    except discord.HTTPException:
         return
+    deal_store.update(deal, role_message_id=role_message.id)
 
-    custom_thread_id = thread_data.get(thread.id)
-    thread_folder = os.path.join(LOGS_DIR, custom_thread_id)
-    info_path = os.path.join(thread_folder, "info.json")
-    with open(info_path, 'r') as f:
-        thread_info = json.load(f)
-    thread_info["address"] = address
-    thread_info["private_key"] = private_key
-    with open(info_path, 'w') as f:
-        json.dump(thread_info, f, indent=4)
+async def send_deposit_address(deal, thread):
+    """Bind a pre-generated Litecoin address to the deal and post it with the funds button."""
+    try:
+        address, private_key = await address_pool.take(deal.deal_id)
+    except RPCError as e:
+        outbox.send(thread, "Error generating Litecoin address.")
+        print(f"Error generating Litecoin address: {e}")
+        return
+    deal_store.update(deal, address=address, private_key=private_key)
+    outbox.send(thread, f"Here is your unique Litecoin address: `{address}`")
+    
+    # Provide a button to confirm that funds have been sent
+    outbox.send(thread, view=confirm_funds_buttons(deal.deal_id))
 
-async def handle_confirm_funds(interaction):
+@interactions.route("confirm_funds", single_flight=True, needs=("node",))
+async def handle_confirm_funds(interaction, deal_id):
     """
     Monitor the Litecoin address for incoming funds.
     Once funds are detected, update the thread info and wait for confirmations.
     """
-    await interaction.response.defer()
     thread = interaction.channel
-    address = None
-    async for message in thread.history(limit=100):
-        if "litecoin address" in message.content.lower():
-            # Assume the address is between backticks
-            parts = message.content.split('`')
-            if len(parts) >= 2:
-                address = parts[1]
-                break
-    if not address:
-        await thread.send("Address not found.")
+    deal = find_deal(interaction, deal_id)
+    if not deal or not deal.address:
+        outbox.send(thread, "Address not found.")
         return
-    # Check for funds periodically
-    while True:
-        try:
-            result = subprocess.run(
-                ["litecoin-cli", "getreceivedbyaddress", address, "0"],
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            balance = float(result.stdout.strip())
-        except subprocess.CalledProcessError:
-            balance = 0
-        except ValueError:
-            balance = 0
-
-        if balance > 0:
-            custom_thread_id = thread_data.get(thread.id)
-            thread_folder = os.path.join(LOGS_DIR, custom_thread_id)
-            info_path = os.path.join(thread_folder, "info.json")
-            with open(info_path, 'r') as f:
-                thread_info = json.load(f)
-            thread_info["amount"] = balance
-            with open(info_path, 'w') as f:
-                json.dump(thread_info, f, indent=4)
-            await thread.send("💸 Funds received!")
-            break
-        await asyncio.sleep(10)
+    if deal.state not in ("roles_confirmed", "funded"):
+        outbox.send(thread, "This deal is not waiting for funds.")
+        return
+    if deal.deal_id in watched_deals:
+        outbox.send(thread, "Already watching for the deposit.")
+        return
+    deal_store.update(deal, watching=True)
+    await watch_deposit(deal, thread)
+
+watched_deals = set()  # Ids of the deals with a watch_deposit in progress
+
+async def watch_deposit(deal, thread):
+    """
+    Wait for the deal's deposit and its confirmations, then offer the release
+    button. Also used to resume watching after a restart.
+    """
+    if deal.deal_id in watched_deals:
+        return
+    watched_deals.add(deal.deal_id)
+    try:
+        await _watch_deposit(deal, thread)
+    finally:
+        watched_deals.discard(deal.deal_id)
+
+async def _watch_deposit(deal, thread):
+    address = deal.address
+    if deal.state == "roles_confirmed":
+        # Wait for the shared deposit watcher to see the funds
+        balance = None
+        while balance is None:  # None: woken by retarget(), wait again
+            balance = await deposit_watcher.wait_for(address, confirmations=0)
+        if deal.state == "roles_confirmed":
+            required = deal.confirmations_required or confirmations_for(balance)
+            deal_store.transition(deal, "funded", amount=balance, confirmations_required=required)
+            outbox.send(thread, "💸 Funds received!")
     
-    await thread.send("⏳ Waiting for confirmations...")
     while True:
-        try:
-            result = subprocess.run(
-                ["litecoin-cli", "getreceivedbyaddress", address, "1"],
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            conf_balance = float(result.stdout.strip())
-        except subprocess.CalledProcessError:
-            conf_balance = 0
-        except ValueError:
-            conf_balance = 0
-
-        if conf_balance > 0:
-            await thread.send("✅ Transaction confirmed!")
+        # Read again after !confirmations changed the requirement
+        required = deal.confirmations_required or confirmations_for(deal.amount)
+        outbox.send(thread, f"⏳ Waiting for {required} confirmation(s)...")
+        if await deposit_watcher.wait_for(address, confirmations=required) is not None:
             break
-        await asyncio.sleep(10)
+    if deal.state != "funded":
+        return  # Another watcher on the same deal got here first
+    deal_store.transition(deal, "confirmed", watching=None)
+    outbox.send(thread, "✅ Transaction confirmed!")
     
-    release_view = View()
-    release_view.add_item(Button(label="Release funds", style=discord.ButtonStyle.green, custom_id="release_funds"))
-    await thread.send(view=release_view)
+    outbox.send(thread, view=release_funds_buttons(deal.deal_id))
 
-async def handle_release_funds(interaction):
+@interactions.route("release_funds", single_flight=True, needs=("node", "discord"))
+async def handle_release_funds(interaction, deal_id):
     """
     Release funds by:
-      - Creating, signing, and broadcasting the transaction.
+      - Building the transaction in-process from every escrow output.
+      - Signing it with the node wallet and broadcasting it.
       - Updating the statistics after a successful release.
     """
-    await interaction.response.defer()
     thread = interaction.channel
     try:
-        address = None
-        async for message in thread.history(limit=100):
-            if "litecoin address" in message.content.lower():
-                parts = message.content.split('`')
-                if len(parts) >= 2:
-                    address = parts[1]
-                    break
-        if not address:
-            await thread.send("Address not found.")
+        deal = find_deal(interaction, deal_id)
+        if not deal or not deal.address:
+            outbox.send(thread, "Address not found.")
             return
-        await thread.send("Please provide the destination address:")
+        if deal.state != "confirmed":
+            outbox.send(thread, "The funds are not confirmed yet." if deal.state in ("roles_confirmed", "funded") else "This deal is closed.")
+            return
+        address = deal.address
+        outbox.send(thread, "Please provide the destination address:")
         
         def check_ltc_address(msg):
-            return msg.channel == thread and len(msg.content) in [34, 43, 63]
+            return len(msg.content) in [34, 43, 63]
         
-        msg = await bot.wait_for("message", check=check_ltc_address, timeout=60)
+        msg = await message_router.wait_for(thread.id, check_ltc_address, timeout=60)
         recipient_address = msg.content
         
-        # Get the private key for the address
-        try:
-            privkey_result = subprocess.run(
-                ["litecoin-cli", "dumpprivkey", address],
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            private_key = privkey_result.stdout.strip()
-        except subprocess.CalledProcessError as e:
-            await thread.send("Error retrieving private key.")
-            print(f"Error retrieving private key: {e}")
-            return
-
-        # List unspent outputs for the address
-        unspent_cmd = ["litecoin-cli", "listunspent", "1", "9999999", f'["{address}"]']
-        try:
-            unspent_result = subprocess.run(
-                unspent_cmd,
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            unspent_data = json.loads(unspent_result.stdout)
-            utxo = unspent_data[0]
-        except Exception as e:
-            await thread.send("Error retrieving unspent outputs.")
-            print(f"Error retrieving unspent outputs: {e}")
-            return
-
-        total_amount = float(utxo['amount'])
-        txid = utxo['txid']
-        vout = utxo['vout']
-
-        # Create raw transaction
-        create_tx_cmd = (
-            f"litecoin-cli createrawtransaction "
-            f"'[{{\"txid\":\"{txid}\",\"vout\":{vout}}}]' "
-            f"'{{\"{recipient_address}\":{total_amount}}}'"
-        )
-        try:
-            raw_tx_result = subprocess.run(
-                create_tx_cmd,
-                shell=True,
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            raw_hex = raw_tx_result.stdout.strip()
-        except subprocess.CalledProcessError as e:
-            await thread.send("Error creating raw transaction.")
-            print(f"Error creating raw transaction: {e}")
-            return
-
-        # Sign the raw transaction
-        sign_cmd = (
-            f"litecoin-cli signrawtransactionwithkey "
-            f"\"{raw_hex}\" "
-            f"'[\"{private_key}\"]' | jq -r .hex"
-        )
-        try:
-            signed_result = subprocess.run(
-                sign_cmd,
-                shell=True,
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            signed_hex = signed_result.stdout.strip()
-        except subprocess.CalledProcessError as e:
-            await thread.send("Error signing transaction.")
-            print(f"Error signing transaction: {e}")
-            return
-
-        hex_size = len(signed_hex) / 2
-        fee = 0.0001 * (hex_size / 1000)
-        final_amount = total_amount - fee
-
-        # Create final transaction with adjusted amount
-        create_final_tx_cmd = (
-            f"litecoin-cli createrawtransaction "
-            f"'[{{\"txid\":\"{txid}\",\"vout\":{vout}}}]' "
-            f"'{{\"{recipient_address}\":{final_amount}}}'"
-        )
-        try:
-            final_raw_result = subprocess.run(
-                create_final_tx_cmd,
-                shell=True,
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            final_raw_hex = final_raw_result.stdout.strip()
-        except subprocess.CalledProcessError as e:
-            await thread.send("Error creating final raw transaction.")
-            print(f"Error creating final raw transaction: {e}")
-            return
-
-        final_sign_cmd = (
-            f"litecoin-cli signrawtransactionwithkey "
-            f"\"{final_raw_hex}\" "
-            f"'[\"{private_key}\"]' | jq -r .hex"
-        )
         try:
-            final_signed_result = subprocess.run(
-                final_sign_cmd,
-                shell=True,
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            final_signed_hex = final_signed_result.stdout.strip()
-        except subprocess.CalledProcessError as e:
-            await thread.send("Error signing final transaction.")
-            print(f"Error signing final transaction: {e}")
+            recipient_script = address_to_script(recipient_address)
+        except AddressError as e:
+            outbox.send(thread, f"Invalid destination address: {e}.")
             return
 
-        # Broadcast the transaction
+        if PAYOUT_BATCHING:
+            outbox.send(thread, "⏳ Payout queued, it will be broadcast with the next batch.")
+        # Spend every confirmed output sitting at the escrow address
         try:
-            broadcast_result = subprocess.run(
-                ["litecoin-cli", "sendrawtransaction", final_signed_hex],
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            txid_broadcast = broadcast_result.stdout.strip()
-            await thread.send(f"✅ Funds released! TXID: `{txid_broadcast}`")
-        except subprocess.CalledProcessError as e:
-            await thread.send("Error broadcasting transaction.")
-            print(f"Error broadcasting transaction: {e}")
+            txid_broadcast, final_amount, fee = await coordinator.payout(deal, address, recipient_script)
+        except PayoutError as e:
+            outbox.send(thread, str(e))
             return
+        outbox.send(thread, f"✅ Funds released! TXID: `{txid_broadcast}`")
+        deal_store.transition(deal, "released", txid=txid_broadcast)
         
         # Update statistics
-        custom_thread_id = thread_data.get(thread.id)
-        thread_folder = os.path.join(LOGS_DIR, custom_thread_id)
-        info_path = os.path.join(thread_folder, "info.json")
-        with open(info_path, 'r') as f:
-            thread_info = json.load(f)
-        amount = thread_info.get("amount", 0)
-        sender_id = thread_info["sender"]
-        receiver_id = thread_info["receiver"]
+        await record_completed_deal(deal, txid_broadcast, fee)
         
-        update_stats(amount)
-        update_user_stats(bot, sender_id, amount_sent=amount)
-        update_user_stats(bot, receiver_id, amount_received=amount)
-        
-        await thread.send("📊 Stats updated!")
+        outbox.send(thread, "📊 Stats updated!")
+    except PromptCancelled:
+        return
     except Exception as e:
-        await thread.send(f"❌ Error: {str(e)}")
+        outbox.send(thread, f"❌ Error: {str(e)}")
         print(f"Error: {e}")
 
 # ----------------- Bot Commands -----------------
@@ -663,42 +3671,279 @@ async def ticket(ctx):
     
     await ctx.send(embed=embed2, view=view2)
 
+STATS_WINDOW_RE = re.compile(r"^(\d+)([hd])$")
+
 @bot.command()
-async def stats(ctx):
-    """Display server-wide transaction statistics."""
-    try:
-        with open(STATS_FILE, 'r') as f:
-            stats_data = json.load(f)
-    except FileNotFoundError:
+async def stats(ctx, window: str = None):
+    """Display server-wide transaction statistics, optionally for a window such as 24h or 7d."""
+    if window:
+        match = STATS_WINDOW_RE.match(window.lower())
+        if not match:
+            await ctx.send("Invalid window. Use hours or days, e.g. `!stats 24h` or `!stats 7d`.")
+            return
+        seconds = int(match.group(1)) * (3600 if match.group(2) == "h" else 86400)
+        if seconds > stats_rollup.days * 86400:
+            await ctx.send(f"Windowed statistics only cover the last {stats_rollup.days} days.")
+            return
+        count, volume = stats_rollup.window(seconds)
+        title = f"📈 Server Statistics (last {window.lower()})"
+    else:
+        count, volume = stats_rollup.count, stats_rollup.volume
+        title = "📈 Server Statistics"
+    if not count and not window:
         await ctx.send("No transactions recorded.")
         return
-    total = sum(stats_data.values())
     await ctx.send(
-        f"📈 Server Statistics\n"
-        f"Total transactions: {len(stats_data)}\n"
-        f"Total volume: {total:.8f} LTC"
+        f"{title}\n"
+        f"Total transactions: {count}\n"
+        f"Total volume: {volume / COIN:.8f} LTC"
     )
 
 @bot.command()
 async def userstats(ctx, user_id: int):
     """Display statistics for a specific user."""
+    # Answered from memory: only an already cached member gives a name
+    member = members.cached(ctx.guild.id, user_id) if ctx.guild else None
+    name = member.name if member else f"<@{user_id}>"
+    user_data = stats_rollup.user(user_id, legacy_name=sanitize_filename(member.name) if member else None)
+    if not user_data:
+        await ctx.send("No statistics for this user.")
+        return
+    amount_sent, amount_received, total_deals = user_data
+    await ctx.send(
+        f"📊 Stats for {name}\n"
+        f"Received: {amount_received / COIN:.8f} LTC\n"
+        f"Sent: {amount_sent / COIN:.8f} LTC\n"
+        f"Total Volume: {(amount_sent + amount_received) / COIN:.8f} LTC\n"
+        f"Transactions: {total_deals}",
+        allowed_mentions=discord.AllowedMentions.none()
+    )
+
+@bot.command()
+async def leaderboard(ctx):
+    """Display the users with the highest trading volume."""
+    if not stats_rollup.leaderboard:
+        await ctx.send("No transactions recorded.")
+        return
+    lines = [
+        f"{rank}. <@{user_id}> - {volume / COIN:.8f} LTC"
+        for rank, (volume, user_id) in enumerate(stats_rollup.leaderboard, start=1)
+    ]
+    await ctx.send("🏆 Volume Leaderboard\n" + "\n".join(lines), allowed_mentions=discord.AllowedMentions.none())
+
+def history_page(user_id, rows, has_newer, has_older):
+    """
+    Render one page of !history. The buttons carry the user and the id of the
+    first or last deal shown, which is all the next page's query needs.
+    """
+    title = f"📜 Deal history of <@{user_id}>"
+    lines = [
+        f"`#{row_id}` <t:{completed_at}:d> <@{sender_id}> → <@{receiver_id}> {amount / COIN:.8f} LTC"
+        + (f" · `{txid[:16]}…`" if txid else "")
+        for row_id, _, _, sender_id, receiver_id, amount, _, txid, completed_at in rows
+    ]
+    view = View(timeout=180)
+    view.add_item(Button(label="◀ Newer", style=discord.ButtonStyle.secondary, disabled=not has_newer,
+                         custom_id=f"history:{user_id}:newer:{rows[0][0]}"))
+    view.add_item(Button(label="Older ▶", style=discord.ButtonStyle.secondary, disabled=not has_older,
+                         custom_id=f"history:{user_id}:older:{rows[-1][0]}"))
+    return title + "\n" + "\n".join(lines), view
+
+@bot.command()
+async def history(ctx, user: discord.User = None):
+    """Display the completed deals of a user, or your own, a page at a time."""
+    user_id = (user or ctx.author).id
+    rows = await ledger.history(user_id, limit=HISTORY_PAGE_SIZE + 1)
+    if not rows:
+        await ctx.send("No completed deals for this user.")
+        return
+    content, view = history_page(user_id, rows[:HISTORY_PAGE_SIZE], False, len(rows) > HISTORY_PAGE_SIZE)
+    await ctx.send(content, view=view, allowed_mentions=discord.AllowedMentions.none())
+
+@interactions.route("history", debounce=0.5)
+async def handle_history_page(interaction, argument):
     try:
-        user = await bot.fetch_user(user_id)
-    except discord.NotFound:
-        await ctx.send("User not found.")
+        user_id, direction, cursor = argument.split(":")
+        user_id, cursor = int(user_id), int(cursor)
+    except (AttributeError, ValueError):
         return
-    user_file = os.path.join(USERS_DIR, f"{sanitize_filename(user.name)}.json")
-    if not os.path.exists(user_file):
-        await ctx.send("No statistics for this user.")
+    if direction == "newer":
+        rows = await ledger.history(user_id, after_id=cursor, limit=HISTORY_PAGE_SIZE + 1)
+        has_newer, has_older = len(rows) > HISTORY_PAGE_SIZE, True
+        rows = rows[-HISTORY_PAGE_SIZE:]
+    else:
+        rows = await ledger.history(user_id, before_id=cursor, limit=HISTORY_PAGE_SIZE + 1)
+        has_newer, has_older = True, len(rows) > HISTORY_PAGE_SIZE
+        rows = rows[:HISTORY_PAGE_SIZE]
+    if not rows:
+        return
+    content, view = history_page(user_id, rows, has_newer, has_older)
+    await interaction.edit_original_response(content=content, view=view, allowed_mentions=discord.AllowedMentions.none())
+
+EXPORT_FIELDS = ("id", "deal_id", "thread_id", "sender_id", "receiver_id", "amount", "fee", "txid", "completed_at")
+export_lock = asyncio.Lock()
+
+def write_export_rows(out, writer, fmt, rows):
+    for row in rows:
+        record = dict(zip(EXPORT_FIELDS, row))
+        record["amount"] = f"{record['amount'] / COIN:.8f}"
+        if record["fee"] is not None:
+            record["fee"] = f"{record['fee'] / COIN:.8f}"
+        if record["completed_at"]:
+            record["completed_at"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(record["completed_at"]))
+        else:
+            record["completed_at"] = None  # Imported from stats.json, undated
+        if fmt == "csv":
+            writer.writerow(record)
+        else:
+            out.write(json.dumps(record) + "\n")
+
+async def export_deals(fileobj, fmt, user_id=None):
+    """
+    Write completed deals to `fileobj` as gzipped CSV or JSONL. Deals are read
+    EXPORT_CHUNK_SIZE at a time and written on a worker thread, so memory
+    stays bounded and the ledger keeps serving other requests in between.
+    Returns the number of deals written.
+    """
+    compressed = gzip.GzipFile(fileobj=fileobj, mode="wb")
+    out = io.TextIOWrapper(compressed, encoding="utf-8", newline="")
+    writer = None
+    if fmt == "csv":
+        writer = csv.DictWriter(out, EXPORT_FIELDS)
+        writer.writeheader()
+    count, after_id = 0, 0
+    while True:
+        rows = await ledger.export_chunk(after_id, user_id, EXPORT_CHUNK_SIZE)
+        if not rows:
+            break
+        await asyncio.to_thread(write_export_rows, out, writer, fmt, rows)
+        count += len(rows)
+        after_id = rows[-1][0]
+    out.flush()
+    out.detach()
+    compressed.close()
+    return count
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def export(ctx, fmt: str = "csv", user: discord.User = None):
+    """Export completed deals, of everyone or one user, as a gzipped CSV or JSONL file (admins only)."""
+    fmt = fmt.lower()
+    if fmt not in ("csv", "jsonl"):
+        await ctx.send("Invalid format. Use `!export csv` or `!export jsonl`, optionally followed by a user.")
+        return
+    if export_lock.locked():
+        await ctx.send("An export is already running, please try again when it is done.")
+        return
+    async with export_lock:
+        with tempfile.TemporaryFile() as f:
+            async with ctx.typing():
+                count = await export_deals(f, fmt, user.id if user else None)
+            size = f.tell()
+            limit = ctx.guild.filesize_limit if ctx.guild else discord.utils.DEFAULT_FILE_SIZE_LIMIT_BYTES
+            if size > limit:
+                await ctx.send(f"The export of {count} deals is {size / 1024 / 1024:.1f} MiB, over the upload limit "
+                               f"of {limit / 1024 / 1024:.0f} MiB. Export a single user instead.")
+                return
+            f.seek(0)
+            await ctx.send(f"Exported {count} deals.", file=discord.File(f, filename=f"deals.{fmt}.gz"))
+
+@export.error
+async def export_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send("Only administrators can export deals.")
+    else:
+        print(f"Error exporting deals: {error}")
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def archived(ctx, key: str):
+    """Look up a finished deal in the archive by deal id, thread id or address (admins only)."""
+    if re.fullmatch(r"[a-z0-9]{32}", key):
+        record = await deal_store.find_archived(deal_id=key)
+    elif key.isdigit():
+        record = await deal_store.find_archived(thread_id=int(key))
+    else:
+        record = await deal_store.find_archived(address=key)
+    # Archives may be shared by sharded processes: only show this server's deals
+    if record is None or record["info"].get("guild_id") not in (None, ctx.guild.id if ctx.guild else None):
+        await ctx.send("No archived deal found.")
+        return
+    info = record["info"]
+    await ctx.send(
+        f"🗄️ Deal `{record['deal_id']}` ({info.get('state', 'unknown')}), archived <t:{record['archived_at']}:f>\n"
+        f"Thread: {info.get('thread_id') or '—'} · Address: `{info.get('address') or '—'}` · TXID: `{info.get('txid') or '—'}`\n"
+        f"Transcript: {len(record['transcript'])} message(s)",
+        file=discord.File(io.BytesIO(json.dumps(record, indent=2).encode()), filename=f"deal-{record['deal_id']}.json")
+    )
+
+@archived.error
+async def archived_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send("Only administrators can read archived deals.")
+    elif isinstance(error, commands.UserInputError):
+        await ctx.send("Usage: `!archived <deal id, thread id or address>`.")
+    else:
+        print(f"Error reading archived deal: {error}")
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def confirmations(ctx, count: int):
+    """Set how many confirmations the deal of this thread needs before release (admins only)."""
+    deal = deal_store.by_thread(ctx.channel.id)
+    if deal is None:
+        await ctx.send("Run this in the thread of an open deal.")
+        return
+    if deal.state not in ("created", "accepted", "roles_confirmed", "funded"):
+        await ctx.send("The funds of this deal are no longer waiting for confirmations.")
+        return
+    if count < 1:
+        await ctx.send("A deal needs at least 1 confirmation.")
+        return
+    # Journaled like any other change, so it survives a restart
+    deal_store.update(deal, confirmations_required=count)
+    if deal.address:
+        deposit_watcher.retarget(deal.address)
+    await ctx.send(f"This deal now needs {count} confirmation(s) before the funds can be released.")
+
+@confirmations.error
+async def confirmations_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send("Only administrators can change the confirmations of a deal.")
+    elif isinstance(error, commands.UserInputError):
+        await ctx.send("Usage: `!confirmations <count>` in the deal's thread.")
+    else:
+        print(f"Error setting confirmations: {error}")
+
+profile_lock = asyncio.Lock()
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def profile(ctx, seconds: float = 10):
+    """Sample every thread's stack for a few seconds and upload them as a collapsed-stack file (admins only)."""
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        await ctx.send(f"Profile for up to {PROFILE_MAX_SECONDS} seconds, e.g. `!profile 10`.")
+        return
+    if profile_lock.locked():
+        await ctx.send("A profile is already running, please try again when it is done.")
         return
-    with open(user_file, 'r') as f:
-        user_data = json.load(f)
+    async with profile_lock:
+        await ctx.send(f"⏱️ Profiling for {seconds:g}s...")
+        # The sampler runs on a worker thread, so the loop it samples keeps running
+        collapsed = await asyncio.to_thread(sample_stacks, seconds)
     await ctx.send(
-        f"📊 Stats for {user.name}\n"
-        f"Received: {user_data['Amount Received']:.8f} LTC\n"
-        f"Sent: {user_data['Amount Sent']:.8f} LTC\n"
-        f"Total Volume: {user_data['Total Volume']:.8f} LTC\n"
-        f"Transactions: {user_data['Total Deals']}"
+        "Collapsed stacks, one sample every "
+        f"{PROFILE_INTERVAL * 1000:g} ms. Open with speedscope or `flamegraph.pl`. "
+        f"Event loop stalls since startup: {watchdog.stalls}.",
+        file=discord.File(io.BytesIO(collapsed.encode()), filename=f"profile-{int(time.time())}.collapsed")
     )
 
-bot.run("token")
+@profile.error
+async def profile_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send("Only administrators can run the profiler.")
+    else:
+        print(f"Error profiling: {error}")
+
+if __name__ == "__main__":
+    bot.run(TOKEN)
@@ -0,0 +1,547 @@
+"""
+Offline load test for automiddleman.
+
+Runs the real deal handlers, from create_ticket to release_funds, for N
+concurrent deals against a stand-in litecoind (a local aiohttp JSON-RPC
+server mining blocks every --block-time seconds) and stand-in Discord
+objects whose REST calls go through a fake bot.http with a fixed latency.
+Nothing leaves the machine; the bot's files are written to a temporary
+directory.
+
+    python bench.py --deals 200 --block-time 0.5 --output bench.json
+
+Reports throughput, p50/p99 latency of every deal step, RPC and Discord
+requests per deal and memory per open deal, and saves them as JSON so runs
+can be compared.
+"""
+import argparse
+import asyncio
+import collections
+import hashlib
+import itertools
+import json
+import os
+import platform
+import random
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from aiohttp import web
+
+STEPS = ("create", "accept", "roles", "deposit", "confirmations", "release")
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def bech32_address(hrp, program):
+    """Encode a version 0 segwit address, used for stand-in wallet and payout addresses."""
+    acc = bits = 0
+    data = [0]
+    for byte in program:
+        acc = (acc << 8) | byte
+        bits += 8
+        while bits >= 5:
+            bits -= 5
+            data.append((acc >> bits) & 31)
+    if bits:
+        data.append((acc << (5 - bits)) & 31)
+    values = [ord(c) >> 5 for c in hrp] + [0] + [ord(c) & 31 for c in hrp] + data
+    polymod = am._bech32_polymod(values + [0] * 6) ^ 1
+    checksum = [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+    return hrp + "1" + "".join(am.BECH32_CHARSET[d] for d in data + checksum)
+
+
+# ----------------- Stand-in litecoind -----------------
+class FakeNode:
+    """
+    Just enough of litecoind's wallet and chain RPCs for the bot: a wallet
+    handing out P2WPKH addresses, deposits that confirm as blocks are mined,
+    and broadcasts that spend the outputs they reference.
+    """
+    def __init__(self, block_time, on_block=None):
+        self.block_time = block_time
+        self.on_block = on_block
+        self.height = 1000
+        self.keys = {}  # address -> private key
+        self.utxos = {}  # address -> [utxo dict with "height" (None while in the mempool)]
+        self.calls = collections.Counter()  # method -> calls
+        self.requests = 0  # HTTP requests, a batch counts once
+        self._counter = itertools.count()
+        self._runner = None
+        self._miner = None
+        self.url = None
+
+    def _getnewaddress(self, *params):
+        program = hashlib.sha256(b"wallet" + str(next(self._counter)).encode()).digest()[:20]
+        address = bech32_address("ltc", program)
+        self.keys[address] = "T" + program.hex()
+        return address
+
+    def _dumpprivkey(self, address):
+        return self.keys[address]
+
+    def _listunspent(self, minconf=1, maxconf=9999999, addresses=None):
+        unspent = []
+        for address in addresses if addresses is not None else list(self.utxos):
+            for utxo in self.utxos.get(address, []):
+                confirmations = self.height - utxo["height"] + 1 if utxo["height"] is not None else 0
+                if minconf <= confirmations <= maxconf:
+                    unspent.append(dict(utxo, address=address, confirmations=confirmations))
+        return unspent
+
+    def _estimatesmartfee(self, target, *params):
+        return {"feerate": 0.0001, "blocks": target}
+
+    def _getblockchaininfo(self):
+        return {"blocks": self.height, "headers": self.height, "initialblockdownload": False}
+
+    def _signrawtransactionwithwallet(self, raw_hex):
+        return {"hex": raw_hex, "complete": True}
+
+    def _sendrawtransaction(self, raw_hex):
+        raw = bytes.fromhex(raw_hex)
+        count, offset = raw[4], 5  # Fewer than 253 inputs
+        spent = set()
+        for _ in range(count):
+            spent.add((raw[offset:offset + 32][::-1].hex(), struct.unpack("<I", raw[offset + 32:offset + 36])[0]))
+            offset += 41
+        for address, utxos in list(self.utxos.items()):
+            self.utxos[address] = [utxo for utxo in utxos if (utxo["txid"], utxo["vout"]) not in spent]
+        return hashlib.sha256(hashlib.sha256(raw).digest()).digest()[::-1].hex()
+
+    def pay(self, address, amount):
+        """A customer sends `amount` LTC to an address; it confirms with the next block."""
+        script = "0014" + self.keys[address][1:]
+        txid = hashlib.sha256(f"{address}{next(self._counter)}".encode()).hexdigest()
+        self.utxos.setdefault(address, []).append(
+            {"txid": txid, "vout": 0, "amount": amount, "scriptPubKey": script, "height": None}
+        )
+
+    def _call(self, request):
+        method = request["method"]
+        self.calls[method] += 1
+        handler = getattr(self, "_" + method, None)
+        if handler is None:
+            return {"id": request["id"], "result": None, "error": {"code": -32601, "message": "Method not found"}}
+        try:
+            return {"id": request["id"], "result": handler(*request["params"]), "error": None}
+        except (KeyError, ValueError, IndexError) as e:
+            return {"id": request["id"], "result": None, "error": {"code": -5, "message": str(e)}}
+
+    async def _handle(self, request):
+        self.requests += 1
+        body = await request.json()
+        if isinstance(body, list):
+            return web.json_response([self._call(entry) for entry in body])
+        reply = self._call(body)
+        return web.json_response(reply, status=500 if reply["error"] else 200)
+
+    async def _mine(self):
+        while True:
+            await asyncio.sleep(self.block_time)
+            self.height += 1
+            for utxos in self.utxos.values():
+                for utxo in utxos:
+                    if utxo["height"] is None:
+                        utxo["height"] = self.height
+            if self.on_block:
+                self.on_block()
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+        self._miner = asyncio.create_task(self._mine())
+
+    async def stop(self):
+        self._miner.cancel()
+        await self._runner.cleanup()
+
+
+# ----------------- Stand-in Discord -----------------
+class FakeHTTP:
+    """Replaces bot.http: every REST call waits `latency` seconds and is counted by route."""
+    def __init__(self, latency):
+        self.latency = latency
+        self.routes = collections.Counter()
+
+    async def request(self, route, **kwargs):
+        self.routes[f"{route.method} {route.path}"] += 1
+        await asyncio.sleep(self.latency)
+
+    async def delete_message(self, channel_id, message_id, *, reason=None):
+        await self.request(Route("DELETE", "/channels/{channel_id}/messages/{message_id}",
+                                 channel_id=channel_id, message_id=message_id))
+
+    async def delete_messages(self, channel_id, message_ids, *, reason=None):
+        await self.request(Route("POST", "/channels/{channel_id}/messages/bulk-delete", channel_id=channel_id))
+
+    async def delete_channel(self, channel_id, *, reason=None):
+        await self.request(Route("DELETE", "/channels/{channel_id}", channel_id=channel_id))
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.mention = f"<@{user_id}>"
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.members = {}
+
+    async def fetch_member(self, user_id):
+        await am.bot.http.request(Route("GET", "/guilds/{guild_id}/members/{user_id}",
+                                        guild_id=self.id, user_id=user_id))
+        return self.members[user_id]
+
+
+class FakeMessage:
+    _ids = itertools.count(10**17)
+
+    def __init__(self, channel, content=None, author=None, message_id=None):
+        self.id = message_id or next(self._ids)
+        self.channel = channel
+        self.content = content or ""
+        self.author = author
+
+
+class FakePartialMessage:
+    def __init__(self, channel, message_id):
+        self.channel = channel
+        self.id = message_id
+
+    async def edit(self, **fields):
+        await am.bot.http.request(Route("PATCH", "/channels/{channel_id}/messages/{message_id}",
+                                        channel_id=self.channel.id, message_id=self.id))
+
+
+class FakeChannel:
+    _ids = itertools.count(10**16)
+    threads = {}  # id -> every thread created so far
+
+    def __init__(self, guild):
+        self.id = next(self._ids)
+        self.guild = guild
+        self.mention = f"<#{self.id}>"
+        self.jump_url = f"https://discord.com/channels/{guild.id}/{self.id}"
+        self.messages = []
+
+    async def send(self, content=None, *, embeds=None, view=None, **kwargs):
+        await am.bot.http.request(Route("POST", "/channels/{channel_id}/messages", channel_id=self.id))
+        message = FakeMessage(self, content, am.bot.user)
+        self.messages.append(message)
+        return message
+
+    def get_partial_message(self, message_id):
+        return FakePartialMessage(self, message_id)
+
+    async def create_thread(self, *, name, type=None, invitable=True, **kwargs):
+        await am.bot.http.request(Route("POST", "/channels/{channel_id}/threads", channel_id=self.id))
+        thread = FakeChannel(self.guild)
+        FakeChannel.threads[thread.id] = thread
+        return thread
+
+    async def add_user(self, user):
+        await am.bot.http.request(Route("PUT", "/channels/{channel_id}/thread-members/{user_id}",
+                                        channel_id=self.id, user_id=user.id))
+
+    async def delete(self):
+        await am.bot.http.request(Route("DELETE", "/channels/{channel_id}", channel_id=self.id))
+
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.deferred = False
+        self.rejected = None
+
+    async def defer(self, *, ephemeral=False, **kwargs):
+        await am.bot.http.request(Route("POST", "/interactions/{interaction_id}/{interaction_token}/callback",
+                                        interaction_id=0, interaction_token="t"))
+        self.deferred = True
+
+    async def send_message(self, content=None, *, ephemeral=False, **kwargs):
+        await am.bot.http.request(Route("POST", "/interactions/{interaction_id}/{interaction_token}/callback",
+                                        interaction_id=0, interaction_token="t"))
+        self.rejected = content
+
+
+class FakeFollowup:
+    async def send(self, content=None, **kwargs):
+        await am.bot.http.request(Route("POST", "/webhooks/{webhook_id}/{webhook_token}",
+                                        webhook_id=0, webhook_token="t"))
+
+
+class FakeInteraction:
+    def __init__(self, custom_id, user, channel, message=None):
+        self.data = {"custom_id": custom_id}
+        self.type = discord.InteractionType.component
+        self.user = user
+        self.channel = channel
+        self.channel_id = channel.id
+        self.guild = channel.guild
+        self.message = message
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup()
+
+
+# ----------------- Load test -----------------
+class Barrier:
+    """Lets every deal reach the same point before any goes on (asyncio.Barrier needs 3.11)."""
+    def __init__(self, parties):
+        self.parties = parties
+        self.arrived = 0
+        self.event = asyncio.Event()
+
+    async def wait(self):
+        self.arrived += 1
+        if self.arrived >= self.parties:
+            self.event.set()
+        await self.event.wait()
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.latencies = {step: [] for step in STEPS}
+        self.completed = 0
+        self.failed = collections.Counter()
+        self.rejected = 0
+        self.guild = FakeGuild(4242 << 22)
+        self.memory = None
+        self._user_ids = itertools.count(10**15, 2)
+
+    async def click(self, custom_id, user, channel, message=None):
+        """Click a button, retrying while admission control turns it away."""
+        while True:
+            interaction = FakeInteraction(custom_id, user, channel, message)
+            await am.interactions.dispatch(interaction)
+            if interaction.response.rejected is None or "already" in interaction.response.rejected:
+                return interaction
+            self.rejected += 1
+            await asyncio.sleep(0.2 + random.random() * 0.3)
+
+    async def reply(self, channel, author, content):
+        """Answer the prompt waiting in a thread, once the bot asks."""
+        while channel.id not in am.message_router.waiters:
+            await asyncio.sleep(0.005)
+        am.message_router.dispatch(FakeMessage(channel, content, author))
+
+    async def until(self, predicate, timeout):
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            if time.monotonic() > deadline:
+                raise asyncio.TimeoutError()
+            await asyncio.sleep(0.005)
+
+    async def deal(self, index, barrier):
+        args = self.args
+        seller, buyer = FakeUser(next(self._user_ids)), FakeUser(next(self._user_ids))
+        self.guild.members[buyer.id] = buyer
+        parent = FakeChannel(self.guild)
+        step = "create"
+        reached = False
+        try:
+            started = time.perf_counter()
+            await self.click("create_ticket", seller, parent)
+            deal = am.deal_store.for_participant(seller.id)[0]
+            thread = FakeChannel.threads[deal.thread_id]
+            self.latencies["create"].append(time.perf_counter() - started)
+
+            step = "accept"
+            started = time.perf_counter()
+            await asyncio.gather(
+                self.click(f"accept_deal:{deal.deal_id}", seller, thread),
+                self.reply(thread, seller, str(buyer.id)),
+            )
+            await self.until(lambda: deal.role_message_id is not None, args.timeout)
+            self.latencies["accept"].append(time.perf_counter() - started)
+
+            step = "roles"
+            started = time.perf_counter()
+            role_message = FakeMessage(thread, message_id=deal.role_message_id)
+            view = deal.role_view
+            for user, button in ((seller, view.sender_button), (buyer, view.receiver_button)):
+                await button.callback(FakeInteraction("role", user, thread, role_message))
+            for user in (seller, buyer):
+                await view.confirm_button.callback(FakeInteraction("confirm_role", user, thread, role_message))
+            await self.until(lambda: deal.address is not None, args.timeout)
+            self.latencies["roles"].append(time.perf_counter() - started)
+
+            step = "deposit"
+            confirm = asyncio.create_task(self.click(f"confirm_funds:{deal.deal_id}", seller, thread))
+            await self.until(lambda: deal.address in am.deposit_watcher.waiters, args.timeout)
+            reached = True
+            await barrier.wait()
+            started = time.perf_counter()
+            self.node.pay(deal.address, args.amount)
+            await self.until(lambda: deal.state != "roles_confirmed", args.timeout)
+            self.latencies["deposit"].append(time.perf_counter() - started)
+
+            step = "confirmations"
+            started = time.perf_counter()
+            await self.until(lambda: deal.state == "confirmed", args.timeout)
+            await confirm
+            self.latencies["confirmations"].append(time.perf_counter() - started)
+
+            step = "release"
+            started = time.perf_counter()
+            await asyncio.gather(
+                self.click(f"release_funds:{deal.deal_id}", seller, thread),
+                self.reply(thread, seller, self.payout_address),
+            )
+            if deal.state != "released":
+                raise RuntimeError(f"deal ended as {deal.state}")
+            self.latencies["release"].append(time.perf_counter() - started)
+            self.completed += 1
+        except Exception as e:
+            self.failed[f"{step}: {type(e).__name__}"] += 1
+            if not reached:
+                await barrier.wait()
+
+    async def run(self):
+        args = self.args
+        self.payout_address = bech32_address("ltc", bytes(range(20)))
+
+        # Blocks are announced like ZMQ would
+        self.node = FakeNode(args.block_time, on_block=lambda: am.chain_notifier.received("bench"))
+        await self.node.start()
+        am.rpc = am.RPCPool(am.LitecoinRPC(self.node.url, "bench", "bench"))
+        am.bot.http = FakeHTTP(args.discord_latency)
+        am.metrics.port = None
+        if args.no_pacing:
+            am.outbox.route_limits = {route: (10**6, 1.0) for route in am.outbox.route_limits}
+            am.outbox.global_budget = am.RateBudget(10**6, 1.0)
+        await am.setup_hook()
+        await asyncio.sleep(0.2)  # Let the address pool fill
+
+        if args.memory:
+            tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0] if args.memory else 0
+        barrier = Barrier(args.deals)
+        started = time.perf_counter()
+        deals = [asyncio.create_task(self.deal(index, barrier)) for index in range(args.deals)]
+        await barrier.event.wait()
+        if args.memory:
+            open_deals = sum(1 for deal in am.deal_store.deals.values() if deal.state == "roles_confirmed")
+            in_use = tracemalloc.get_traced_memory()[0] - baseline
+            self.memory = {"open_deals": open_deals, "bytes_per_open_deal": in_use // max(open_deals, 1)}
+            tracemalloc.stop()
+        await asyncio.gather(*deals)
+        elapsed = time.perf_counter() - started
+
+        await am.deal_store.flush()
+        await self.node.stop()
+        await am.rpc.close()
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        args = self.args
+        steps = {}
+        for step, values in self.latencies.items():
+            steps[step] = {
+                "count": len(values),
+                "p50": percentile(values, 0.50),
+                "p99": percentile(values, 0.99),
+                "mean": sum(values) / len(values) if values else None,
+                "max": max(values, default=None),
+            }
+        deals = max(args.deals, 1)
+        return {
+            "config": {
+                "deals": args.deals,
+                "block_time": args.block_time,
+                "amount": args.amount,
+                "discord_latency": args.discord_latency,
+                "pacing": not args.no_pacing,
+                "payout_batching": am.PAYOUT_BATCHING,
+                "memory_tracing": args.memory,
+                "seed": args.seed,
+            },
+            "environment": {"python": platform.python_version(), "platform": platform.platform()},
+            "started_at": int(time.time() - elapsed),
+            "wall_seconds": elapsed,
+            "completed": self.completed,
+            "failed": dict(self.failed),
+            "rejected_clicks": self.rejected,
+            "throughput_deals_per_second": self.completed / elapsed if elapsed else None,
+            "steps": steps,
+            "rpc": {
+                "requests_per_deal": self.node.requests / deals,
+                "calls_per_deal": sum(self.node.calls.values()) / deals,
+                "calls_by_method": dict(self.node.calls),
+            },
+            "discord": {
+                "requests_per_deal": sum(am.bot.http.routes.values()) / deals,
+                "requests_by_route": dict(am.bot.http.routes),
+            },
+            "memory": self.memory,
+        }
+
+
+def print_summary(result):
+    print(f"{result['completed']}/{result['config']['deals']} deals in {result['wall_seconds']:.2f}s "
+          f"({result['throughput_deals_per_second']:.2f} deals/s), {result['rejected_clicks']} clicks refused")
+    if result["failed"]:
+        print(f"failed: {result['failed']}")
+    for step, stats in result["steps"].items():
+        if stats["count"]:
+            print(f"  {step:<14} p50 {stats['p50'] * 1000:9.1f} ms   p99 {stats['p99'] * 1000:9.1f} ms")
+    print(f"  RPC: {result['rpc']['calls_per_deal']:.1f} calls / {result['rpc']['requests_per_deal']:.1f} requests per deal")
+    print(f"  Discord: {result['discord']['requests_per_deal']:.1f} requests per deal")
+    if result["memory"]:
+        print(f"  Memory: {result['memory']['bytes_per_open_deal']} bytes per open deal "
+              f"({result['memory']['open_deals']} open)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--deals", type=int, default=100, help="Concurrent deals to run")
+    parser.add_argument("--block-time", type=float, default=0.5, help="Seconds between stand-in blocks")
+    parser.add_argument("--amount", type=float, default=1.0, help="LTC deposited per deal, sets the confirmations required")
+    parser.add_argument("--discord-latency", type=float, default=0.05, help="Seconds every Discord REST call takes")
+    parser.add_argument("--no-pacing", action="store_true", help="Lift the outbox rate limits")
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="Skip tracemalloc, which slows the run")
+    parser.add_argument("--timeout", type=float, default=300, help="Seconds a deal step may take before it counts as failed")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench.json", help="Where to write the JSON results")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    output = os.path.abspath(args.output)
+    workdir = tempfile.mkdtemp(prefix="automiddleman-bench-")
+    # The bot keeps its files relative to the working directory
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+    global am, discord, Route
+    import discord
+    from discord.http import Route
+    import automiddleman as am
+
+    result = asyncio.run(LoadTest(args).run())
+    result["workdir"] = workdir
+    with open(output, "w") as f:
+        json.dump(result, f, indent=4)
+    print_summary(result)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
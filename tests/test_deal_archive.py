@@ -0,0 +1,95 @@
+"""Appending to and recovering the DealArchive."""
+import asyncio
+import os
+
+import automiddleman as am
+
+
+def record(n):
+    info = {"state": "released", "thread_id": 1000 + n, "address": f"ltc1qaddress{n}"}
+    return (f"deal{n}", info, [{"at": n, "author": 1, "content": f"message {n}"}])
+
+
+def segment_path(directory, segment=1):
+    return os.path.join(directory, f"segment-{segment:06d}.dat")
+
+
+def test_torn_record_is_truncated(tmp_path):
+    directory = str(tmp_path)
+    archive = am.DealArchive(directory)
+    archive.append([record(1)])
+    archive.close()
+    good = os.path.getsize(segment_path(directory))
+    # A crash mid-append: a header promising more bytes than were written
+    with open(segment_path(directory), "ab") as f:
+        f.write(am.DealArchive.HEADER.pack(500) + b"partial")
+
+    archive = am.DealArchive(directory)
+    assert archive.find(deal_id="deal1")["info"]["thread_id"] == 1001
+    assert os.path.getsize(segment_path(directory)) == good
+    # Later records land right after the last good one
+    archive.append([record(2)])
+    assert archive.find(deal_id="deal2")["transcript"][0]["content"] == "message 2"
+
+
+def test_unindexed_records_are_reindexed(tmp_path):
+    directory = str(tmp_path)
+    archive = am.DealArchive(directory)
+    archive.append([record(1), record(2)])
+    # A crash between writing the segment and indexing it
+    with archive.conn:
+        archive.conn.execute("DELETE FROM records WHERE deal_id = 'deal2'")
+    archive.close()
+
+    archive = am.DealArchive(directory)
+    assert archive.find(deal_id="deal2")["info"]["address"] == "ltc1qaddress2"
+
+
+
+def test_find_by_any_key_after_reopening(tmp_path):
+    directory = str(tmp_path)
+    archive = am.DealArchive(directory, segment_size=200)
+    archive.append([record(n) for n in range(5)])
+    archive.close()
+    assert os.path.exists(segment_path(directory, 2))  # Spread over several segments
+
+    archive = am.DealArchive(directory)
+    for n in range(5):
+        deal_id, info, transcript = record(n)
+        by_id = archive.find(deal_id=deal_id)
+        assert by_id["info"] == info
+        assert by_id["transcript"] == transcript
+        assert archive.find(thread_id=info["thread_id"]) == by_id
+        assert archive.find(address=info["address"]) == by_id
+    assert archive.find(deal_id="missing") is None
+
+
+def test_deal_store_archives_dropped_deals(tmp_path):
+    logs = tmp_path / "logs"
+    logs.mkdir()
+
+    def make_store():
+        return am.DealStore(
+            logs_dir=str(logs), snapshot_file=str(tmp_path / "deals.snapshot.json"),
+            journal_file=str(tmp_path / "deals.journal"), archive=am.DealArchive(str(tmp_path / "archive"))
+        )
+
+    async def write():
+        store = make_store()
+        deal = store.create("a" * 32, 1, 10)
+        store.update(deal, address="ltc1qdropped")
+        await store.flush()
+        store.archive_deal(deal)
+        await store.flush()
+
+    async def read():
+        store = make_store()
+        await store.load()
+        return store, await store.find_archived(address="ltc1qdropped")
+
+    asyncio.run(write())
+    store, found = asyncio.run(read())
+    assert not store.deals
+    assert not os.path.exists(logs / ("a" * 32))
+    assert found["deal_id"] == "a" * 32
+    assert found["info"]["thread_id"] == 1
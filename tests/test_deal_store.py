@@ -0,0 +1,75 @@
+"""Restoring the DealStore from its snapshot and journal."""
+import asyncio
+import json
+
+import automiddleman as am
+
+
+def make_store(tmp_path, **kwargs):
+    logs = tmp_path / "logs"
+    logs.mkdir(exist_ok=True)
+    return am.DealStore(
+        logs_dir=str(logs), snapshot_file=str(tmp_path / "deals.snapshot.json"),
+        journal_file=str(tmp_path / "deals.journal"), archive=am.DealArchive(str(tmp_path / "archive")), **kwargs
+    )
+
+
+def write_journal(tmp_path, entries, torn=None):
+    with open(tmp_path / "deals.journal", "w") as f:
+        f.write("".join(json.dumps(entry) + "\n" for entry in entries))
+        if torn is not None:
+            f.write(torn)
+
+
+def test_journal_replays_over_snapshot(tmp_path):
+    snapshot = {"a": {"state": "created", "thread_id": 1}, "b": {"state": "created", "thread_id": 2}}
+    (tmp_path / "deals.snapshot.json").write_text(json.dumps(snapshot))
+    write_journal(tmp_path, [
+        {"id": "a", "info": {"state": "accepted", "thread_id": 1}},
+        {"id": "b", "removed": True},
+        {"id": "c", "info": {"state": "created", "thread_id": 3}},
+    ])
+    infos, entries, legacy = make_store(tmp_path)._read_state()
+    assert infos == {"a": {"state": "accepted", "thread_id": 1}, "c": {"state": "created", "thread_id": 3}}
+    assert entries == 3
+    assert not legacy
+
+
+def test_torn_last_journal_line_is_ignored(tmp_path):
+    (tmp_path / "deals.snapshot.json").write_text(json.dumps({"a": {"state": "created"}}))
+    write_journal(tmp_path, [{"id": "a", "info": {"state": "accepted"}}], torn='{"id": "a", "info": {"sta')
+    infos, entries, legacy = make_store(tmp_path)._read_state()
+    assert infos == {"a": {"state": "accepted"}}
+    assert entries == 1
+
+
+def test_journal_without_snapshot(tmp_path):
+    write_journal(tmp_path, [{"id": "a", "info": {"state": "created"}}])
+    infos, entries, legacy = make_store(tmp_path)._read_state()
+    assert infos == {"a": {"state": "created"}}
+    assert not legacy
+
+
+def test_flushed_deals_load_back(tmp_path):
+    async def write():
+        store = make_store(tmp_path, snapshot_every=3)
+        kept = store.create("a" * 32, 1, 10)
+        gone = store.create("b" * 32, 2, 20)
+        await store.flush()
+        store.update(kept, state="accepted", participants=[10, 11])
+        store.archive_deal(gone)
+        store.create("c" * 32, 3, 30)
+        await store.flush()
+
+    async def read():
+        store = make_store(tmp_path)
+        await store.load()
+        return store
+
+    asyncio.run(write())
+    store = asyncio.run(read())
+    assert sorted(store.deals) == ["a" * 32, "c" * 32]
+    deal = store.get("a" * 32)
+    assert deal.state == "accepted"
+    assert store.by_thread(1) is deal
+    assert store.participants[11] == {"a" * 32}
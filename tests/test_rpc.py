@@ -0,0 +1,159 @@
+"""LitecoinRPC error mapping, against a stand-in node served by aiohttp."""
+import asyncio
+import base64
+import contextlib
+import socket
+
+import pytest
+from aiohttp import web
+
+import automiddleman as am
+
+
+@contextlib.asynccontextmanager
+async def node(handler):
+    """Serve `handler` on a local port and yield its URL."""
+    app = web.Application()
+    app.router.add_post("/", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    try:
+        yield f"http://127.0.0.1:{port}/"
+    finally:
+        await runner.cleanup()
+
+
+def run(handler, test, **kwargs):
+    """Run `test(client)` against a LitecoinRPC talking to `handler`."""
+    async def main():
+        async with node(handler) as url:
+            client = am.LitecoinRPC(url, **kwargs)
+            try:
+                return await test(client)
+            finally:
+                await client.close()
+    return asyncio.run(main())
+
+
+def credentials(request):
+    return base64.b64decode(request.headers["Authorization"].split()[1]).decode()
+
+
+def test_result_is_returned():
+    async def handler(request):
+        body = await request.json()
+        return web.json_response({"result": body["params"][0] * 2, "error": None, "id": body["id"]})
+    assert run(handler, lambda client: client.call("double", 21), user="u", password="p") == 42
+
+
+def test_http_500_with_error_body_raises_response_error():
+    async def handler(request):
+        body = await request.json()
+        error = {"code": -5, "message": "Invalid Litecoin address"}
+        return web.json_response({"result": None, "error": error, "id": body["id"]}, status=500)
+
+    with pytest.raises(am.RPCResponseError) as raised:
+        run(handler, lambda client: client.call("validateaddress", "x"), user="u", password="p")
+    assert raised.value.code == -5
+    assert raised.value.rpc_message == "Invalid Litecoin address"
+    assert raised.value.method == "validateaddress"
+
+
+def test_http_error_without_json_raises_connection_error():
+    async def handler(request):
+        return web.Response(status=503, text="Loading block index...")
+
+    with pytest.raises(am.RPCConnectionError, match="HTTP 503"):
+        run(handler, lambda client: client.call("getblockcount"), user="u", password="p")
+
+
+def test_rejected_cookie_is_read_again(tmp_path):
+    cookie = tmp_path / ".cookie"
+    cookie.write_text("__cookie__:old")
+    seen = []
+
+    async def handler(request):
+        seen.append(credentials(request))
+        if credentials(request) != "__cookie__:new":
+            return web.Response(status=401)
+        return web.json_response({"result": 7, "error": None, "id": (await request.json())["id"]})
+
+    async def test(client):
+        with pytest.raises(am.RPCConnectionError, match="Authentication"):
+            await client.call("getblockcount")
+        # The node restarted and wrote a new cookie
+        cookie.write_text("__cookie__:new")
+        return await client.call("getblockcount")
+
+    assert run(handler, test, cookie_file=str(cookie)) == 7
+    assert seen == ["__cookie__:old", "__cookie__:new"]
+
+
+def test_slow_node_raises_timeout():
+    async def handler(request):
+        await asyncio.sleep(1)
+        return web.json_response({"result": None, "error": None, "id": 1})
+
+    async def test(client):
+        await client.call("getblockcount", timeout=0.2)
+
+    with pytest.raises(am.RPCTimeoutError):
+        run(handler, test, user="u", password="p")
+
+
+def test_unreachable_node_raises_connection_error():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    client = am.LitecoinRPC(f"http://127.0.0.1:{port}/", "u", "p")
+
+    async def main():
+        try:
+            await client.call("getblockcount")
+        finally:
+            await client.close()
+
+    with pytest.raises(am.RPCConnectionError):
+        asyncio.run(main())
+
+
+def test_missing_batch_reply():
+    async def handler(request):
+        requests = await request.json()
+        # Only the first call is answered
+        return web.json_response([{"result": "first", "error": None, "id": requests[0]["id"]}])
+
+    calls = [("getbestblockhash",), ("getblockcount",)]
+
+    async def test(client):
+        return await client.batch(calls, return_exceptions=True)
+
+    first, second = run(handler, test, user="u", password="p")
+    assert first == "first"
+    assert isinstance(second, am.RPCResponseError)
+    assert second.method == "getblockcount"
+
+    async def strict(client):
+        await client.batch(calls)
+
+    with pytest.raises(am.RPCResponseError, match="Missing reply"):
+        run(handler, strict, user="u", password="p")
+
+
+def test_batch_error_entries():
+    async def handler(request):
+        requests = await request.json()
+        return web.json_response([
+            {"result": None, "error": {"code": -8, "message": "Block height out of range"}, "id": requests[1]["id"]},
+            {"result": 1, "error": None, "id": requests[0]["id"]},
+        ])
+
+    async def test(client):
+        return await client.batch([("getblockcount",), ("getblockhash", 10 ** 9)], return_exceptions=True)
+
+    count, error = run(handler, test, user="u", password="p")
+    assert count == 1
+    assert error.code == -8
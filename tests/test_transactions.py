@@ -0,0 +1,171 @@
+"""Address decoding, fee estimation and transaction building for payouts."""
+import hashlib
+
+import pytest
+
+import automiddleman as am
+
+GENESIS_HASH160 = bytes.fromhex("62e907b15cbf27d5425399ebf6f0fb50ebb88f18")
+P2WPKH_PROGRAM = bytes.fromhex("751e76e8199196d454941c45d1b3a323f1433bd6")
+P2WPKH_SCRIPT = b"\x00\x14" + P2WPKH_PROGRAM
+
+
+def base58check(payload):
+    payload += hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4]
+    number = int.from_bytes(payload, "big")
+    encoded = ""
+    while number:
+        number, digit = divmod(number, 58)
+        encoded = am.BASE58_ALPHABET[digit] + encoded
+    return "1" * (len(payload) - len(payload.lstrip(b"\x00"))) + encoded
+
+
+def segwit_address(hrp, version, program):
+    acc = bits = 0
+    data = [version]
+    for byte in program:
+        acc = (acc << 8) | byte
+        bits += 8
+        while bits >= 5:
+            bits -= 5
+            data.append((acc >> bits) & 31)
+    if bits:
+        data.append((acc << (5 - bits)) & 31)
+    const = 1 if version == 0 else am.BECH32M_CONST
+    values = [ord(c) >> 5 for c in hrp] + [0] + [ord(c) & 31 for c in hrp] + data
+    polymod = am._bech32_polymod(values + [0] * 6) ^ const
+    data += [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+    return hrp + "1" + "".join(am.BECH32_CHARSET[d] for d in data)
+
+
+# ----------------- bech32 -----------------
+@pytest.mark.parametrize("hrp, address, version, program", [
+    # BIP173
+    ("bc", "BC1QW508D6QEJXTDG4Y5R3ZARVARY0C5XW7KV8F3T4", 0, "751e76e8199196d454941c45d1b3a323f1433bd6"),
+    ("tb", "tb1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3q0sl5k7", 0,
+     "1863143c14c5166804bd19203356da136c985678cd4d27a1b8c6329604903262"),
+    # BIP350
+    ("bc", "bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vqzk5jj0", 1,
+     "79be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798"),
+])
+def test_decode_segwit_vectors(hrp, address, version, program):
+    assert am._decode_segwit(hrp, address) == (version, bytes.fromhex(program))
+
+
+@pytest.mark.parametrize("hrp, address", [
+    # Mixed case
+    ("tb", "tb1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3q0sL5k7"),
+    # Bad checksum
+    ("bc", "bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t5"),
+    # Wrong network
+    ("ltc", "bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4"),
+])
+def test_decode_segwit_rejects(hrp, address):
+    with pytest.raises(am.AddressError):
+        am._decode_segwit(hrp, address)
+
+
+def test_witness_v1_needs_bech32m():
+    address = segwit_address("ltc", 1, bytes(32))
+    assert am._decode_segwit("ltc", address) == (1, bytes(32))
+    # The same data with a bech32 (v0) checksum must be rejected
+    values = [ord(c) >> 5 for c in "ltc"] + [0] + [ord(c) & 31 for c in "ltc"]
+    data = [am.BECH32_CHARSET.index(c) for c in address[4:-6]]
+    polymod = am._bech32_polymod(values + data + [0] * 6) ^ 1
+    bad = address[:-6] + "".join(am.BECH32_CHARSET[(polymod >> 5 * (5 - i)) & 31] for i in range(6))
+    with pytest.raises(am.AddressError):
+        am._decode_segwit("ltc", bad)
+
+
+def test_address_to_script_segwit():
+    assert am.address_to_script(segwit_address("ltc", 0, P2WPKH_PROGRAM)) == P2WPKH_SCRIPT
+    assert am.address_to_script(segwit_address("ltc", 1, bytes(32))) == b"\x51\x20" + bytes(32)
+    with pytest.raises(am.AddressError):
+        am.address_to_script(segwit_address("ltc", 0, bytes(25)))  # v0 programs are 20 or 32 bytes
+
+
+# ----------------- base58 -----------------
+def test_decode_base58check_vector():
+    # Bitcoin's genesis block coinbase address
+    payload = am._decode_base58check("1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa")
+    assert payload == b"\x00" + GENESIS_HASH160
+
+
+def test_decode_base58check_rejects():
+    with pytest.raises(am.AddressError):
+        am._decode_base58check("1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNb")  # Checksum
+    with pytest.raises(am.AddressError):
+        am._decode_base58check("1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfN0")  # 0 is not base58
+
+
+def test_address_to_script_base58():
+    p2pkh = base58check(b"\x30" + GENESIS_HASH160)
+    assert p2pkh.startswith("L")
+    assert am.address_to_script(p2pkh) == b"\x76\xa9\x14" + GENESIS_HASH160 + b"\x88\xac"
+    for version in (0x32, 0x05):  # M... and legacy 3... P2SH addresses
+        assert am.address_to_script(base58check(bytes([version]) + GENESIS_HASH160)) == b"\xa9\x14" + GENESIS_HASH160 + b"\x87"
+
+
+@pytest.mark.parametrize("version", [0x00, 0x6f, 0xc4, 0x3a])
+def test_address_to_script_rejects_other_versions(version):
+    # Bitcoin mainnet, and testnet versions on the main network
+    with pytest.raises(am.AddressError):
+        am.address_to_script(base58check(bytes([version]) + GENESIS_HASH160), network="main")
+
+
+def test_address_to_script_rejects_bad_length():
+    with pytest.raises(am.AddressError):
+        am.address_to_script(base58check(b"\x30" + GENESIS_HASH160[:19]))
+
+
+# ----------------- Fees -----------------
+def test_p2wpkh_one_in_one_out_is_110_vbytes():
+    assert am.estimate_vsize(["p2wpkh"], [P2WPKH_SCRIPT]) == 110
+    assert am.fee_for(110, 0.0001) == 1100
+
+
+def test_legacy_input_has_no_witness_overhead():
+    # 10 bytes overhead + 148 input + 31 output, no marker and flag
+    assert am.estimate_vsize(["p2pkh"], [P2WPKH_SCRIPT]) == 189
+
+
+# ----------------- Building -----------------
+def utxo(litoshis, vout=0, script="0014" + P2WPKH_PROGRAM.hex()):
+    return {"txid": "11" * 32, "vout": vout, "amount": litoshis / am.COIN, "scriptPubKey": script}
+
+
+def test_sweep_sends_everything_less_fee_without_change():
+    raw_hex, amount, fee = am.build_sweep([utxo(100000), utxo(50000, vout=1)], P2WPKH_SCRIPT, 0.0001)
+    assert fee == am.fee_for(am.estimate_vsize(["p2wpkh", "p2wpkh"], [P2WPKH_SCRIPT]), 0.0001)
+    assert amount + fee == 150000
+    # One output, to the recipient: no change comes back to the escrow
+    assert raw_hex.count(P2WPKH_SCRIPT.hex()) == 1
+    assert raw_hex.endswith(amount.to_bytes(8, "little").hex() + "16" + P2WPKH_SCRIPT.hex() + "00000000")
+
+
+def test_sweep_dust_edge():
+    _, amount, fee = am.build_sweep([utxo(am.DUST_LIMIT + 1100)], P2WPKH_SCRIPT, 0.0001)
+    assert (amount, fee) == (am.DUST_LIMIT, 1100)
+    with pytest.raises(ValueError):
+        am.build_sweep([utxo(am.DUST_LIMIT + 1099)], P2WPKH_SCRIPT, 0.0001)
+
+
+def test_batched_fees_add_up():
+    payouts = [([utxo(200000)], P2WPKH_SCRIPT), ([utxo(300000, vout=1)], P2WPKH_SCRIPT)]
+    _, results = am.build_payouts(payouts, 0.0001)
+    total_fee = sum(fee for _, fee in results)
+    assert total_fee >= am.fee_for(am.estimate_vsize(["p2wpkh"] * 2, [P2WPKH_SCRIPT] * 2), 0.0001)
+    assert [amount + fee for amount, fee in results] == [200000, 300000]
+
+
+def test_serialize_known_transaction():
+    # Spends output 0 of the genesis coinbase txid to a P2WPKH output of 50 LTC
+    txid = "4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b"
+    assert am.serialize_transaction([(txid, 0)], [(P2WPKH_SCRIPT, 5000000000)]) == (
+        "02000000"
+        "01"
+        "3ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a" "00000000" "00" "ffffffff"
+        "01"
+        "00f2052a01000000" "16" "0014751e76e8199196d454941c45d1b3a323f1433bd6"
+        "00000000"
+    )
@@ -0,0 +1,96 @@
+"""Output reservations of the UTXOIndex that payouts spend from."""
+import asyncio
+
+import pytest
+
+import automiddleman as am
+
+ADDRESS = "ltc1qescrow"
+
+
+def utxo(txid, vout=0, confirmations=6, address=ADDRESS, amount="0.5"):
+    return {"txid": txid, "vout": vout, "address": address, "amount": amount, "confirmations": confirmations}
+
+
+def index_with(*utxos):
+    index = am.UTXOIndex()
+    index.update([ADDRESS], list(utxos))
+    return index
+
+
+def outpoints(utxos):
+    return sorted((u["txid"], u["vout"]) for u in utxos)
+
+
+def test_concurrent_reservations_never_share_an_output():
+    index = index_with(utxo("a"), utxo("a", 1), utxo("b"))
+
+    async def reserve_all():
+        return await asyncio.gather(*(index.reserve(f"deal{i}", ADDRESS) for i in range(5)))
+
+    results = asyncio.run(reserve_all())
+    taken = [outpoint for result in results for outpoint in outpoints(result)]
+    assert len(taken) == len(set(taken))
+    assert sorted(taken) == [("a", 0), ("a", 1), ("b", 0)]
+    assert set(index.reserved.values()) == {"deal0"}
+
+
+def test_reservations_racing_on_the_node_never_share_an_output(monkeypatch):
+    index = am.UTXOIndex()
+
+    # Nothing known yet: every reserve() asks the node and yields meanwhile
+    async def listunspent(method, *params):
+        await asyncio.sleep(0)
+        return [utxo("a"), utxo("b")]
+    monkeypatch.setattr(am.rpc, "call", listunspent)
+
+    async def reserve_all():
+        return await asyncio.gather(*(index.reserve(f"deal{i}", ADDRESS) for i in range(5)))
+
+    results = asyncio.run(reserve_all())
+    taken = [outpoint for result in results for outpoint in outpoints(result)]
+    assert sorted(taken) == [("a", 0), ("b", 0)]
+    assert len({index.reserved[outpoint] for outpoint in taken}) == 1
+
+
+def test_reservations_honour_confirmations(monkeypatch):
+    index = index_with(utxo("a"), utxo("b", confirmations=0))
+
+    # Known outputs below the threshold make it ask the node first
+    async def listunspent(method, *params):
+        return [utxo("a"), utxo("b", confirmations=0)]
+    monkeypatch.setattr(am.rpc, "call", listunspent)
+    first = asyncio.run(index.reserve("deal1", ADDRESS))
+    second = asyncio.run(index.reserve("deal2", ADDRESS, confirmations=0))
+    assert outpoints(first) == [("a", 0)]
+    assert outpoints(second) == [("b", 0)]
+
+
+def test_same_deal_cannot_reserve_twice():
+    index = index_with(utxo("a"))
+    asyncio.run(index.reserve("deal1", ADDRESS))
+    with pytest.raises(am.PayoutError):
+        asyncio.run(index.reserve("deal1", ADDRESS))
+
+
+def test_released_outputs_can_be_reserved_again():
+    index = index_with(utxo("a"))
+    first = asyncio.run(index.reserve("deal1", ADDRESS))
+    assert asyncio.run(index.reserve("deal2", ADDRESS)) == []
+    index.release("deal1", first)
+    assert outpoints(asyncio.run(index.reserve("deal2", ADDRESS))) == [("a", 0)]
+
+
+def test_spent_outputs_are_dropped():
+    index = index_with(utxo("a"), utxo("b"))
+    selected = asyncio.run(index.reserve("deal1", ADDRESS))
+    index.release("deal1", selected, spent=True)
+    assert not index.reserved
+    assert ADDRESS not in index.outputs
+
+
+def test_release_leaves_other_deals_reservations():
+    index = index_with(utxo("a"))
+    selected = asyncio.run(index.reserve("deal1", ADDRESS))
+    index.release("deal2", selected)
+    assert index.reserved == {("a", 0): "deal1"}